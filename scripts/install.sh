@@ -36,8 +36,8 @@ set -ex
 
 apt-get update -q
 apt-get install -yq --no-install-recommends \
-    python python-pip openvpn uwsgi uwsgi-plugin-python \
-    python-dev build-essential
+    python python-pip openvpn openssl ipset uwsgi uwsgi-plugin-python \
+    python-dev build-essential wireguard-tools
 
 pip install -U pip
 pip install -r $DIR/requirements.txt
@@ -52,6 +52,14 @@ $DIR/vpn-proxy/manage.py autosuperuser
 
 mkdir -p $DIR/tmp
 
+# Health sweeps exit right away when disabled, so only run them when enabled
+HEALTH_CHECKS=`$DIR/vpn-proxy/manage.py shell -c \
+    "from django.conf import settings; print bool(settings.HEALTH_CHECK_INTERVAL)"`
+SWEEP_HEALTH=
+if [ "$HEALTH_CHECKS" = "True" ]; then
+    SWEEP_HEALTH="attach-daemon = $DIR/vpn-proxy/manage.py sweep_health"
+fi
+
 cat > /etc/uwsgi/apps-available/vpn-proxy.ini << EOF
 [uwsgi]
 
@@ -63,6 +71,10 @@ processes = 4
 
 master = true
 vacuum = true
+enable-threads = true
+
+hook-master-start = exec:$DIR/vpn-proxy/manage.py fail_interrupted_jobs
+$SWEEP_HEALTH
 
 uid = root
 gid = root
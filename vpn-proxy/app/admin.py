@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from .models import Tunnel, Forwarding
+from .models import Tunnel, Forwarding, Job
 
 
 class ForwardingAdmin(admin.ModelAdmin):
@@ -61,7 +61,7 @@ class TunnelAdmin(admin.ModelAdmin):
     list_display = ['name', 'server', 'client', 'port',
                     'forwardings', 'active', 'created_at']
     actions = ['enable', 'disable', 'reset', 'delete_selected']
-    list_filter = ['active', 'created_at', 'updated_at']
+    list_filter = ['active', 'pooled', 'created_at', 'updated_at']
     inlines = [EditForwardingInline, AddForwardingInline]
 
     def get_fieldsets(self, request, obj=None):
@@ -72,6 +72,9 @@ class TunnelAdmin(admin.ModelAdmin):
                     'fields': ('name', 'server', 'client', 'port', 'active',
                                'created_at', 'updated_at'),
                 }),
+                ('Performance', {
+                    'fields': ('profile', 'tuning', 'rate', 'ceil'),
+                }),
                 ('Extra', {
                     'fields': ('key', 'conf', 'client_conf', 'client_script'),
                     'classes': ('collapse', ),
@@ -100,5 +103,14 @@ class TunnelAdmin(admin.ModelAdmin):
     delete_selected.short_description = "Delete"
 
 
+class JobAdmin(admin.ModelAdmin):
+    readonly_fields = ['kind', 'status', 'progress', 'params', 'result',
+                       'error', 'created_at', 'updated_at']
+    list_display = ['id', 'kind', 'status', 'progress', 'created_at',
+                    'updated_at']
+    list_filter = ['kind', 'status', 'created_at']
+
+
 admin.site.register(Tunnel, TunnelAdmin)
 admin.site.register(Forwarding, ForwardingAdmin)
+admin.site.register(Job, JobAdmin)
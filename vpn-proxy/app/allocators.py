@@ -0,0 +1,297 @@
+"""In-memory allocators for tunnel addresses and forwarding ports
+
+Allocators are loaded once from the DB, kept up to date as objects are
+saved and deleted, and answer allocation requests without querying the DB
+for every candidate.
+
+"""
+
+import re
+import bisect
+import random
+import logging
+import threading
+
+from netaddr import IPAddress, IPNetwork, IPSet
+
+
+log = logging.getLogger(__name__)
+
+
+class IntervalSet(object):
+    """A set of integers stored as sorted, disjoint, merged intervals
+
+    Membership tests and looking up the next integer not in the set take
+    O(log n) in the number of intervals.
+
+    """
+
+    def __init__(self, values=()):
+        self.starts, self.ends = [], []
+        for value in values:
+            self.add(value)
+
+    def _find(self, value):
+        """Return index of the interval containing value, or -1"""
+        index = bisect.bisect_right(self.starts, value) - 1
+        if index >= 0 and self.ends[index] >= value:
+            return index
+        return -1
+
+    def __contains__(self, value):
+        return self._find(value) >= 0
+
+    def __len__(self):
+        return sum(end - start + 1
+                   for start, end in zip(self.starts, self.ends))
+
+    def add(self, value):
+        if value in self:
+            return
+        index = bisect.bisect_right(self.starts, value)
+        merge_prev = index > 0 and self.ends[index - 1] == value - 1
+        merge_next = (index < len(self.starts) and
+                      self.starts[index] == value + 1)
+        if merge_prev and merge_next:
+            self.ends[index - 1] = self.ends[index]
+            del self.starts[index], self.ends[index]
+        elif merge_prev:
+            self.ends[index - 1] = value
+        elif merge_next:
+            self.starts[index] = value
+        else:
+            self.starts.insert(index, value)
+            self.ends.insert(index, value)
+
+    def discard(self, value):
+        index = self._find(value)
+        if index < 0:
+            return
+        start, end = self.starts[index], self.ends[index]
+        if start == end:
+            del self.starts[index], self.ends[index]
+        elif value == start:
+            self.starts[index] = value + 1
+        elif value == end:
+            self.ends[index] = value - 1
+        else:
+            self.ends[index] = value - 1
+            self.starts.insert(index + 1, value + 1)
+            self.ends.insert(index + 1, end)
+
+    def next_free(self, value):
+        """Return the smallest integer >= value not in the set"""
+        index = self._find(value)
+        if index >= 0:
+            return self.ends[index] + 1
+        return value
+
+    def first_free(self, first, last, start=None):
+        """Return an integer in [first, last] not in the set, or None
+
+        Search starts at `start`, if given, and wraps around."""
+        if start is None or not first <= start <= last:
+            start = first
+        value = self.next_free(start)
+        if value <= last:
+            return value
+        value = self.next_free(first)
+        if value < start:
+            return value
+        return None
+
+
+class AddressAllocator(object):
+    """Allocate private IPv4 addresses for tunnel endpoints
+
+    :param load:    callable returning all addresses in use
+    :param in_use:  callable checking whether an address is in use, used to
+                    double check candidates since other processes may have
+                    allocated addresses this one doesn't know of
+
+    """
+
+    def __init__(self, allowed_cidrs, reserved_cidrs, load, in_use):
+        self.available = IPSet(allowed_cidrs)
+        for cidr in reserved_cidrs:
+            if cidr:
+                self.available.remove(IPNetwork(cidr))
+        self.load, self.in_use = load, in_use
+        self.lock = threading.Lock()
+        self._used = None
+
+    @property
+    def used(self):
+        if self._used is None:
+            self._used = IntervalSet(int(IPAddress(addr))
+                                     for addr in self.load() if addr)
+            log.debug("Loaded %d used addresses.", len(self._used))
+        return self._used
+
+    def reserve(self, *addrs):
+        with self.lock:
+            for addr in addrs:
+                if addr:
+                    self.used.add(int(IPAddress(addr)))
+
+    def release(self, *addrs):
+        with self.lock:
+            for addr in addrs:
+                if addr:
+                    self.used.discard(int(IPAddress(addr)))
+
+    def reset(self):
+        """Forget all addresses, reloading them from the DB when needed"""
+        with self.lock:
+            self._used = None
+
+    def allocate(self, routable_cidrs, excluded_cidrs=[], client_addr=''):
+        """Find and reserve an available IP address
+
+        See `models.choose_ip` for the meaning of the parameters.
+
+        """
+        exc_nets = [exc_net for exc_net in routable_cidrs + excluded_cidrs
+                    if exc_net]
+        available = self.available - IPSet(exc_nets)
+        with self.lock:
+            for cidr in available.iter_cidrs():
+                # skip network and broadcast addresses
+                first, last = cidr.first + 1, cidr.last - 1
+                if first > last:
+                    continue
+                if client_addr:
+                    start = int(IPAddress(client_addr)) + 1
+                else:
+                    start = random.randint(first, last)
+                while True:
+                    address = self.used.first_free(first, last, start)
+                    if address is None:
+                        break
+                    self.used.add(address)
+                    address = str(IPAddress(address))
+                    if not self.in_use(address):
+                        return address
+                    log.debug("Address %s already in use.", address)
+        return None
+
+
+class PortAllocator(object):
+    """Allocate local ports from a range, tracked in a bitmap
+
+    :param start, stop: the range of ports, `stop` excluded
+    :param load:        callable returning all ports in use
+    :param in_use:      callable returning which of a list of ports are in
+                        use, used to double check candidates since other
+                        processes may have allocated ports this one doesn't
+                        know of
+
+    """
+
+    NOT_FULL = re.compile(b'[^\xff]')
+
+    def __init__(self, start, stop, load, in_use):
+        self.start, self.stop = start, stop
+        self.load, self.in_use = load, in_use
+        self.lock = threading.Lock()
+        self._bitmap = None
+        self.free = 0
+
+    def _load(self):
+        if self._bitmap is not None:
+            return
+        size = self.stop - self.start
+        self._bitmap = bytearray((size + 7) // 8)
+        self.free = size
+        # mark padding bits past the end of the range as used
+        for offset in xrange(size, len(self._bitmap) * 8):
+            self._bitmap[offset // 8] |= 1 << (offset % 8)
+        for port in self.load():
+            self._set(port)
+        log.debug("Loaded %d used ports.", size - self.free)
+
+    def _set(self, port):
+        if not self.start <= port < self.stop:
+            return
+        offset = port - self.start
+        byte, bit = offset // 8, 1 << (offset % 8)
+        if not self._bitmap[byte] & bit:
+            self._bitmap[byte] |= bit
+            self.free -= 1
+
+    def _clear(self, port):
+        if not self.start <= port < self.stop:
+            return
+        offset = port - self.start
+        byte, bit = offset // 8, 1 << (offset % 8)
+        if self._bitmap[byte] & bit:
+            self._bitmap[byte] &= ~bit
+            self.free += 1
+
+    def reserve(self, port):
+        with self.lock:
+            self._load()
+            self._set(port)
+
+    def release(self, port):
+        with self.lock:
+            self._load()
+            self._clear(port)
+
+    def reset(self):
+        """Forget all ports, reloading them from the DB when needed"""
+        with self.lock:
+            self._bitmap = None
+
+    def _find(self):
+        """Return a port not marked as used, starting at a random offset"""
+        bitmap = self._bitmap
+        pos = random.randrange(len(bitmap))
+        match = self.NOT_FULL.search(bitmap, pos) or \
+            self.NOT_FULL.search(bitmap, 0, pos)
+        byte = match.start()
+        value = bitmap[byte]
+        bit = 0
+        while value & (1 << bit):
+            bit += 1
+        return self.start + byte * 8 + bit
+
+    def allocate(self):
+        """Find and reserve an available port
+
+        Raise an Exception if all ports in the range are in use."""
+        with self.lock:
+            self._load()
+            while self.free:
+                port = self._find()
+                self._set(port)
+                if port not in self.in_use([port]):
+                    return port
+                log.debug("Port %s already in use.", port)
+        raise Exception('Could not find available port for allocation')
+
+    def allocate_many(self, count):
+        """Find and reserve `count` available ports, double checking all
+        candidates at once
+
+        Raise an Exception, reserving none, if there aren't enough ports
+        available in the range."""
+        ports = []
+        with self.lock:
+            self._load()
+            while len(ports) < count:
+                if self.free < count - len(ports):
+                    for port in ports:
+                        self._clear(port)
+                    raise Exception('Could not find %d available ports for '
+                                    'allocation' % count)
+                candidates = []
+                for _ in xrange(count - len(ports)):
+                    port = self._find()
+                    self._set(port)
+                    candidates.append(port)
+                used = self.in_use(candidates)
+                if used:
+                    log.debug("Ports %s already in use.", sorted(used))
+                ports.extend(port for port in candidates if port not in used)
+        return ports
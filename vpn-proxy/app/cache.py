@@ -0,0 +1,91 @@
+"""In-process cache of forwardings known to be applied
+
+Lets repeated requests for the same forwarding be answered without
+touching the DB or the kernel. Entries expire after
+settings.FORWARDING_CACHE_TTL seconds and are invalidated as forwardings
+and tunnels change. Invalidations that may affect other processes, such
+as disabling a forwarding or reconciling, update a shared generation file
+which every process stats on lookup.
+
+"""
+
+import os
+import time
+import logging
+import threading
+
+from django.conf import settings
+
+
+log = logging.getLogger(__name__)
+
+
+class ForwardingCache(object):
+
+    def __init__(self, ttl, path):
+        self.ttl, self.path = ttl, path
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.generation = self._generation()
+
+    def _generation(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime, stat.st_size
+
+    def get(self, tunnel_id, dst_addr, dst_port):
+        """Return cached local port for given target, or None"""
+        if not self.ttl:
+            return None
+        generation = self._generation()
+        if generation != self.generation:
+            with self.lock:
+                self.entries.clear()
+                self.generation = generation
+            return None
+        entry = self.entries.get((tunnel_id, dst_addr, dst_port))
+        if entry is None:
+            return None
+        loc_port, expires_at = entry
+        if expires_at < time.time():
+            self.entries.pop((tunnel_id, dst_addr, dst_port), None)
+            return None
+        return loc_port
+
+    def set(self, forwarding):
+        """Cache a forwarding that has just been enabled"""
+        if not self.ttl:
+            return
+        key = (forwarding.tunnel_id, forwarding.dst_addr, forwarding.dst_port)
+        with self.lock:
+            self.entries[key] = (forwarding.loc_port, time.time() + self.ttl)
+
+    def discard(self, forwarding):
+        """Drop a single forwarding from this process' cache"""
+        key = (forwarding.tunnel_id, forwarding.dst_addr, forwarding.dst_port)
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def invalidate(self):
+        """Drop all entries, in all processes"""
+        with self.lock:
+            self.entries.clear()
+        try:
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            # Both mtime and size change, in case mtime resolution is coarse
+            with open(self.path, 'a') as fobj:
+                if os.fstat(fobj.fileno()).st_size > 4096:
+                    fobj.truncate(0)
+                fobj.write('.')
+        except (IOError, OSError) as exc:
+            log.warning("Couldn't touch cache generation file %s: %r",
+                        self.path, exc)
+        self.generation = self._generation()
+
+
+forwarding_cache = ForwardingCache(
+    settings.FORWARDING_CACHE_TTL,
+    os.path.join(settings.LOCK_DIR, 'forwarding-cache.generation'))
@@ -0,0 +1,168 @@
+"""Periodic health sweep of all active tunnels
+
+Pings the client end of every active tunnel over the tunnel, every
+settings.HEALTH_CHECK_INTERVAL seconds. Tunnels are probed concurrently,
+with a socket each, from a single poll loop, and the latest results are
+written to a file, which /health/ serves without touching the DB or the
+network.
+
+"""
+
+import os
+import json
+import time
+import errno
+import select
+import socket
+import logging
+import threading
+
+from django.conf import settings
+from django.db import connection
+
+from . import icmp
+from .models import Tunnel
+
+
+log = logging.getLogger(__name__)
+
+RESULTS_PATH = os.path.join(settings.LOCK_DIR, 'health.json')
+
+
+def sweep(targets, count=3, interval=0.2, timeout=1):
+    """Ping all `targets`, (key, host, iface) tuples, at once and return
+    a dict of the results of icmp.iter_ping by key
+
+    All echo requests with the same sequence number are sent together, and
+    those unanswered `timeout` seconds after the last ones are lost."""
+    results, probes = {}, {}
+    poller = select.poll()
+    try:
+        for key, host, iface in targets:
+            try:
+                probe = icmp.Probe(host, iface)
+            except socket.error as exc:
+                log.warning("Failed to probe %s over %s: %r", host, iface,
+                            exc)
+                results[key] = [(seq, None) for seq in range(count)]
+                continue
+            results[key] = []
+            probes[probe.fileno()] = key, probe
+            poller.register(probe, select.POLLIN)
+        started_at = time.time()
+        ends_at = started_at + (count - 1) * interval + timeout
+        seq = 0
+        while time.time() < ends_at:
+            if seq < count and time.time() >= started_at + seq * interval:
+                for key, probe in probes.itervalues():
+                    probe.send(seq)
+                seq += 1
+            if seq == count and not any(probe.pending for key, probe
+                                        in probes.itervalues()):
+                break
+            wakeup = started_at + seq * interval if seq < count else ends_at
+            try:
+                events = poller.poll(max(wakeup - time.time(), 0) * 1000)
+            except select.error as exc:
+                if exc.args[0] != errno.EINTR:
+                    raise
+                continue
+            for fd, _ in events:
+                key, probe = probes[fd]
+                results[key].extend(probe.receive())
+        for key, probe in probes.itervalues():
+            results[key].extend((seq, None) for seq in sorted(probe.pending))
+    finally:
+        for key, probe in probes.itervalues():
+            probe.close()
+    return results
+
+
+def sweep_tunnels():
+    """Probe all active tunnels and return their health by tunnel id"""
+    tunnels = list(Tunnel.objects.filter(active=True, pooled=False))
+    connection.close()
+    batch_size = settings.HEALTH_CHECK_CONCURRENCY
+    health = {}
+    for i in range(0, len(tunnels), batch_size):
+        batch = tunnels[i:i + batch_size]
+        results = sweep([(tun.id, tun.client, tun.iface) for tun in batch],
+                        count=settings.HEALTH_CHECK_PKTS,
+                        timeout=settings.HEALTH_CHECK_TIMEOUT)
+        checked_at = time.time()
+        for tun in batch:
+            summary = icmp.summarize(tun.client, results[tun.id])
+            health[tun.id] = {
+                'client': tun.client,
+                'iface': tun.iface,
+                'rtt': summary['avgping'] and float(summary['avgping']),
+                'loss': int(summary['packet_loss']),
+                'checked_at': checked_at,
+            }
+    return health
+
+
+def write_results(health, started_at):
+    """Replace the results served by /health/ with `health`"""
+    data = json.dumps({
+        'interval': settings.HEALTH_CHECK_INTERVAL,
+        'started_at': started_at,
+        'duration': time.time() - started_at,
+        'tunnels': health,
+    })
+    if not os.path.isdir(os.path.dirname(RESULTS_PATH)):
+        os.makedirs(os.path.dirname(RESULTS_PATH))
+    # Readers must never see a partially written file
+    tmp_path = '%s.%d' % (RESULTS_PATH, os.getpid())
+    with open(tmp_path, 'wb') as fobj:
+        fobj.write(data)
+    os.rename(tmp_path, RESULTS_PATH)
+
+
+def run_sweep():
+    """Probe all active tunnels and publish the results, return them"""
+    started_at = time.time()
+    health = sweep_tunnels()
+    write_results(health, started_at)
+    log.info("Swept %d tunnels in %.3fs, %d unreachable.", len(health),
+             time.time() - started_at,
+             sum(1 for result in health.values() if result['rtt'] is None))
+    return health
+
+
+def sweep_forever():
+    while True:
+        started_at = time.time()
+        try:
+            run_sweep()
+        except Exception as exc:
+            log.exception("Failed to sweep tunnels: %r", exc)
+        time.sleep(max(settings.HEALTH_CHECK_INTERVAL -
+                       (time.time() - started_at), 0))
+
+
+class HealthResults(object):
+    """The latest sweep's results, re-read only when the file changes"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.stat, self.data = None, None
+
+    def get(self):
+        """Return the latest results, or None if there are none yet"""
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        # Every sweep renames a new file into place
+        stat = stat.st_ino, stat.st_mtime
+        with self.lock:
+            if stat != self.stat:
+                with open(self.path) as fobj:
+                    self.data = json.load(fobj)
+                self.stat = stat
+            return self.data
+
+
+health_results = HealthResults(RESULTS_PATH)
@@ -0,0 +1,210 @@
+"""In-process ICMP echo prober
+
+Pings hosts over ICMP sockets bound to a network interface, with the same
+SO_BINDTODEVICE option as scripts/bind_iface.py, instead of forking `ping`
+and parsing its output. Raw sockets are used when permitted, datagram
+ICMP sockets, subject to net.ipv4.ping_group_range, otherwise.
+
+"""
+
+import os
+import math
+import time
+import errno
+import select
+import socket
+import struct
+import logging
+import itertools
+
+
+log = logging.getLogger(__name__)
+
+SO_BINDTODEVICE = 25
+
+ICMP_ECHO_REPLY = 0
+ICMP_ECHO_REQUEST = 8
+
+# Type, code, checksum, identifier and sequence number
+HEADER = struct.Struct('!BBHHH')
+
+# Same size as `ping`'s default payload
+PAYLOAD = 'vpn-proxy'.ljust(56, '\0')
+
+_idents = itertools.count(os.getpid())
+
+
+def checksum(data):
+    """The internet checksum of `data`, see RFC 1071"""
+    if len(data) % 2:
+        data += '\0'
+    total = sum(struct.unpack('!%dH' % (len(data) // 2), data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+class Probe(object):
+    """Echo requests to `host` over `iface` and the replies to them
+
+    The socket is non-blocking and the probe has a fileno(), so that many
+    probes may be waited on together with select or poll."""
+
+    def __init__(self, host, iface=None):
+        self.host = str(host)
+        self.ident = next(_idents) & 0xffff
+        # Send times of requests not answered yet, by sequence number
+        self.pending = {}
+        try:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_RAW,
+                                      socket.IPPROTO_ICMP)
+            self.raw = True
+        except socket.error as exc:
+            if exc.errno not in (errno.EPERM, errno.EACCES):
+                raise
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
+                                      socket.IPPROTO_ICMP)
+            self.raw = False
+        try:
+            if iface:
+                self.sock.setsockopt(socket.SOL_SOCKET, SO_BINDTODEVICE,
+                                     str(iface))
+            self.sock.setblocking(False)
+        except socket.error:
+            self.sock.close()
+            raise
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        self.sock.close()
+
+    def send(self, seq):
+        """Send echo request `seq`, counted as lost if it can't be sent"""
+        seq &= 0xffff
+        header = HEADER.pack(ICMP_ECHO_REQUEST, 0, 0, self.ident, seq)
+        packet = HEADER.pack(ICMP_ECHO_REQUEST, 0,
+                             checksum(header + PAYLOAD), self.ident, seq)
+        self.pending[seq] = time.time()
+        try:
+            self.sock.sendto(packet + PAYLOAD, (self.host, 0))
+        except socket.error as exc:
+            log.debug("Failed to ping %s: %r", self.host, exc)
+
+    def receive(self):
+        """Read all replies received, return a list of (seq, rtt) with the
+        round-trip times in milliseconds"""
+        replies = []
+        while True:
+            try:
+                data, addr = self.sock.recvfrom(65536)
+            except socket.error as exc:
+                if exc.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    log.debug("Failed to receive from %s: %r", self.host, exc)
+                break
+            received_at = time.time()
+            if addr[0] != self.host:
+                continue
+            if self.raw:
+                # Raw sockets receive the IP header as well
+                data = data[(ord(data[0]) & 0x0f) * 4:]
+            if len(data) < HEADER.size:
+                continue
+            kind, _, _, ident, seq = HEADER.unpack_from(data)
+            # The kernel sets and matches the identifier of datagram sockets
+            if kind != ICMP_ECHO_REPLY or (self.raw and ident != self.ident):
+                continue
+            sent_at = self.pending.pop(seq, None)
+            if sent_at is not None:
+                replies.append((seq, (received_at - sent_at) * 1000))
+        return replies
+
+    def expire(self, timeout):
+        """Give up on requests unanswered for `timeout` seconds, return
+        their sequence numbers"""
+        now = time.time()
+        lost = sorted(seq for seq, sent_at in self.pending.items()
+                      if now - sent_at >= timeout)
+        for seq in lost:
+            del self.pending[seq]
+        return lost
+
+
+def iter_ping(host, iface=None, count=10, interval=0.4, timeout=1,
+              deadline=None):
+    """Ping `host` over `iface`, yield (seq, rtt) as replies arrive
+
+    Requests unanswered for `timeout` seconds are yielded with an rtt of
+    None, as are all outstanding ones once `deadline` seconds, if given,
+    have passed. Requests are then sent at most every half the deadline
+    divided by `count`, so that most are answered or lost by then.
+
+    The socket is opened when called rather than when iterated, so that
+    errors opening it, e.g. binding it to `iface` without CAP_NET_RAW, are
+    raised to the caller right away."""
+    if deadline:
+        interval = min(interval, deadline / 2.0 / max(count, 1))
+        timeout = min(timeout, deadline)
+    return _iter_ping(Probe(host, iface), count, interval, timeout, deadline)
+
+
+def _iter_ping(probe, count, interval, timeout, deadline):
+    try:
+        started_at = time.time()
+        seq = 0
+        while seq < count or probe.pending:
+            now = time.time()
+            if deadline and now - started_at >= deadline:
+                break
+            if seq < count and now >= started_at + seq * interval:
+                probe.send(seq)
+                seq += 1
+            for result in probe.receive():
+                yield result
+            for lost in probe.expire(timeout):
+                yield lost, None
+            wakeups = [sent_at + timeout
+                       for sent_at in probe.pending.values()]
+            if seq < count:
+                wakeups.append(started_at + seq * interval)
+            if deadline:
+                wakeups.append(started_at + deadline)
+            if wakeups:
+                select.select([probe], [], [],
+                              max(min(wakeups) - time.time(), 0))
+        for lost in sorted(probe.pending):
+            yield lost, None
+    finally:
+        probe.close()
+
+
+def summarize(host, results):
+    """Sum up the results of iter_ping, with the keys and formatting of
+    pingparser's summary of `ping`'s output"""
+    rtts = [rtt for seq, rtt in results if rtt is not None]
+    sent, received = len(results), len(rtts)
+    summary = {
+        'host': host,
+        'sent': str(sent),
+        'received': str(received),
+        'packet_loss': str((sent - received) * 100 // sent if sent else 0),
+        'minping': None,
+        'avgping': None,
+        'maxping': None,
+        'jitter': None,
+    }
+    if rtts:
+        avg = sum(rtts) / received
+        mdev = math.sqrt(max(sum(rtt * rtt for rtt in rtts) / received -
+                             avg * avg, 0))
+        summary.update(minping='%.3f' % min(rtts), avgping='%.3f' % avg,
+                       maxping='%.3f' % max(rtts), jitter='%.3f' % mdev)
+    return summary
+
+
+def ping(host, iface=None, count=10, interval=0.4, timeout=1,
+         deadline=None):
+    """Ping `host` over `iface` and return the summary of the results"""
+    return summarize(host, list(iter_ping(host, iface, count, interval,
+                                          timeout, deadline)))
@@ -0,0 +1,91 @@
+"""Run long running operations, such as provisioning, in the background
+
+Jobs are stored in the DB, so that their status may be polled from any
+web server process, and run by a pool of threads in the process that
+submitted them.
+
+"""
+
+import json
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from .models import Job
+from .pool import create_tunnel
+
+
+log = logging.getLogger(__name__)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def set_progress(job, progress, status=None):
+    job.progress = progress
+    if status:
+        job.status = status
+    job.save(update_fields=['progress', 'status', 'updated_at'])
+
+
+def create_tunnel_job(job, cidrs, excluded_cidrs, protocol=None,
+                      driver=None, profile=None, tuning=None, rate=None,
+                      ceil=None):
+    set_progress(job, 'provisioning tunnel')
+    tun = create_tunnel(cidrs, excluded_cidrs, protocol=protocol,
+                        driver=driver, profile=profile, tuning=tuning,
+                        rate=rate, ceil=ceil)
+    return tun.to_dict()
+
+
+HANDLERS = {
+    'create_tunnel': create_tunnel_job,
+}
+
+
+def run_job(job_id):
+    """Run job with given id, storing its result or error"""
+    try:
+        job = Job.objects.get(id=job_id)
+        set_progress(job, 'started', 'running')
+        try:
+            result = HANDLERS[job.kind](job, **json.loads(job.params))
+        except Exception as exc:
+            log.exception("Job %s failed: %r", job_id, exc)
+            job.status, job.error = 'failed', repr(exc)
+        else:
+            job.status, job.result = 'done', json.dumps(result)
+        job.progress = job.status
+        job.save()
+    finally:
+        connection.close()
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(settings.JOB_WORKERS)
+    return _pool
+
+
+def fail_interrupted():
+    """Mark jobs left pending or running as failed and return their count
+
+    Jobs only run in the process that submitted them, so none of them will
+    ever finish once the web server has been restarted."""
+    return Job.objects.filter(status__in=('pending', 'running')).update(
+        status='failed', progress='failed',
+        error="Interrupted by a restart of the web server",
+        updated_at=timezone.now())
+
+
+def submit(kind, **params):
+    """Create a pending Job and queue it in the worker pool"""
+    job = Job.objects.create(kind=kind, params=json.dumps(params))
+    get_pool().apply_async(run_job, (job.id, ))
+    return job
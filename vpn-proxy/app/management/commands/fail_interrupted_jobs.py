@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+from app.jobs import fail_interrupted
+
+
+class Command(BaseCommand):
+    help = ("Mark jobs left pending or running by a previous web server as "
+            "failed, run when the web server starts")
+
+    def handle(self, *args, **kwargs):
+        self.stdout.write("Marked %d interrupted jobs as failed." %
+                          fail_interrupted())
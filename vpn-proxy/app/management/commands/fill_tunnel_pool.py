@@ -0,0 +1,12 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from app.pool import fill_pool
+
+
+class Command(BaseCommand):
+    help = "Provision tunnels until settings.TUNNEL_POOL_SIZE are pooled"
+
+    def handle(self, *args, **kwargs):
+        created = fill_pool()
+        self.stdout.write("Provisioned %d tunnels, pool size is %d." % (
+            created, settings.TUNNEL_POOL_SIZE))
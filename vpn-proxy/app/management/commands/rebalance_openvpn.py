@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from app.tunnels import rebalance_openvpn
+
+
+class Command(BaseCommand):
+    help = "Spread OpenVPN servers over CPUs by their current load"
+
+    def add_arguments(self, parser):
+        parser.add_argument('-i', '--interval', default=1.0, type=float,
+                            help="Seconds to sample the load of servers for")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Only report moves, don't apply them")
+
+    def handle(self, *args, **kwargs):
+        moves = rebalance_openvpn(interval=kwargs['interval'],
+                                  dry_run=kwargs['dry_run'])
+        for iface, old, new, load in moves:
+            self.stdout.write("%-12s CPU %4s -> %-4s load %5.1f%%" % (
+                iface, '-' if old is None else old, new, load * 100))
+        self.stdout.write("%d OpenVPN servers moved." % len(moves))
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from app.reconcile import reconcile, RESOURCES
+
+
+class Command(BaseCommand):
+    help = "Reconcile server configuration with Tunnels and Forwardings"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Only report drift, don't apply changes")
+
+    def handle(self, *args, **kwargs):
+        report = reconcile(dry_run=kwargs['dry_run'])
+        for kind in RESOURCES:
+            self.stdout.write("%-10s %5d missing %5d extra" % (
+                kind, report['drift'][kind]['missing'],
+                report['drift'][kind]['extra']))
+        for phase in ('read', 'plan', 'apply'):
+            self.stdout.write("%s phase took %.3fs" % (
+                phase.capitalize(), report['timings'][phase]))
+        if report['errors']:
+            self.stderr.write("%d changes failed, see log for details." %
+                              report['errors'])
@@ -1,5 +1,15 @@
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
 from app.models import Tunnel
+from app.tunnels import iptables_batch, kernel_state
+
+import time
+import logging
+import itertools
+from multiprocessing.pool import ThreadPool
+
+
+log = logging.getLogger(__name__)
 
 
 class Command(BaseCommand):
@@ -7,12 +17,57 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument('tunnel', nargs='*', type=int)
+        parser.add_argument('-j', '--jobs', default=1, type=int,
+                            help="Number of tunnels to reset in parallel")
 
     def handle(self, *args, **kwargs):
         if kwargs['tunnel']:
             tunnels = Tunnel.objects.filter(id__in=kwargs['tunnel'])
         else:
             tunnels = Tunnel.objects.all()
-        for tunnel in tunnels:
-            self.stdout.write("Resetting tunnel %d..." % tunnel.id)
-            tunnel.reset()
+        tunnels = list(tunnels)
+        jobs = max(1, min(kwargs['jobs'], len(tunnels)))
+        started_at = time.time()
+        failed = []
+        with kernel_state() as state, iptables_batch() as batch:
+
+            def reset(tunnel):
+                """Reset tunnel sharing the command's snapshot and batch"""
+                _started_at = time.time()
+                try:
+                    with kernel_state(state), iptables_batch(batch):
+                        tunnel.reset()
+                except Exception as exc:
+                    log.exception("Error resetting tunnel %d: %r",
+                                  tunnel.id, exc)
+                    return tunnel, time.time() - _started_at, exc
+                finally:
+                    if jobs > 1:
+                        connection.close()
+                return tunnel, time.time() - _started_at, None
+
+            if jobs > 1:
+                pool = ThreadPool(jobs)
+                results = pool.imap_unordered(reset, tunnels)
+            else:
+                pool = None
+                results = itertools.imap(reset, tunnels)
+            try:
+                for i, (tunnel, duration, exc) in enumerate(results, 1):
+                    if exc is None:
+                        status = "done"
+                    else:
+                        status = "FAILED: %r" % exc
+                        failed.append(tunnel.id)
+                    self.stdout.write("[%d/%d] Reset tunnel %d in %.2fs, %s" %
+                                      (i, len(tunnels), tunnel.id, duration,
+                                       status))
+            finally:
+                if pool is not None:
+                    pool.close()
+                    pool.join()
+        self.stdout.write("Reset %d tunnels with %d jobs in %.2fs." %
+                          (len(tunnels), jobs, time.time() - started_at))
+        if failed:
+            raise CommandError("Failed to reset tunnels: %s" %
+                               ', '.join(map(str, sorted(failed))))
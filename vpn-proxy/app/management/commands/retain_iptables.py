@@ -1,5 +1,6 @@
 from django.core.management.base import BaseCommand
 from app.models import Forwarding
+from app.tunnels import iptables_batch, kernel_state
 
 import datetime
 
@@ -19,6 +20,7 @@ class Command(BaseCommand):
         )
         if kwargs['tunnel']:
             query['tunnel_id__in'] = kwargs['tunnel']
-        for frule in Forwarding.objects.filter(**query):
-            self.stdout.write("Disabling %s..." % frule)
-            frule.disable()
+        with kernel_state(), iptables_batch():
+            for frule in Forwarding.objects.filter(**query):
+                self.stdout.write("Disabling %s..." % frule)
+                frule.disable()
@@ -0,0 +1,26 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from app.health import run_sweep, sweep_forever
+
+
+class Command(BaseCommand):
+    help = ("Ping all active tunnels every settings.HEALTH_CHECK_INTERVAL "
+            "seconds and publish the results under /health/")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help="Sweep once and report unreachable tunnels")
+
+    def handle(self, *args, **kwargs):
+        if kwargs['once']:
+            health = run_sweep()
+            for tunnel_id in sorted(health):
+                if health[tunnel_id]['rtt'] is None:
+                    self.stdout.write("Tunnel %s (%s) is unreachable." % (
+                        tunnel_id, health[tunnel_id]['client']))
+            self.stdout.write("%d tunnels swept." % len(health))
+            return
+        if not settings.HEALTH_CHECK_INTERVAL:
+            raise CommandError("Health checks are disabled, set "
+                               "HEALTH_CHECK_INTERVAL.")
+        sweep_forever()
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 23:04
+from __future__ import unicode_literals
+
+import app.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0006_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tunnel',
+            name='instance',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='tunnel',
+            name='server',
+            field=models.GenericIPAddressField(protocol='IPv4', validators=[app.models.check_ip]),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 23:07
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0007_tunnel_instance'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tunnel',
+            name='driver',
+            field=models.CharField(choices=[('openvpn', 'OpenVPN'), ('wireguard', 'WireGuard')], default='openvpn', max_length=16),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 23:10
+from __future__ import unicode_literals
+
+import app.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0008_tunnel_driver'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tunnel',
+            name='profile',
+            field=models.CharField(blank=True, default='', max_length=32, validators=[app.models.check_profile]),
+        ),
+        migrations.AddField(
+            model_name='tunnel',
+            name='tuning',
+            field=models.TextField(blank=True, default='{}', validators=[app.models.check_tuning]),
+        ),
+    ]
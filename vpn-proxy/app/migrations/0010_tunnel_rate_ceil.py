@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 23:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0009_tunnel_performance'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tunnel',
+            name='ceil',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='tunnel',
+            name='rate',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
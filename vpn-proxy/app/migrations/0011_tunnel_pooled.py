@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 23:16
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0010_tunnel_rate_ceil'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tunnel',
+            name='pooled',
+            field=models.BooleanField(default=False),
+        ),
+    ]
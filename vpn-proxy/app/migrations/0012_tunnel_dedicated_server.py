@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 10:42
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def set_dedicated_server(apps, schema_editor):
+    Tunnel = apps.get_model('app', 'Tunnel')
+    for tunnel in Tunnel.objects.filter(instance__isnull=True):
+        tunnel.dedicated_server = tunnel.server
+        tunnel.save(update_fields=['dedicated_server'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0011_tunnel_pooled'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tunnel',
+            name='dedicated_server',
+            field=models.GenericIPAddressField(editable=False, null=True, protocol='IPv4', unique=True),
+        ),
+        migrations.RunPython(set_dedicated_server,
+                             migrations.RunPython.noop),
+    ]
@@ -1,18 +1,24 @@
 from __future__ import unicode_literals
 
-import random
+import os
+import json
 import logging
 
-from netaddr import IPAddress, IPNetwork, IPSet
+from netaddr import IPAddress, IPNetwork
 
-from django.db import models
-from django.db.models import Q
+from django.db import models, transaction
+from django.db.models import Q, Count
 from django.core.exceptions import ValidationError
+from django.core.validators import validate_ipv4_address
 from django.conf import settings
 
-from .tunnels import start_tunnel, stop_tunnel, gen_key
+from .tunnels import start_tunnel, stop_tunnel, gen_key, gen_client_cert
 from .tunnels import get_conf, get_client_conf, get_client_script
-from .tunnels import add_iptables, del_iptables, add_fwmark, del_fwmark
+from .tunnels import add_iptables, del_iptables, TUNNEL_DRIVERS
+from .tunnels import PERFORMANCE_OPTIONS
+from .tunnels import iptables_batch, kernel_state, tunnel_lock
+from .allocators import AddressAllocator, PortAllocator
+from .cache import forwarding_cache
 
 
 PORT_ALLOC_START, PORT_ALLOC_STOP = settings.PORT_ALLOC_RANGE
@@ -30,6 +36,10 @@ def choose_ip(routable_cidrs, excluded_cidrs=[], client_addr=''):
     `routable_cidrs`, and `excluded_cidrs` are excluded from the allocation
     process.
 
+    Addresses in use are tracked by `address_allocator`, which is loaded
+    from the DB once and then kept up to date as tunnels are saved and
+    deleted. The returned address is reserved until the tunnel is saved.
+
     :param routable_cidrs: the CIDRs that are to be routed over a VPN tunnel
     :param excluded_cidrs: an optional list of CIDRs to be excluded from the
                            address allocation process
@@ -39,32 +49,155 @@ def choose_ip(routable_cidrs, excluded_cidrs=[], client_addr=''):
     :return: a private IP address
 
     """
-    exc_nets = routable_cidrs + excluded_cidrs + settings.RESERVED_CIDRS
-    # make sure the exc_nets list does not contain any empty strings
-    exc_nets = [exc_net for exc_net in exc_nets if exc_net]
-    # a list of unique, non-overlapping supernets (to be excluded)
-    exc_nets = IPSet(exc_nets).iter_cidrs()
-    for network in settings.ALLOWED_CIDRS:
-        available_cidrs = IPSet(IPNetwork(network))
-        for exc_net in exc_nets:
-            available_cidrs.remove(exc_net)
-        if not available_cidrs:
-            continue
-        for cidr in available_cidrs.iter_cidrs():
-            first, last = cidr.first, cidr.last
-            if client_addr:
-                address = IPAddress(client_addr) + 1
-            else:
-                address = IPAddress(random.randrange(first + 1, last))
-            for _ in xrange(first + 1, last):
-                if address not in cidr or address == cidr.broadcast:
-                    address = cidr.network + 1
-                try:
-                    Tunnel.objects.get(Q(client=str(address)) |
-                                       Q(server=str(address)))
-                    address += 1
-                except Tunnel.DoesNotExist:
-                    return str(address)
+    return address_allocator.allocate(routable_cidrs, excluded_cidrs,
+                                      client_addr)
+
+
+def _used_addresses():
+    for client, server in Tunnel.objects.values_list('client', 'server'):
+        yield client
+        yield server
+
+
+def _address_in_use(address):
+    return Tunnel.objects.filter(Q(client=address) |
+                                 Q(server=address)).exists()
+
+
+address_allocator = AddressAllocator(
+    settings.ALLOWED_CIDRS,
+    settings.RESERVED_CIDRS + ([settings.SHARED_SERVER_CIDR]
+                               if settings.SHARED_SERVERS else []),
+    _used_addresses, _address_in_use)
+
+shared_address_allocator = AddressAllocator([settings.SHARED_SERVER_CIDR], [],
+                                            _used_addresses, _address_in_use)
+
+
+class SharedServer(object):
+    """A multi-client OpenVPN server, serving many tunnels
+
+    Shared servers are numbered from 0 to settings.SHARED_SERVERS - 1 and
+    each gets an equal part of settings.SHARED_SERVER_CIDR, whose first
+    address is the server's.
+
+    """
+
+    def __init__(self, index):
+        self.index = index
+        network = IPNetwork(settings.SHARED_SERVER_CIDR)
+        bits = max(settings.SHARED_SERVERS - 1, 0).bit_length()
+        self.networks = list(network.subnet(network.prefixlen + bits))
+        self.network = self.networks[index]
+
+    @property
+    def name(self):
+        return '%s%s' % (settings.SHARED_IFACE_PREFIX, self.index)
+
+    @property
+    def port(self):
+        return settings.SHARED_SERVER_PORT_START + self.index
+
+    @property
+    def server(self):
+        return str(self.network[1])
+
+    @property
+    def netmask(self):
+        return str(self.network.netmask)
+
+    @property
+    def rp_filter(self):
+        return '/proc/sys/net/ipv4/conf/%s/rp_filter' % self.name
+
+    @property
+    def conf_path(self):
+        return '/etc/openvpn/%s.conf' % self.name
+
+    @property
+    def performance(self):
+        return get_performance_profile(settings.DEFAULT_PERFORMANCE_PROFILE)
+
+    def choose_ip(self, routable_cidrs, excluded_cidrs=[]):
+        """Find an available client address in the server's network"""
+        excluded = ['%s/32' % self.server] + [str(network)
+                                              for network in self.networks
+                                              if network != self.network]
+        return shared_address_allocator.allocate(routable_cidrs,
+                                                 excluded_cidrs + excluded)
+
+
+def choose_shared_server():
+    """Return the shared server serving the fewest tunnels"""
+    counts = dict(Tunnel.objects.filter(instance__isnull=False)
+                  .values_list('instance').annotate(Count('id')))
+    return SharedServer(min(range(settings.SHARED_SERVERS),
+                            key=lambda index: counts.get(index, 0)))
+
+
+def create_tunnel(cidrs, excluded_cidrs=[], protocol=None, driver=None,
+                  profile=None, tuning=None, rate=None, ceil=None,
+                  pooled=False):
+    """Allocate addresses for and set up a new Tunnel
+
+    :param cidrs:          the CIDRs that are to be routed over the tunnel
+    :param excluded_cidrs: CIDRs to be excluded from address allocation
+    :param protocol:       'udp' or 'tcp', defaults to the field's default
+    :param driver:         'openvpn' or 'wireguard', defaults to the field's
+                           default
+    :param profile:        the name of a settings.PERFORMANCE_PROFILES entry
+    :param tuning:         a JSON object of options overriding the profile's
+    :param rate:           the guaranteed rate of the tunnel in kbit/s
+    :param ceil:           the maximum rate of the tunnel in kbit/s
+    :param pooled:         provision the tunnel for the pool, see app.pool
+
+    OpenVPN UDP tunnels are served by the least busy shared server, if any
+    are configured in settings.SHARED_SERVERS.
+
+    :return: the new, saved and enabled Tunnel
+
+    """
+    if driver and driver not in TUNNEL_DRIVERS:
+        raise ValidationError("Unknown tunnel driver %s." % driver)
+    params = {'pooled': pooled}
+    if protocol:
+        params['protocol'] = protocol
+    if driver:
+        params['driver'] = driver
+    if profile:
+        params['profile'] = profile
+    if tuning:
+        params['tuning'] = tuning
+    if rate:
+        params['rate'] = rate
+    if ceil:
+        params['ceil'] = ceil
+    if params.get('driver', 'openvpn') != 'openvpn':
+        params['key'] = TUNNEL_DRIVERS[params['driver']]().gen_key()
+    elif settings.SHARED_SERVERS and params.get('protocol', 'udp') == 'udp':
+        server = choose_shared_server()
+        params['instance'] = server.index
+        params['server'] = server.server
+        params['client'] = server.choose_ip(cidrs, excluded_cidrs)
+    if 'instance' not in params:
+        client = choose_ip(cidrs, excluded_cidrs)
+        params['client'] = client
+        params['server'] = choose_ip(cidrs, excluded_cidrs,
+                                     client_addr=client)
+    tun = Tunnel(**params)
+    try:
+        tun.save()
+    except Exception:
+        # Addresses are reserved as they're allocated, keep them only if
+        # the tunnel has been stored
+        if tun.id is None:
+            tun._release_addresses()
+        raise
+    if tun.shared_server is not None:
+        # The certificate's name is that of the tunnel, known once saved
+        tun.key = gen_client_cert(tun.name)
+        tun.save()
+    return tun
 
 
 def check_ip(addr):
@@ -74,17 +207,125 @@ def check_ip(addr):
         raise ValidationError("Only private IPv4 networks are supported.")
 
 
-def pick_port(port_start=PORT_ALLOC_START, port_stop=PORT_ALLOC_STOP):
-    """Find next available port based on Forwarding.
+def get_performance_profile(name):
+    """Return the options of performance profile `name`, or the default"""
+    return dict(settings.PERFORMANCE_PROFILES[
+        name or settings.DEFAULT_PERFORMANCE_PROFILE])
+
+
+def check_profile(name):
+    """Verify that the performance profile exists"""
+    if name and name not in settings.PERFORMANCE_PROFILES:
+        raise ValidationError("Unknown performance profile %s." % name)
+
+
+def check_tuning(tuning):
+    """Verify that tuning is a JSON object of valid performance options"""
+    try:
+        options = json.loads(tuning)
+    except ValueError:
+        raise ValidationError("Tuning must be a JSON object.")
+    if not isinstance(options, dict):
+        raise ValidationError("Tuning must be a JSON object.")
+    for option, value in options.items():
+        if option not in PERFORMANCE_OPTIONS:
+            raise ValidationError("Unknown performance option %s." % option)
+        if option == 'fast_io':
+            if not isinstance(value, bool):
+                raise ValidationError("fast_io must be true or false.")
+        elif value is not None and (isinstance(value, bool) or
+                                    not isinstance(value, int) or
+                                    value <= 0):
+            raise ValidationError("%s must be a positive integer." % option)
+
+
+def pick_port():
+    """Find and reserve next available port based on Forwarding.
     This function is used directly by views.py"""
-    for _ in xrange(100):
-        _port = random.randrange(port_start, port_stop)
+    return port_allocator.allocate()
+
+
+def _used_ports():
+    return Forwarding.objects.values_list('loc_port', flat=True)
+
+
+def _ports_in_use(ports):
+    used = set()
+    # Keep the number of query parameters within SQLite's limit
+    for i in range(0, len(ports), 500):
+        used.update(Forwarding.objects.filter(
+            loc_port__in=ports[i:i + 500]).values_list('loc_port', flat=True))
+    return used
+
+
+port_allocator = PortAllocator(PORT_ALLOC_START, PORT_ALLOC_STOP,
+                               _used_ports, _ports_in_use)
+
+
+def create_forwardings(tunnel, targets):
+    """Forward a local port over `tunnel` to each of `targets`, a list of
+    (dst_addr, dst_port) pairs, return the forwardings in the same order
+
+    Targets that are already forwarded keep their local port. Ports for the
+    rest are allocated at once, their forwardings are inserted in a single
+    transaction and the firewall rules of all targets are committed as one
+    batch. Raise ValidationError, before changing anything, if any target
+    is invalid."""
+    targets = [(str(addr), port) for addr, port in targets]
+    errors = []
+    for addr, port in targets:
         try:
-            Forwarding.objects.get(loc_port=_port)
-        except Forwarding.DoesNotExist:
-            return _port
-    else:
-        raise Exception('Cloud not find available port for allocation')
+            validate_ipv4_address(addr)
+        except ValidationError:
+            errors.append("Invalid destination address %s." % addr)
+        if not isinstance(port, int) or not 1 <= port <= 65535:
+            errors.append("Invalid destination port %s." % port)
+    if errors:
+        raise ValidationError(errors)
+    requested, existing = set(targets), {}
+    for forwarding in Forwarding.objects.filter(
+            tunnel=tunnel, dst_addr__in=set(addr for addr, _ in targets)):
+        target = (forwarding.dst_addr, forwarding.dst_port)
+        # Other ports of the same addresses are left alone
+        if target in requested:
+            forwarding.tunnel = tunnel
+            existing[target] = forwarding
+    new = []
+    for target in targets:
+        if target in existing:
+            continue
+        forwarding = Forwarding(tunnel=tunnel, dst_addr=target[0],
+                                dst_port=target[1], loc_port=0)
+        existing[target] = forwarding
+        new.append(forwarding)
+    ports = port_allocator.allocate_many(len(new))
+    try:
+        for forwarding, port in zip(new, ports):
+            forwarding.loc_port = port
+        with transaction.atomic():
+            Forwarding.objects.bulk_create(new)
+            Forwarding.objects.filter(
+                id__in=[fwd.id for fwd in existing.values()
+                        if fwd.id and not fwd.active]).update(active=True)
+    except Exception:
+        for port in ports:
+            port_allocator.release(port)
+        raise
+    forwardings = [existing[target] for target in targets]
+    with kernel_state(), iptables_batch():
+        for forwarding in forwardings:
+            forwarding.active = True
+            add_iptables(forwarding)
+    for forwarding in forwardings:
+        forwarding_cache.set(forwarding)
+    return forwardings
+
+
+def _invalidate_forwarding_cache():
+    """Invalidate cached forwardings once the firewall changes queued so
+    far are committed, so that they can't be cached again in between"""
+    with iptables_batch() as batch:
+        batch.on_commit(forwarding_cache.invalidate)
 
 
 class BaseModel(models.Model):
@@ -139,20 +380,64 @@ class BaseModel(models.Model):
 
 class Tunnel(BaseModel):
     server = models.GenericIPAddressField(protocol='IPv4',
-                                          validators=[check_ip],
-                                          unique=True)
+                                          validators=[check_ip])
     client = models.GenericIPAddressField(protocol='IPv4',
                                           validators=[check_ip])
     key = models.TextField(default=gen_key, blank=False, unique=True)
     protocol = models.CharField(max_length=3, default='udp',
                                 choices=[('udp', 'UDP'), ('tcp', 'TCP')])
+    # How the tunnel is served, see tunnels.TUNNEL_DRIVERS. WireGuard
+    # tunnels are always UDP and ignore `protocol`
+    driver = models.CharField(max_length=16, default='openvpn',
+                              choices=[('openvpn', 'OpenVPN'),
+                                       ('wireguard', 'WireGuard')])
+    # The index of the shared server serving the tunnel, if not served by
+    # its own OpenVPN server
+    instance = models.IntegerField(null=True, blank=True)
+    # The server address of tunnels served by their own server, kept unique,
+    # and NULL for those of a shared server, which share its address
+    dedicated_server = models.GenericIPAddressField(protocol='IPv4',
+                                                    null=True, unique=True,
+                                                    editable=False)
+    # The name of the tunnel's performance profile, blank for the default,
+    # and a JSON object of options overriding it
+    profile = models.CharField(max_length=32, blank=True, default='',
+                               validators=[check_profile])
+    tuning = models.TextField(blank=True, default='{}',
+                              validators=[check_tuning])
+    # The guaranteed and the maximum rate, in kbit/s, of traffic sent over
+    # the tunnel. If only one is set, it's used for both
+    rate = models.PositiveIntegerField(null=True, blank=True)
+    ceil = models.PositiveIntegerField(null=True, blank=True)
+    # Provisioned ahead of time and not claimed yet, see app.pool
+    pooled = models.BooleanField(default=False)
 
     @property
     def name(self):
         return '%s%s' % (settings.IFACE_PREFIX, self.id)
 
+    @property
+    def shared_server(self):
+        if self.instance is None:
+            return None
+        return SharedServer(self.instance)
+
+    @property
+    def iface(self):
+        """The network interface the tunnel's traffic is routed via"""
+        if self.instance is None:
+            return self.name
+        return self.shared_server.name
+
+    @property
+    def gateway(self):
+        """The client address, if other tunnels are reachable via `iface`"""
+        return None if self.instance is None else self.client
+
     @property
     def port(self):
+        if self.instance is not None:
+            return self.shared_server.port
         return (settings.SERVER_PORT_START + self.id - 1) if self.id else None
 
     @property
@@ -161,7 +446,7 @@ class Tunnel(BaseModel):
 
     @property
     def rp_filter(self):
-        return '/proc/sys/net/ipv4/conf/%s/rp_filter' % self.name
+        return '/proc/sys/net/ipv4/conf/%s/rp_filter' % self.iface
 
     @property
     def key_path(self):
@@ -169,8 +454,22 @@ class Tunnel(BaseModel):
 
     @property
     def conf_path(self):
+        if self.instance is not None:
+            return os.path.join(settings.PKI_DIR, 'ccd', self.name)
+        if self.driver == 'wireguard':
+            return '/etc/wireguard/%s.conf' % self.name
         return '/etc/openvpn/%s.conf' % self.name
 
+    @property
+    def performance(self):
+        """The options of the tunnel's profile, overridden by its tuning"""
+        if self.instance is not None:
+            # Options such as the MTU have to match the shared server's
+            return self.shared_server.performance
+        options = get_performance_profile(self.profile)
+        options.update(json.loads(self.tuning or '{}'))
+        return options
+
     @property
     def conf(self):
         return get_conf(self)
@@ -191,13 +490,25 @@ class Tunnel(BaseModel):
     def client_protocol(self):
         return 'tcp-client' if self.protocol == 'tcp' else 'udp'
 
+    def clean(self):
+        for field in ('rate', 'ceil'):
+            value = getattr(self, field)
+            if isinstance(value, (int, long)) and value <= 0:
+                raise ValidationError("%s must be positive." %
+                                      field.capitalize())
+        if self.rate and self.ceil and self.ceil < self.rate:
+            raise ValidationError("Ceil must not be lower than rate.")
+
     def _enable(self):
-        start_tunnel(self)
-        for forwarding in self.forwarding_set.all():
-            forwarding.reset()
+        with tunnel_lock(self), kernel_state(), iptables_batch():
+            start_tunnel(self)
+            for forwarding in self.forwarding_set.all():
+                forwarding.reset()
 
     def _disable(self):
-        stop_tunnel(self)
+        with tunnel_lock(self), kernel_state():
+            stop_tunnel(self)
+        _invalidate_forwarding_cache()
 
     def __str__(self):
         return '%s %s -> %s (port %s)' % (self.name, self.server,
@@ -210,16 +521,41 @@ class Tunnel(BaseModel):
             'server': self.server,
             'client': self.client,
             'protocol': self.protocol,
+            'driver': self.driver,
             'port': self.port,
+            'instance': self.instance,
+            'profile': self.profile,
+            'tuning': json.loads(self.tuning or '{}'),
+            'rate': self.rate,
+            'ceil': self.ceil,
             'key': self.key,
             'active': self.active,
         }
 
+    def _reserve_addresses(self):
+        if self.shared_server is None:
+            address_allocator.reserve(self.client, self.server)
+        else:
+            # The server's address is that of the shared server
+            shared_address_allocator.reserve(self.client)
+
+    def _release_addresses(self):
+        if self.shared_server is None:
+            address_allocator.release(self.client, self.server)
+        else:
+            shared_address_allocator.release(self.client)
+
+    def save(self, *args, **kwargs):
+        self.dedicated_server = self.server if self.instance is None else None
+        super(Tunnel, self).save(*args, **kwargs)
+        self._reserve_addresses()
+
     def delete(self, *args, **kwargs):
         """Disable and delete all forwardings before deleting tunnel"""
         for forwarding in Forwarding.objects.filter(tunnel=self):
             forwarding.delete()
         super(Tunnel, self).delete(*args, **kwargs)
+        self._release_addresses()
 
 
 class Forwarding(BaseModel):
@@ -236,13 +572,24 @@ class Forwarding(BaseModel):
     def destination(self):
         return '%s:%s' % (self.dst_addr, self.dst_port)
 
+    def save(self, *args, **kwargs):
+        forwarding_cache.discard(self)
+        super(Forwarding, self).save(*args, **kwargs)
+        port_allocator.reserve(self.loc_port)
+
+    def delete(self, *args, **kwargs):
+        forwarding_cache.discard(self)
+        super(Forwarding, self).delete(*args, **kwargs)
+        port_allocator.release(self.loc_port)
+
     def _enable(self):
-        add_iptables(self)
-        add_fwmark(self)
+        with kernel_state():
+            add_iptables(self)
 
     def _disable(self):
-        del_iptables(self)
-        del_fwmark(self)
+        with kernel_state():
+            del_iptables(self)
+        _invalidate_forwarding_cache()
 
     def __str__(self):
         return 'Local port %s via %s -> %s' % (self.port, self.tunnel.name,
@@ -258,3 +605,39 @@ class Forwarding(BaseModel):
             'tunnel_name': self.tunnel.name,
             'r_table': self.tunnel.rtable
         }
+
+
+class Job(models.Model):
+    """A background job, such as provisioning a Tunnel asynchronously"""
+
+    kind = models.CharField(max_length=32)
+    status = models.CharField(max_length=8, default='pending',
+                              choices=[('pending', 'Pending'),
+                                       ('running', 'Running'),
+                                       ('done', 'Done'),
+                                       ('failed', 'Failed')])
+    progress = models.CharField(max_length=64, blank=True, default='')
+    params = models.TextField(default='{}')
+    result = models.TextField(blank=True, default='')
+    error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return 'Job %s %s (%s)' % (self.id, self.kind, self.status)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'progress': self.progress,
+            'params': json.loads(self.params),
+            'result': json.loads(self.result) if self.result else None,
+            'error': self.error,
+            'created_at': self.created_at,
+            'updated_at': self.updated_at,
+        }
@@ -0,0 +1,239 @@
+"""Minimal rtnetlink client for IPv4 routing rules and routes
+
+Talks to the kernel over an AF_NETLINK socket, in order to avoid forking
+`ip` for every rule or route that is checked, added or removed.
+
+"""
+
+import os
+import socket
+import struct
+import itertools
+import contextlib
+
+
+NETLINK_ROUTE = 0
+
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+
+NLM_F_REQUEST = 0x1
+NLM_F_ACK = 0x4
+NLM_F_DUMP = 0x300
+NLM_F_EXCL = 0x200
+NLM_F_CREATE = 0x400
+
+RTM_NEWROUTE = 24
+RTM_DELROUTE = 25
+RTM_GETROUTE = 26
+RTM_NEWRULE = 32
+RTM_DELRULE = 33
+RTM_GETRULE = 34
+
+# Route attributes
+RTA_DST = 1
+RTA_OIF = 4
+RTA_GATEWAY = 5
+RTA_TABLE = 15
+
+# Rule attributes
+FRA_SRC = 2
+FRA_PRIORITY = 6
+FRA_FWMARK = 10
+FRA_TABLE = 15
+FRA_FWMASK = 16
+
+FR_ACT_TO_TBL = 1
+RTPROT_BOOT = 3
+RT_SCOPE_UNIVERSE = 0
+RT_SCOPE_LINK = 253
+RTN_UNICAST = 1
+
+NLMSGHDR = struct.Struct('IHHII')
+RTATTR = struct.Struct('HH')
+# struct rtmsg and struct fib_rule_hdr share the same layout
+RTMSG = struct.Struct('BBBBBBBBI')
+
+
+_seq = itertools.count(1)
+
+
+class NetlinkError(OSError):
+    pass
+
+
+def _align(length):
+    return (length + 3) & ~3
+
+
+def _attr(kind, data):
+    attr = RTATTR.pack(RTATTR.size + len(data), kind) + data
+    return attr + '\0' * (_align(len(attr)) - len(attr))
+
+
+def _u32(value):
+    return struct.pack('I', value)
+
+
+def _parse_attrs(data):
+    attrs = {}
+    while len(data) >= RTATTR.size:
+        length, kind = RTATTR.unpack_from(data)
+        if length < RTATTR.size:
+            break
+        attrs[kind] = data[RTATTR.size:length]
+        data = data[_align(length):]
+    return attrs
+
+
+def _messages(data):
+    while len(data) >= NLMSGHDR.size:
+        length, kind, flags, seq, pid = NLMSGHDR.unpack_from(data)
+        if length < NLMSGHDR.size:
+            break
+        yield kind, flags, data[NLMSGHDR.size:length]
+        data = data[_align(length):]
+
+
+@contextlib.contextmanager
+def _socket():
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+    try:
+        sock.bind((0, 0))
+        yield sock
+    finally:
+        sock.close()
+
+
+def request(kind, payload, flags=0):
+    """Send a netlink request and return the payloads of all replies
+
+    Raise NetlinkError if the kernel replies with an error."""
+    seq = next(_seq)
+    flags |= NLM_F_REQUEST | NLM_F_ACK
+    msg = NLMSGHDR.pack(NLMSGHDR.size + len(payload), kind, flags, seq, 0)
+    replies = []
+    with _socket() as sock:
+        sock.sendall(msg + payload)
+        while True:
+            data = sock.recv(65536)
+            for _kind, _flags, _payload in _messages(data):
+                if _kind == NLMSG_DONE:
+                    return replies
+                if _kind == NLMSG_ERROR:
+                    error = -struct.unpack_from('i', _payload)[0]
+                    if error:
+                        raise NetlinkError(error, os.strerror(error))
+                    return replies
+                replies.append(_payload)
+
+
+def _ifindex(iface):
+    with open('/sys/class/net/%s/ifindex' % iface) as fobj:
+        return int(fobj.read())
+
+
+def _ifnames():
+    names = {}
+    for iface in os.listdir('/sys/class/net'):
+        try:
+            names[_ifindex(iface)] = iface
+        except (IOError, ValueError):
+            pass
+    return names
+
+
+def _rule(table, src=None, fwmark=None):
+    src_len, attrs = 0, _attr(FRA_TABLE, _u32(table))
+    if src:
+        addr, _, prefix = src.partition('/')
+        src_len = int(prefix or 32)
+        attrs += _attr(FRA_SRC, socket.inet_aton(addr))
+    if fwmark is not None:
+        attrs += _attr(FRA_FWMARK, _u32(fwmark))
+    hdr = RTMSG.pack(socket.AF_INET, 0, src_len, 0,
+                     table if table < 256 else 0, 0, 0, FR_ACT_TO_TBL, 0)
+    return hdr + attrs
+
+
+def add_rule(table, src=None, fwmark=None):
+    """Add IPv4 rule pointing `src` and/or `fwmark` to numeric `table`"""
+    request(RTM_NEWRULE, _rule(table, src, fwmark),
+            NLM_F_CREATE | NLM_F_EXCL)
+
+
+def del_rule(table, src=None, fwmark=None):
+    request(RTM_DELRULE, _rule(table, src, fwmark))
+
+
+def list_rules():
+    """Return a list of dicts describing all IPv4 rules"""
+    rules = []
+    hdr = RTMSG.pack(socket.AF_INET, 0, 0, 0, 0, 0, 0, 0, 0)
+    for payload in request(RTM_GETRULE, hdr, NLM_F_DUMP):
+        (family, _, src_len, _, table,
+         _, _, action, _) = RTMSG.unpack_from(payload)
+        attrs = _parse_attrs(payload[RTMSG.size:])
+        rule = {'src': None, 'fwmark': None, 'fwmask': None,
+                'priority': 0, 'action': action,
+                'table': table}
+        if FRA_TABLE in attrs:
+            rule['table'] = struct.unpack('I', attrs[FRA_TABLE])[0]
+        if FRA_PRIORITY in attrs:
+            rule['priority'] = struct.unpack('I', attrs[FRA_PRIORITY])[0]
+        if FRA_SRC in attrs:
+            rule['src'] = socket.inet_ntoa(attrs[FRA_SRC])
+            if src_len != 32:
+                rule['src'] += '/%d' % src_len
+        if FRA_FWMARK in attrs:
+            rule['fwmark'] = struct.unpack('I', attrs[FRA_FWMARK])[0]
+        if FRA_FWMASK in attrs:
+            rule['fwmask'] = struct.unpack('I', attrs[FRA_FWMASK])[0]
+        rules.append(rule)
+    return rules
+
+
+def _route(iface, table, gateway=None):
+    hdr = RTMSG.pack(socket.AF_INET, 0, 0, 0,
+                     table if table < 256 else 0, RTPROT_BOOT,
+                     RT_SCOPE_LINK if gateway is None else RT_SCOPE_UNIVERSE,
+                     RTN_UNICAST, 0)
+    attrs = (_attr(RTA_TABLE, _u32(table)) +
+             _attr(RTA_OIF, _u32(_ifindex(iface))))
+    if gateway is not None:
+        attrs += _attr(RTA_GATEWAY, socket.inet_aton(gateway))
+    return hdr + attrs
+
+
+def add_route(iface, table, gateway=None):
+    """Add IPv4 default route via `iface`, and `gateway` if given, in
+    numeric `table`"""
+    request(RTM_NEWROUTE, _route(iface, table, gateway),
+            NLM_F_CREATE | NLM_F_EXCL)
+
+
+def del_route(iface, table, gateway=None):
+    request(RTM_DELROUTE, _route(iface, table, gateway))
+
+
+def list_routes():
+    """Return a list of dicts describing all IPv4 routes of all tables"""
+    routes, names = [], _ifnames()
+    hdr = RTMSG.pack(socket.AF_INET, 0, 0, 0, 0, 0, 0, 0, 0)
+    for payload in request(RTM_GETROUTE, hdr, NLM_F_DUMP):
+        (family, dst_len, _, _, table,
+         _, _, kind, _) = RTMSG.unpack_from(payload)
+        attrs = _parse_attrs(payload[RTMSG.size:])
+        route = {'dst': None, 'dst_len': dst_len, 'type': kind,
+                 'iface': None, 'gateway': None, 'table': table}
+        if RTA_TABLE in attrs:
+            route['table'] = struct.unpack('I', attrs[RTA_TABLE])[0]
+        if RTA_DST in attrs:
+            route['dst'] = socket.inet_ntoa(attrs[RTA_DST])
+        if RTA_GATEWAY in attrs:
+            route['gateway'] = socket.inet_ntoa(attrs[RTA_GATEWAY])
+        if RTA_OIF in attrs:
+            oif = struct.unpack('I', attrs[RTA_OIF])[0]
+            route['iface'] = names.get(oif, str(oif))
+        routes.append(route)
+    return routes
@@ -0,0 +1,120 @@
+"""Keep a pool of provisioned, unclaimed tunnels to hand out on creation
+
+Creating a tunnel generates its key, writes its config, starts its server
+and sets up its routing, which takes seconds. With settings.TUNNEL_POOL_SIZE
+set, that many tunnels with default options are provisioned ahead of time
+by a background thread per web server process. Requests for such a tunnel
+claim one from the pool, as long as its addresses don't overlap the
+requested CIDRs, and only fall back to creating one otherwise.
+
+"""
+
+import time
+import logging
+import threading
+
+from netaddr import IPAddress, IPNetwork
+
+from django.conf import settings
+from django.db import connection
+
+from . import models
+from .models import Tunnel
+from .tunnels import file_lock
+
+
+log = logging.getLogger(__name__)
+
+# Seconds between checks of the pool's size, besides every claim
+FILL_INTERVAL = 60
+
+_filler = None
+_filler_lock = threading.Lock()
+_wakeup = threading.Event()
+
+
+def _is_default(options):
+    """Check if `options` of create_tunnel are those of pooled tunnels"""
+    return ((options.get('protocol') or 'udp') == 'udp' and
+            (options.get('driver') or 'openvpn') == 'openvpn' and
+            not any(options.get(option)
+                    for option in ('profile', 'tuning', 'rate', 'ceil')))
+
+
+def claim_tunnel(cidrs, excluded_cidrs=[]):
+    """Claim a pooled tunnel whose addresses aren't in `cidrs` or
+    `excluded_cidrs`, return it or None if there's none"""
+    networks = [IPNetwork(cidr)
+                for cidr in list(cidrs) + list(excluded_cidrs) if cidr]
+    for tunnel in Tunnel.objects.filter(pooled=True,
+                                        active=True).order_by('id'):
+        if any(IPAddress(addr) in network
+               for addr in (tunnel.client, tunnel.server)
+               for network in networks):
+            continue
+        # Other threads and processes may be claiming the same tunnel
+        if Tunnel.objects.filter(id=tunnel.id,
+                                 pooled=True).update(pooled=False):
+            tunnel.pooled = False
+            log.info("Claimed pooled tunnel %s.", tunnel.name)
+            return tunnel
+    return None
+
+
+def create_tunnel(cidrs, excluded_cidrs=[], **options):
+    """Claim a pooled tunnel, if one fits, or create a new one
+
+    Takes the same arguments as models.create_tunnel. Only tunnels with
+    default options are served from the pool."""
+    if settings.TUNNEL_POOL_SIZE and _is_default(options):
+        wake_filler()
+        tunnel = claim_tunnel(cidrs, excluded_cidrs)
+        if tunnel is not None:
+            return tunnel
+        log.info("No pooled tunnel fits %s, creating one.", cidrs)
+    return models.create_tunnel(cidrs, excluded_cidrs, **options)
+
+
+def fill_pool():
+    """Provision tunnels until settings.TUNNEL_POOL_SIZE are pooled, return
+    the number of tunnels provisioned"""
+    created = 0
+    # Fillers of all processes take turns, counting the pool anew
+    with file_lock('tunnel_pool'):
+        missing = (settings.TUNNEL_POOL_SIZE -
+                   Tunnel.objects.filter(pooled=True).count())
+        for _ in range(max(missing, 0)):
+            tunnel = models.create_tunnel([], pooled=True)
+            log.info("Provisioned pooled tunnel %s.", tunnel.name)
+            created += 1
+    return created
+
+
+def _fill_forever():
+    while True:
+        _wakeup.wait(FILL_INTERVAL)
+        _wakeup.clear()
+        started_at = time.time()
+        try:
+            created = fill_pool()
+        except Exception as exc:
+            log.exception("Failed to fill tunnel pool: %r", exc)
+        else:
+            if created:
+                log.info("Provisioned %d pooled tunnels in %.3fs.", created,
+                         time.time() - started_at)
+        finally:
+            connection.close()
+
+
+def wake_filler():
+    """Have the filler thread of this process top up the pool, starting it
+    if not running yet"""
+    global _filler
+    with _filler_lock:
+        if _filler is None:
+            _filler = threading.Thread(target=_fill_forever,
+                                       name='tunnel-pool-filler')
+            _filler.daemon = True
+            _filler.start()
+    _wakeup.set()
@@ -0,0 +1,288 @@
+"""Reconcile the server configuration with the tunnels and forwardings in DB
+
+Instead of reapplying every resource of every object one at a time, the
+desired set of resources is built from the DB, the actual one is read once
+and only the difference between the two is applied, in batches.
+
+"""
+
+import os
+import re
+import time
+import glob
+import logging
+import subprocess
+
+from netaddr import IPNetwork
+
+from django.conf import settings
+
+from .models import Tunnel, Forwarding
+from .cache import forwarding_cache
+from .tunnels import get_conf, get_shared_conf, ensure_pki, SOURCE_CIDRS
+from .tunnels import get_iptables_rules, get_tunnel_iptables_rules
+from .tunnels import IPSET_SOURCES, IPSET_NETS, IPSET_PORTS
+from .tunnels import write_file, remove_file, check_rp_filter, check_tc
+from .tunnels import read_rtables, edit_rtables
+from .tunnels import list_openvpn_units, systemctl_openvpn, wait_for_ifaces
+from .tunnels import list_wireguard_links, del_link, get_driver
+from .tunnels import get_nftables_elements
+from .tunnels import kernel_state, IPTablesBatch, NFTablesBatch
+
+
+RESOURCES = ('files', 'units', 'links', 'rtables', 'ip_rules', 'ip_routes',
+             'iptables', 'ipsets', 'nftables')
+
+IFACE_REGEX = re.compile(r'^%s\d+$' % re.escape(settings.IFACE_PREFIX))
+RTABLE_REGEX = re.compile(r'^rt_%s\d+$' % re.escape(settings.IFACE_PREFIX))
+SHARED_IFACE_REGEX = re.compile(r'^%s\d+$' %
+                                re.escape(settings.SHARED_IFACE_PREFIX))
+
+
+log = logging.getLogger(__name__)
+
+
+def is_managed_iptables(rule):
+    """Check if (table, chain, spec) rule looks like a tunnel or forwarding
+    rule, or a tunnel's chain"""
+    table, chain, spec = rule
+    if table == 'nat' and IFACE_REGEX.match(chain):
+        return True
+    opts = dict(zip(spec, spec[1:]))
+    if opts.get('-s') not in SOURCE_CIDRS and IPSET_SOURCES not in spec:
+        return False
+    if chain == 'PREROUTING':
+        # Rules of forwardings used to be in PREROUTING
+        return (opts.get('-i') == settings.IN_IFACE and
+                ((table, opts.get('-j')) in (('mangle', 'MARK'),
+                                             ('nat', 'DNAT')) or
+                 bool(IFACE_REGEX.match(opts.get('-j', '')))))
+    if chain == 'POSTROUTING':
+        return (table == 'nat' and opts.get('-j') == 'MASQUERADE' and
+                bool(IFACE_REGEX.match(opts.get('-o', '')) or
+                     SHARED_IFACE_REGEX.match(opts.get('-o', ''))))
+    return False
+
+
+def get_desired_state():
+    """Return a dict of sets of all resources required by the DB"""
+    desired = dict((kind, set()) for kind in RESOURCES)
+    for tunnel in Tunnel.objects.filter(active=True):
+        server = tunnel.shared_server
+        if tunnel.driver == 'wireguard':
+            desired['links'].add(tunnel.name)
+            desired['ip_rules'].add((tunnel.server, None, tunnel.rtable))
+        elif server is None:
+            desired['files'].add((tunnel.key_path, tunnel.key))
+            desired['units'].add(tunnel.name)
+            desired['ip_rules'].add((tunnel.server, None, tunnel.rtable))
+        else:
+            desired['files'].add((server.conf_path, get_shared_conf(server)))
+            desired['units'].add(server.name)
+        desired['files'].add((tunnel.conf_path, get_conf(tunnel)))
+        desired['rtables'].add((tunnel.id, tunnel.rtable))
+        desired['ip_rules'].add(('all', hex(tunnel.id), tunnel.rtable))
+        desired['ip_routes'].add((tunnel.iface, tunnel.rtable,
+                                  tunnel.gateway))
+    forwardings = Forwarding.objects.filter(active=True, tunnel__active=True)
+    for forwarding in forwardings.select_related('tunnel'):
+        tunnel = forwarding.tunnel
+        # Resources of the backend not in use are removed, if any are left
+        # behind after switching backends
+        if settings.FIREWALL_BACKEND == 'nftables':
+            desired['nftables'].update(get_nftables_elements(forwarding))
+        else:
+            for rules in get_iptables_rules(forwarding).values():
+                desired['iptables'].update(rules)
+            for rules in get_tunnel_iptables_rules(tunnel).values():
+                desired['iptables'].update(rules)
+            desired['ipsets'].add((IPSET_SOURCES, None))
+            desired['ipsets'].update((IPSET_SOURCES, cidr)
+                                     for cidr in SOURCE_CIDRS)
+            desired['ipsets'].add((tunnel.name, None))
+            desired['ipsets'].add((tunnel.name, str(forwarding.loc_port)))
+    return desired
+
+
+def get_actual_state(state):
+    """Return a dict of sets of all managed resources currently in place"""
+    actual = dict((kind, set()) for kind in RESOURCES)
+    paths = []
+    for path in glob.glob('/etc/openvpn/%s*' % settings.IFACE_PREFIX):
+        iface, ext = os.path.splitext(os.path.basename(path))
+        if IFACE_REGEX.match(iface) and ext in ('.conf', '.key'):
+            paths.append(path)
+    for path in glob.glob('/etc/openvpn/%s*' % settings.SHARED_IFACE_PREFIX):
+        iface, ext = os.path.splitext(os.path.basename(path))
+        if SHARED_IFACE_REGEX.match(iface) and ext == '.conf':
+            paths.append(path)
+    for path in glob.glob('/etc/wireguard/%s*.conf' % settings.IFACE_PREFIX):
+        if IFACE_REGEX.match(os.path.splitext(os.path.basename(path))[0]):
+            paths.append(path)
+    for path in glob.glob(os.path.join(settings.PKI_DIR, 'ccd', '*')):
+        if IFACE_REGEX.match(os.path.basename(path)):
+            paths.append(path)
+    for path in paths:
+        with open(path) as fobj:
+            actual['files'].add((path, fobj.read()))
+    actual['units'] = set(iface for iface in list_openvpn_units()
+                          if IFACE_REGEX.match(iface) or
+                          SHARED_IFACE_REGEX.match(iface))
+    actual['links'] = set(iface for iface in list_wireguard_links()
+                          if IFACE_REGEX.match(iface))
+    actual['rtables'] = set((index, rtable)
+                            for rtable, index in read_rtables().items()
+                            if RTABLE_REGEX.match(rtable))
+    actual['ip_rules'] = set(rule for rule in state.ip_rules
+                             if RTABLE_REGEX.match(rule[2]))
+    actual['ip_routes'] = set(route for route in state.ip_routes
+                              if RTABLE_REGEX.match(route[1]))
+    try:
+        actual['iptables'] = set(rule for rule in state.iptables
+                                 if is_managed_iptables(rule))
+        for name, members in state.ipsets.items():
+            if IFACE_REGEX.match(name):
+                actual['ipsets'].add((name, None))
+                actual['ipsets'].update((name, member) for member in members)
+            elif name == IPSET_SOURCES:
+                # `ipset save` omits the prefix length of /32 networks
+                actual['ipsets'].add((name, None))
+                actual['ipsets'].update((name, str(IPNetwork(member).cidr))
+                                        for member in members)
+    except OSError:
+        if settings.FIREWALL_BACKEND == 'iptables':
+            raise
+        log.debug("iptables not installed, skipping.")
+    actual['nftables'] = set(state.nftables)
+    return actual
+
+
+def get_plan(desired, actual):
+    """Return a dict of (missing, extra) sets of resources per kind"""
+    plan = {}
+    for kind in RESOURCES:
+        plan[kind] = (desired[kind] - actual[kind],
+                      actual[kind] - desired[kind])
+    # Files are changed in place, so only remove those no longer needed
+    paths = set(path for path, data in desired['files'])
+    plan['files'] = (plan['files'][0],
+                     set(path for path, data in plan['files'][1]
+                         if path not in paths))
+    # Units whose configuration is about to change need to be restarted,
+    # which along with starting and stopping them flushes their routes
+    changed = set(os.path.splitext(os.path.basename(path))[0]
+                  for path, data in plan['files'][0])
+    plan['restart'] = changed & desired['units'] & actual['units']
+    # WireGuard links are reconfigured in place, keeping their routes
+    plan['reconfigure'] = changed & desired['links'] & actual['links']
+    reloaded = (plan['restart'] | plan['units'][0] | plan['units'][1] |
+                plan['links'][0] | plan['links'][1])
+    routes = set(route for route in actual['ip_routes']
+                 if route[0] not in reloaded)
+    plan['ip_routes'] = (desired['ip_routes'] - routes,
+                         routes - desired['ip_routes'])
+    return plan
+
+
+def _apply(func, *args):
+    try:
+        func(*args)
+    except (subprocess.CalledProcessError, OSError, IOError) as exc:
+        log.error("Failed to apply %s%s: %r", func.__name__, args, exc)
+        return 1
+    return 0
+
+
+def apply_plan(plan, state):
+    """Apply the changes of `plan` in batches, return the number of errors"""
+    errors = 0
+    edit_rtables(add=plan['rtables'][0])
+    if (any(SHARED_IFACE_REGEX.match(iface) for iface in plan['units'][0]) or
+            any(path.startswith(settings.PKI_DIR)
+                for path, data in plan['files'][0])):
+        ensure_pki()
+    for path, data in plan['files'][0]:
+        write_file(path, data, 'file')
+    for path in plan['files'][1]:
+        remove_file(path, 'file')
+    started = plan['units'][0] | plan['restart']
+    errors += _apply(systemctl_openvpn, 'stop', plan['units'][1])
+    errors += _apply(systemctl_openvpn, 'start', plan['units'][0])
+    errors += _apply(systemctl_openvpn, 'restart', plan['restart'])
+    wait_for_ifaces(started)
+    for iface in plan['links'][1]:
+        errors += _apply(del_link, iface)
+    configured = plan['links'][0] | plan['reconfigure']
+    for tunnel in Tunnel.objects.filter(active=True, driver='wireguard'):
+        if tunnel.name in configured:
+            errors += _apply(get_driver(tunnel).start, tunnel)
+    for rule in plan['ip_rules'][1]:
+        errors += _apply(state.executor.del_rule, rule)
+    for rule in plan['ip_rules'][0]:
+        errors += _apply(state.executor.add_rule, rule)
+    for route in plan['ip_routes'][1]:
+        errors += _apply(state.executor.del_route, route)
+    for route in plan['ip_routes'][0]:
+        errors += _apply(state.executor.add_route, route)
+    batch = IPTablesBatch()
+    for name, member in plan['ipsets'][0]:
+        if member is None:
+            batch.create_ipset(name, IPSET_NETS if name == IPSET_SOURCES
+                               else IPSET_PORTS)
+    for name, member in plan['ipsets'][0]:
+        if member is not None:
+            batch.add_ipset(name, member)
+    for name, member in plan['ipsets'][1]:
+        if member is not None:
+            batch.del_ipset(name, member)
+    for name, member in plan['ipsets'][1]:
+        if member is None:
+            batch.destroy_ipset(name)
+    for rule in plan['iptables'][1]:
+        batch.delete(rule)
+    for rule in plan['iptables'][0]:
+        batch.append(rule)
+    errors += _apply(batch.commit)
+    batch = NFTablesBatch(elements=state.nftables)
+    for element in plan['nftables'][1]:
+        batch.delete(element)
+    for element in plan['nftables'][0]:
+        batch.append(element)
+    errors += _apply(batch.commit)
+    for tunnel in Tunnel.objects.filter(active=True):
+        errors += _apply(check_rp_filter, tunnel.rp_filter, tunnel.iface)
+        errors += _apply(check_tc, tunnel)
+    edit_rtables(remove=plan['rtables'][1])
+    return errors
+
+
+def reconcile(dry_run=False):
+    """Bring the server configuration in line with the DB
+
+    Return a report dict with the number of missing and extra resources
+    per kind, the number of errors and the time each phase took.
+
+    """
+    timings = {}
+    with kernel_state() as state:
+        started_at = time.time()
+        actual = get_actual_state(state)
+        timings['read'] = time.time() - started_at
+
+        started_at = time.time()
+        plan = get_plan(get_desired_state(), actual)
+        timings['plan'] = time.time() - started_at
+
+        started_at = time.time()
+        errors = 0 if dry_run else apply_plan(plan, state)
+        timings['apply'] = time.time() - started_at
+
+    if not dry_run:
+        forwarding_cache.invalidate()
+
+    drift = dict((kind, {'missing': len(plan[kind][0]),
+                         'extra': len(plan[kind][1])})
+                 for kind in RESOURCES)
+    log.info("Reconciled in %.3fs with %d errors, drift: %s",
+             sum(timings.values()), errors, drift)
+    return {'drift': drift, 'errors': errors, 'timings': timings}
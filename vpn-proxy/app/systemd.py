@@ -0,0 +1,327 @@
+"""Minimal D-Bus client for the systemd manager
+
+Talks to org.freedesktop.systemd1 over the system bus socket, in order to
+list units and to run jobs for many units at once, without forking
+`systemctl` for every unit and blocking on each job in turn.
+
+"""
+
+import os
+import time
+import socket
+import struct
+import binascii
+import itertools
+import contextlib
+
+
+BUS_ADDRESS = 'unix:path=/var/run/dbus/system_bus_socket'
+
+DBUS = 'org.freedesktop.DBus'
+DBUS_PATH = '/org/freedesktop/DBus'
+SYSTEMD = 'org.freedesktop.systemd1'
+SYSTEMD_PATH = '/org/freedesktop/systemd1'
+MANAGER = 'org.freedesktop.systemd1.Manager'
+
+# Message types
+METHOD_CALL = 1
+METHOD_RETURN = 2
+ERROR = 3
+SIGNAL = 4
+
+# Header fields
+PATH = 1
+INTERFACE = 2
+MEMBER = 3
+ERROR_NAME = 4
+REPLY_SERIAL = 5
+DESTINATION = 6
+SIGNATURE = 8
+
+# Endianness, type, flags, protocol version, body length and serial,
+# followed by the header fields, an a(yv) array
+HEADER = struct.Struct('<cBBBII')
+
+_ALIGNMENT = {'y': 1, 'b': 4, 'n': 2, 'q': 2, 'i': 4, 'u': 4, 'x': 8,
+              't': 8, 'd': 8, 's': 4, 'o': 4, 'g': 1, 'v': 1, 'a': 4,
+              '(': 8, '{': 8}
+_FIXED = {'y': 'B', 'b': 'I', 'n': 'h', 'q': 'H', 'i': 'i', 'u': 'I',
+          'x': 'q', 't': 'Q', 'd': 'd'}
+
+JOB_METHODS = {
+    'start': 'StartUnit',
+    'stop': 'StopUnit',
+    'restart': 'RestartUnit',
+}
+
+
+class SystemdError(OSError):
+    pass
+
+
+def _type_end(signature, start):
+    code = signature[start]
+    if code == 'a':
+        return _type_end(signature, start + 1)
+    if code in '({':
+        end = start + 1
+        while signature[end] not in ')}':
+            end = _type_end(signature, end)
+        return end + 1
+    return start + 1
+
+
+def _split(signature):
+    """Split `signature` into a list of single complete types"""
+    types = []
+    while signature:
+        end = _type_end(signature, 0)
+        types.append(signature[:end])
+        signature = signature[end:]
+    return types
+
+
+def _marshal(buf, sig, value):
+    """Append `value` of single complete type `sig` to bytearray `buf`"""
+    code = sig[0]
+    buf.extend('\0' * (-len(buf) % _ALIGNMENT[code]))
+    if code in _FIXED:
+        buf.extend(struct.pack('<' + _FIXED[code], value))
+    elif code in 'so':
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        buf.extend(struct.pack('<I', len(value)) + value + '\0')
+    elif code == 'g':
+        buf.extend(struct.pack('<B', len(value)) + value + '\0')
+    elif code == 'v':
+        _marshal(buf, 'g', value[0])
+        _marshal(buf, value[0], value[1])
+    elif code == 'a':
+        buf.extend('\0' * 4)
+        offset = len(buf)
+        buf.extend('\0' * (-len(buf) % _ALIGNMENT[sig[1]]))
+        start = len(buf)
+        for item in value:
+            _marshal(buf, sig[1:], item)
+        struct.pack_into('<I', buf, offset - 4, len(buf) - start)
+    else:
+        for subsig, item in zip(_split(sig[1:-1]), value):
+            _marshal(buf, subsig, item)
+
+
+def _unmarshal(data, offset, sig):
+    """Return the value of single complete type `sig` at `offset` of
+    `data`, and the offset following it"""
+    code = sig[0]
+    offset += -offset % _ALIGNMENT[code]
+    if code in _FIXED:
+        fmt = '<' + _FIXED[code]
+        return (struct.unpack_from(fmt, data, offset)[0],
+                offset + struct.calcsize(fmt))
+    if code in 'so':
+        length = struct.unpack_from('<I', data, offset)[0]
+        offset += 4
+        return data[offset:offset + length], offset + length + 1
+    if code == 'g':
+        length = struct.unpack_from('<B', data, offset)[0]
+        offset += 1
+        return data[offset:offset + length], offset + length + 1
+    if code == 'v':
+        vsig, offset = _unmarshal(data, offset, 'g')
+        return _unmarshal(data, offset, vsig)
+    if code == 'a':
+        length, offset = _unmarshal(data, offset, 'u')
+        offset += -offset % _ALIGNMENT[sig[1]]
+        end, items = offset + length, []
+        while offset < end:
+            item, offset = _unmarshal(data, offset, sig[1:])
+            items.append(item)
+        return items, end
+    items = []
+    for subsig in _split(sig[1:-1]):
+        item, offset = _unmarshal(data, offset, subsig)
+        items.append(item)
+    return tuple(items), offset
+
+
+def _message(kind, serial, fields, signature='', args=()):
+    body = bytearray()
+    for sig, arg in zip(_split(signature), args):
+        _marshal(body, sig, arg)
+    if signature:
+        fields = fields + [(SIGNATURE, ('g', signature))]
+    msg = bytearray(HEADER.pack('l', kind, 0, 1, len(body), serial))
+    _marshal(msg, 'a(yv)', fields)
+    msg.extend('\0' * (-len(msg) % 8))
+    return str(msg + body)
+
+
+def _parse(data):
+    """Return the type, header fields and body of a complete message"""
+    endian, kind, _, _, _, _ = HEADER.unpack_from(data)
+    if endian != 'l':
+        raise SystemdError("Big-endian D-Bus messages are not supported.")
+    fields, offset = _unmarshal(data, HEADER.size, 'a(yv)')
+    fields = dict(fields)
+    offset += -offset % 8
+    body = []
+    for sig in _split(fields.get(SIGNATURE, '')):
+        value, offset = _unmarshal(data, offset, sig)
+        body.append(value)
+    return kind, fields, body
+
+
+class Connection(object):
+    """A connection to the system bus
+
+    Method calls may be sent without waiting for their replies, which are
+    kept by serial, along with any signals, until asked for."""
+
+    def __init__(self, address=None, timeout=None):
+        address = address or os.environ.get('DBUS_SYSTEM_BUS_ADDRESS',
+                                            BUS_ADDRESS)
+        if not address.startswith('unix:path='):
+            raise SystemdError("Unsupported D-Bus address %s." % address)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(address[len('unix:path='):])
+        self._serial = itertools.count(1)
+        self._buffer = ''
+        self.replies = {}
+        self.signals = []
+        self._auth()
+        self.call(DBUS, DBUS_PATH, DBUS, 'Hello')
+
+    def _recv(self):
+        data = self.sock.recv(65536)
+        if not data:
+            raise SystemdError("D-Bus connection closed.")
+        self._buffer += data
+
+    def _auth(self):
+        uid = binascii.hexlify(str(os.getuid()))
+        self.sock.sendall('\0AUTH EXTERNAL %s\r\n' % uid)
+        while '\r\n' not in self._buffer:
+            self._recv()
+        line, self._buffer = self._buffer.split('\r\n', 1)
+        if not line.startswith('OK '):
+            raise SystemdError("D-Bus authentication failed: %s" % line)
+        self.sock.sendall('BEGIN\r\n')
+
+    def close(self):
+        self.sock.close()
+
+    def send(self, destination, path, interface, member, signature='',
+             args=()):
+        """Send a method call and return its serial"""
+        serial = next(self._serial)
+        fields = [(PATH, ('o', path)), (INTERFACE, ('s', interface)),
+                  (MEMBER, ('s', member)), (DESTINATION, ('s', destination))]
+        self.sock.sendall(_message(METHOD_CALL, serial, fields, signature,
+                                   args))
+        return serial
+
+    def receive(self):
+        """Read the next message, keeping it as a reply or a signal"""
+        while True:
+            if len(self._buffer) >= HEADER.size + 4:
+                body_length = struct.unpack_from('<I', self._buffer, 4)[0]
+                fields_length = struct.unpack_from('<I', self._buffer,
+                                                   HEADER.size)[0]
+                length = HEADER.size + 4 + fields_length
+                length += -length % 8 + body_length
+                if len(self._buffer) >= length:
+                    data = self._buffer[:length]
+                    self._buffer = self._buffer[length:]
+                    break
+            self._recv()
+        kind, fields, body = _parse(data)
+        if kind in (METHOD_RETURN, ERROR):
+            self.replies[fields[REPLY_SERIAL]] = (kind, fields, body)
+        elif kind == SIGNAL:
+            self.signals.append((fields.get(MEMBER), body))
+
+    def reply(self, serial):
+        """Wait for and return the body of the reply to `serial`
+
+        Raise SystemdError if the reply is an error."""
+        while serial not in self.replies:
+            self.receive()
+        kind, fields, body = self.replies.pop(serial)
+        if kind == ERROR:
+            raise SystemdError("%s: %s" % (fields.get(ERROR_NAME),
+                                           body[0] if body else ''))
+        return body
+
+    def call(self, *args, **kwargs):
+        return self.reply(self.send(*args, **kwargs))
+
+
+@contextlib.contextmanager
+def _connection(timeout=30):
+    conn = Connection(timeout=timeout)
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+def list_units():
+    """Return a dict of the active state of all loaded units by name"""
+    with _connection() as conn:
+        units = conn.call(SYSTEMD, SYSTEMD_PATH, MANAGER, 'ListUnits')[0]
+    return dict((unit[0], unit[3]) for unit in units)
+
+
+def reload():
+    """Reload systemd's unit files, the way `systemctl daemon-reload` does"""
+    with _connection() as conn:
+        conn.call(SYSTEMD, SYSTEMD_PATH, MANAGER, 'Reload')
+
+
+def run_jobs(job, units, timeout=90):
+    """Run `job`, one of JOB_METHODS, for all `units` and wait for them
+
+    All jobs are queued at once and their completions, JobRemoved signals,
+    are collected as they come. Raise SystemdError naming the units whose
+    job failed or didn't complete within `timeout` seconds."""
+    if not units:
+        return
+    failed = {}
+    deadline = time.time() + timeout
+    with _connection(timeout) as conn:
+        conn.call(DBUS, DBUS_PATH, DBUS, 'AddMatch', 's', [
+            "type='signal',sender='%s',interface='%s',member='JobRemoved'" %
+            (SYSTEMD, MANAGER)])
+        conn.call(SYSTEMD, SYSTEMD_PATH, MANAGER, 'Subscribe')
+        serials = dict((conn.send(SYSTEMD, SYSTEMD_PATH, MANAGER,
+                                  JOB_METHODS[job], 'ss', [unit, 'replace']),
+                        unit) for unit in units)
+        jobs = {}
+        for serial, unit in serials.items():
+            try:
+                jobs[conn.reply(serial)[0]] = unit
+            except SystemdError as exc:
+                failed[unit] = str(exc)
+        results = {}
+        while True:
+            for member, body in conn.signals:
+                if member == 'JobRemoved':
+                    # The job's id, path, unit and result
+                    results[body[1]] = body[3]
+            del conn.signals[:]
+            if not set(jobs) - set(results):
+                break
+            if time.time() > deadline:
+                break
+            try:
+                conn.receive()
+            except socket.timeout:
+                break
+    for path, unit in jobs.items():
+        result = results.get(path, 'timeout')
+        if result != 'done':
+            failed[unit] = result
+    if failed:
+        raise SystemdError("Failed to %s %s." % (job, ', '.join(
+            '%s (%s)' % (unit, failed[unit]) for unit in sorted(failed))))
@@ -1,3 +1,1951 @@
-from django.test import TestCase
+import os
+import re
+import json
+import sys
+import time
+import errno
+import socket
+import struct
+import tempfile
+import shutil
+import threading
+import glob
+import contextlib
+import subprocess
+from StringIO import StringIO
+from multiprocessing.pool import ThreadPool
 
-# Create your tests here.
+from netaddr import IPAddress, IPNetwork
+
+from django.conf import settings
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.test import override_settings
+from django.core.management import call_command
+from django.db import connections
+from django.core.exceptions import ValidationError
+
+from app import health, icmp, jobs, models, netlink, pool, reconcile
+from app import systemd, tunnels, views
+from app.allocators import AddressAllocator, IntervalSet, PortAllocator
+from app.cache import forwarding_cache
+from app.management.commands import reset_tunnels
+from app.models import Forwarding, create_tunnel, pick_port
+from app.tunnels import iptables_batch, kernel_state, run
+
+
+IP_RULES = 'ip rule list'
+IP_ROUTES = 'ip -4 route list table all'
+IPTABLES_SAVE = 'iptables-save'
+IPSET_SAVE = 'ipset save'
+LISTINGS = (IP_RULES, IP_ROUTES, IPTABLES_SAVE, IPSET_SAVE)
+NFT_LIST = 'nft -nn list table ip vpn-proxy'
+
+
+class KernelStubMixin(object):
+    """Keep tests from configuring the host, by stubbing out everything
+    that would start servers or run commands"""
+
+    def patch(self, obj, name, value):
+        original = getattr(obj, name)
+        setattr(obj, name, value)
+        self.addCleanup(setattr, obj, name, original)
+
+    def setUp(self):
+        super(KernelStubMixin, self).setUp()
+        lock_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, lock_dir)
+        lock_settings = override_settings(LOCK_DIR=lock_dir)
+        lock_settings.enable()
+        self.addCleanup(lock_settings.disable)
+        self.patch(models, 'start_tunnel', lambda tunnel: None)
+        self.patch(models, 'stop_tunnel', lambda tunnel: None)
+        self.patch(models, 'gen_client_cert', lambda name: 'cert-' + name)
+        # Output of the commands run, by command line
+        self.commands, self.inputs, self.outputs = [], [], {}
+        self.patch(tunnels, 'run', self.fake_run)
+        models.address_allocator.reset()
+        models.port_allocator.reset()
+        # Requests must come from one of the source CIDRs
+        self.remote_addr = str(IPNetwork(settings.SOURCE_CIDRS[0])[1])
+
+    def fake_run(self, cmd, *args, **kwargs):
+        self.commands.append(cmd)
+        self.inputs.append(kwargs.get('data'))
+        return self.outputs.get(' '.join(cmd), '')
+
+    def listings(self):
+        """Return the commands run that list rather than change state"""
+        return [' '.join(cmd) for cmd in self.commands
+                if ' '.join(cmd) in LISTINGS]
+
+
+@override_settings(SHARED_SERVERS=1, SHARED_SERVER_CIDR='172.31.0.0/29')
+class SharedAddressTest(KernelStubMixin, TestCase):
+
+    def setUp(self):
+        super(SharedAddressTest, self).setUp()
+        self.patch(models, 'shared_address_allocator', AddressAllocator(
+            ['172.31.0.0/29'], [], models._used_addresses,
+            models._address_in_use))
+
+    def test_reallocate_after_delete(self):
+        tunnels = []
+        while True:
+            try:
+                tunnels.append(create_tunnel(['192.168.0.0/24']))
+            except ValidationError:
+                break
+        self.assertTrue(tunnels)
+        self.assertTrue(all(tunnel.instance == 0 for tunnel in tunnels))
+        self.assertEqual(len(set(tunnel.client for tunnel in tunnels)),
+                         len(tunnels))
+        tunnels[0].delete()
+        tunnel = create_tunnel(['192.168.0.0/24'])
+        self.assertEqual(tunnel.client, tunnels[0].client)
+
+    def test_release_on_failed_creation(self):
+        with self.assertRaises(ValidationError):
+            create_tunnel(['192.168.0.0/24'], rate=200, ceil=100)
+        self.assertEqual(len(models.shared_address_allocator.used), 0)
+
+    def test_unique_dedicated_server(self):
+        shared = [create_tunnel(['192.168.0.0/24']) for i in range(2)]
+        self.assertEqual(shared[0].server, shared[1].server)
+        self.assertEqual([tunnel.dedicated_server for tunnel in shared],
+                         [None, None])
+        dedicated = [create_tunnel(['192.168.0.0/24'], protocol='tcp')
+                     for i in range(2)]
+        self.assertEqual(dedicated[0].dedicated_server, dedicated[0].server)
+        dedicated[1].server = dedicated[0].server
+        self.assertRaises(ValidationError, dedicated[1].save)
+
+
+@override_settings(ROUTING_BACKEND='iproute2')
+class KernelStateTest(KernelStubMixin, TestCase):
+
+    def setUp(self):
+        super(KernelStateTest, self).setUp()
+        self.outputs[IP_RULES] = '\n'.join([
+            '0:\tfrom all lookup local',
+            '1000:\tfrom 10.0.0.2 lookup rt_vpn-tun1',
+            '1001:\tfrom all fwmark 0x1 lookup rt_vpn-tun1',
+            '32766:\tfrom all lookup main',
+        ])
+        self.outputs[IP_ROUTES] = '\n'.join([
+            'default via 192.168.1.1 dev eth0',
+            'default dev vpn-tun1 table rt_vpn-tun1 scope link',
+            '10.0.0.1 dev vpn-tun1 proto kernel scope link src 10.0.0.2',
+        ])
+
+    def test_parse(self):
+        state = tunnels.KernelState()
+        self.assertEqual(state.ip_rules, set([
+            ('all', None, 'local'), ('all', None, 'main'),
+            ('10.0.0.2', None, 'rt_vpn-tun1'),
+            ('all', '0x1', 'rt_vpn-tun1'),
+        ]))
+        self.assertEqual(state.ip_routes, set([
+            ('eth0', 'main', '192.168.1.1'),
+            ('vpn-tun1', 'rt_vpn-tun1', None),
+        ]))
+
+    def test_listed_once(self):
+        with kernel_state():
+            for i in range(3):
+                self.assertTrue(tunnels.check_ip_rule('10.0.0.2',
+                                                      'rt_vpn-tun1'))
+                self.assertTrue(tunnels.check_ip_route('vpn-tun1',
+                                                       'rt_vpn-tun1'))
+                self.assertFalse(tunnels.add_ip_rule('10.0.0.2',
+                                                     'rt_vpn-tun1'))
+        self.assertEqual(sorted(self.listings()), [IP_ROUTES, IP_RULES])
+        self.assertEqual(len(self.commands), 2)
+
+    def test_updated_after_changes(self):
+        with kernel_state():
+            self.assertTrue(tunnels.add_ip_rule('10.0.0.4', 'rt_vpn-tun2'))
+            self.assertTrue(tunnels.check_ip_rule('10.0.0.4',
+                                                  'rt_vpn-tun2'))
+            self.assertFalse(tunnels.add_ip_rule('10.0.0.4', 'rt_vpn-tun2'))
+            self.assertTrue(tunnels.del_ip_route('vpn-tun1', 'rt_vpn-tun1'))
+            self.assertFalse(tunnels.check_ip_route('vpn-tun1',
+                                                    'rt_vpn-tun1'))
+            self.assertFalse(tunnels.del_ip_route('vpn-tun1',
+                                                  'rt_vpn-tun1'))
+        self.assertEqual([' '.join(cmd) for cmd in self.commands], [
+            IP_RULES,
+            'ip rule add from 10.0.0.4 table rt_vpn-tun2',
+            IP_ROUTES,
+            'ip route del default dev vpn-tun1 table rt_vpn-tun1',
+        ])
+
+    def test_forget_iface(self):
+        with kernel_state() as state:
+            self.assertTrue(tunnels.check_ip_route('vpn-tun1',
+                                                   'rt_vpn-tun1'))
+            state.forget_iface('vpn-tun1')
+            self.assertTrue(tunnels.add_ip_route('vpn-tun1', 'rt_vpn-tun1'))
+        self.assertEqual(self.listings(), [IP_ROUTES])
+
+    def test_nested_and_fresh(self):
+        with kernel_state() as state:
+            with kernel_state() as nested:
+                self.assertIs(nested, state)
+            self.assertIs(tunnels.get_kernel_state(), state)
+        # Without a snapshot, every check lists the rules anew
+        for i in range(2):
+            tunnels.check_ip_rule('10.0.0.2', 'rt_vpn-tun1')
+        self.assertEqual(self.listings(), [IP_RULES, IP_RULES])
+
+
+class TunnelViewTest(KernelStubMixin, TestCase):
+
+    def create(self, **data):
+        data.setdefault('cidrs', '192.168.0.0/24')
+        return self.client.post('/', data, REMOTE_ADDR=self.remote_addr)
+
+    def test_rate_and_ceil(self):
+        response = self.create(rate='100', ceil='200')
+        self.assertEqual(response.status_code, 200)
+        tunnel = json.loads(response.content)
+        self.assertEqual((tunnel['rate'], tunnel['ceil']), (100, 200))
+
+    def test_invalid_rate_and_ceil(self):
+        for data in ({'rate': '200', 'ceil': '100'}, {'rate': 'fast'},
+                     {'ceil': '-1'}):
+            response = self.create(**data)
+            self.assertEqual(response.status_code, 400, data)
+        self.assertFalse(models.Tunnel.objects.exists())
+
+
+class JobTest(KernelStubMixin, TestCase):
+
+    def setUp(self):
+        super(JobTest, self).setUp()
+        # Jobs queued, to be run by the test instead of a worker thread
+        self.queued = []
+        self.patch(jobs, 'get_pool', lambda: self)
+
+    def apply_async(self, func, args):
+        self.queued.append((func, args))
+
+    def run_queued(self):
+        while self.queued:
+            func, args = self.queued.pop(0)
+            func(*args)
+
+    def create(self, **data):
+        data.setdefault('cidrs', '192.168.0.0/24')
+        data['async'] = '1'
+        return self.client.post('/', data, REMOTE_ADDR=self.remote_addr)
+
+    def get(self, url):
+        response = self.client.get(url, REMOTE_ADDR=self.remote_addr)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
+
+    def test_create_tunnel(self):
+        response = self.create(rate='100')
+        self.assertEqual(response.status_code, 202)
+        job = json.loads(response.content)
+        self.assertEqual(response['Location'], '/jobs/%s/' % job['id'])
+        self.assertEqual((job['status'], job['result']), ('pending', None))
+        self.assertFalse(models.Tunnel.objects.exists())
+        self.run_queued()
+        job = self.get(response['Location'])
+        self.assertEqual((job['status'], job['error']), ('done', ''))
+        tunnel = models.Tunnel.objects.get()
+        self.assertEqual(job['result']['id'], tunnel.id)
+        self.assertEqual(job['result']['rate'], 100)
+
+    def test_failed_job(self):
+        response = self.create(rate='fast')
+        self.assertEqual(response.status_code, 202)
+        self.run_queued()
+        job = self.get(response['Location'])
+        self.assertEqual((job['status'], job['result']), ('failed', None))
+        self.assertIn('ValidationError', job['error'])
+        self.assertFalse(models.Tunnel.objects.exists())
+
+    def test_missing_job(self):
+        response = self.client.get('/jobs/1/', REMOTE_ADDR=self.remote_addr)
+        self.assertEqual(response.status_code, 404)
+
+    def test_fail_interrupted(self):
+        for status in ('pending', 'running', 'done', 'failed'):
+            models.Job.objects.create(kind='create_tunnel', status=status)
+        stdout = StringIO()
+        call_command('fail_interrupted_jobs', stdout=stdout)
+        self.assertIn('Marked 2 interrupted jobs', stdout.getvalue())
+        self.assertEqual(
+            sorted(models.Job.objects.values_list('status', flat=True)),
+            ['done', 'failed', 'failed', 'failed'])
+        self.assertEqual(
+            models.Job.objects.filter(error__contains='Interrupted').count(),
+            2)
+
+
+@override_settings(FIREWALL_BACKEND='iptables')
+class ForwardingCacheTest(KernelStubMixin, TestCase):
+
+    def test_invalidate_after_commit(self):
+        events = []
+        commit = tunnels.IPTablesBatch.commit
+        self.patch(tunnels.IPTablesBatch, 'commit',
+                   lambda batch: events.append('commit') or commit(batch))
+        self.patch(forwarding_cache, 'invalidate',
+                   lambda: events.append('invalidate'))
+        forwarding = Forwarding(tunnel=create_tunnel(['192.168.0.0/24']),
+                                dst_addr='192.168.0.10', dst_port=22,
+                                loc_port=pick_port())
+        forwarding.save()
+        del events[:]
+        with kernel_state(), iptables_batch():
+            forwarding.disable()
+            self.assertEqual(events, [])
+        self.assertEqual(events[0], 'commit')
+        self.assertEqual(set(events[1:]), set(['invalidate']))
+
+
+@override_settings(FIREWALL_BACKEND='iptables')
+class ForwardingsTest(KernelStubMixin, TestCase):
+
+    def setUp(self):
+        super(ForwardingsTest, self).setUp()
+        self.tunnel = create_tunnel(['192.168.0.0/24'])
+        self.active, self.inactive, self.other = [
+            Forwarding(tunnel=self.tunnel, dst_addr='192.168.0.10',
+                       dst_port=port, loc_port=pick_port())
+            for port in (22, 80, 8080)]
+        for forwarding in (self.active, self.inactive, self.other):
+            forwarding.save()
+        self.inactive.disable()
+        del self.commands[:], self.inputs[:]
+
+    def post(self, *targets):
+        return self.client.post('/%s/forwardings/' % self.tunnel.id,
+                                {'targets': targets},
+                                REMOTE_ADDR=self.remote_addr)
+
+    def test_create(self):
+        response = self.post('192.168.0.10:22', '192.168.0.10:80',
+                             '192.168.0.11:443')
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content)
+        self.assertEqual([(fwd['dst_addr'], fwd['dst_port']) for fwd in data],
+                         [('192.168.0.10', 22), ('192.168.0.10', 80),
+                          ('192.168.0.11', 443)])
+        # Existing forwardings keep their port, inactive ones are enabled
+        self.assertEqual(data[0]['loc_port'], self.active.loc_port)
+        self.assertEqual(data[1]['loc_port'], self.inactive.loc_port)
+        new = Forwarding.objects.get(dst_addr='192.168.0.11')
+        self.assertEqual(data[2]['loc_port'], new.loc_port)
+        self.assertTrue(all(Forwarding.objects.filter(
+            tunnel=self.tunnel).values_list('active', flat=True)))
+        self.assertEqual(Forwarding.objects.count(), 4)
+        # The rules of all targets are committed in a single batch
+        commands = [' '.join(cmd) for cmd in self.commands]
+        self.assertEqual(commands.count(IPTABLES_SAVE), 1)
+        self.assertEqual(commands.count('iptables-restore --noflush'), 1)
+        restore = self.inputs[commands.index('iptables-restore --noflush')]
+        for forwarding in data[1:]:
+            self.assertIn('--to-destination %s:%s' % (forwarding['dst_addr'],
+                                                      forwarding['dst_port']),
+                          restore)
+
+    def test_invalid_target(self):
+        free = models.port_allocator.free
+        for target in ('192.168.0.10', '192.168.0.10:ssh',
+                       '192.168.0.300:22', '192.168.0.10:70000'):
+            response = self.post('192.168.0.11:443', target)
+            self.assertEqual(response.status_code, 400, target)
+        self.assertEqual(Forwarding.objects.count(), 3)
+        self.assertEqual(models.port_allocator.free, free)
+        self.assertEqual(self.commands, [])
+
+    def test_release_ports_on_failure(self):
+        def fail(forwardings):
+            raise Exception("Database is locked")
+
+        free = models.port_allocator.free
+        self.patch(Forwarding.objects, 'bulk_create', fail)
+        response = self.post('192.168.0.11:443', '192.168.0.11:8443',
+                             '192.168.0.10:80')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(models.port_allocator.free, free)
+        self.assertFalse(Forwarding.objects.get(id=self.inactive.id).active)
+        self.assertEqual(self.commands, [])
+
+
+class IPTablesBatchTest(KernelStubMixin, TestCase):
+
+    def test_remove_legacy_rules(self):
+        forwarding = Forwarding(tunnel=create_tunnel(['192.168.0.0/24']),
+                                dst_addr='192.168.0.10', dst_port=22,
+                                loc_port=pick_port())
+        legacy = set((table, chain, ('-s', '10.0.0.0/8') + spec)
+                     for table, chain, spec
+                     in tunnels.get_legacy_iptables_rules(forwarding))
+        other = ('nat', 'PREROUTING', ('-s', '10.0.0.0/8', '-j', 'ACCEPT'))
+        batch = tunnels.IPTablesBatch(rules=legacy | set([other]),
+                                      ipsets={})
+        batch.remove(forwarding)
+        self.assertEqual(set(rule for job, rule in batch.changes
+                             if job == '-D'), legacy)
+        self.assertEqual(batch.rules, set([other]))
+
+    def test_sync_sources(self):
+        self.patch(tunnels, 'SOURCE_CIDRS', ['10.0.0.0/8', '192.0.2.1/32',
+                                             '203.0.113.0/24'])
+        # `ipset save` prints /32 networks as plain addresses
+        self.outputs[IPSET_SAVE] = (
+            'create vpn-proxy-src hash:net family inet hashsize 1024 '
+            'maxelem 65536\n'
+            'add vpn-proxy-src 10.0.0.0/8\n'
+            'add vpn-proxy-src 192.0.2.1\n'
+            'add vpn-proxy-src 172.16.0.0/12\n'
+            'add vpn-proxy-src 198.51.100.7\n')
+        batch = tunnels.IPTablesBatch(rules=set(),
+                                      ipsets=tunnels.list_ipsets())
+        batch.sync_sources()
+        self.assertEqual(sorted(batch.ipset_changes), [
+            ('add', 'vpn-proxy-src', '203.0.113.0/24'),
+            ('del', 'vpn-proxy-src', '172.16.0.0/12'),
+            ('del', 'vpn-proxy-src', '198.51.100.7'),
+        ])
+        self.assertEqual(batch.ipsets['vpn-proxy-src'],
+                         set(['10.0.0.0/8', '192.0.2.1', '203.0.113.0/24']))
+        del self.commands[:], self.inputs[:]
+        self.assertTrue(batch.commit())
+        self.assertEqual([' '.join(cmd) for cmd in self.commands],
+                         ['ipset restore -exist'] * 2)
+        self.assertEqual(self.inputs[0], 'add vpn-proxy-src 203.0.113.0/24\n')
+        self.assertEqual(sorted(self.inputs[1].splitlines()), [
+            'del vpn-proxy-src 172.16.0.0/12',
+            'del vpn-proxy-src 198.51.100.7',
+        ])
+        # Once in line, the set is left alone
+        batch.sync_sources()
+        self.assertEqual(batch.ipset_changes, [])
+
+    def test_sync_sources_creates_set(self):
+        self.patch(tunnels, 'SOURCE_CIDRS', ['10.0.0.0/8'])
+        batch = tunnels.IPTablesBatch(rules=set(), ipsets={})
+        batch.sync_sources()
+        self.assertEqual(batch.ipset_changes, [
+            ('create', 'vpn-proxy-src', 'hash:net'),
+            ('add', 'vpn-proxy-src', '10.0.0.0/8'),
+        ])
+
+    def test_dumps_refills_declared_chains(self):
+        tunnel = create_tunnel(['192.168.0.0/24'])
+        old, new = [Forwarding(tunnel=tunnel, dst_addr='192.168.0.10',
+                               dst_port=22, loc_port=pick_port())
+                    for i in range(2)]
+        batch = tunnels.IPTablesBatch(rules=set(), ipsets={})
+        batch.add(old)
+        batch.changes = []
+        batch.remove(old)
+        batch.add(new)
+        dnat = ' '.join(('-A', tunnel.name) +
+                        tunnels.get_iptables_rules(new)['dnat'][0][2])
+        lines = batch.dumps().splitlines()
+        nat = lines[lines.index('*nat'):]
+        self.assertIn(':%s - [0:0]' % tunnel.name, nat)
+        self.assertEqual([line for line in nat
+                          if line.split()[1:2] == [tunnel.name]], [dnat])
+        self.assertNotIn('-X %s' % tunnel.name, nat)
+
+
+# `nft -nn list table ip vpn-proxy` with two forwardings of tunnel 1, one
+# of tunnel 2 and long element lists wrapped the way nft prints them
+NFT_TABLE = """table ip vpn-proxy {
+	set sources {
+		type ipv4_addr
+		flags interval
+		elements = { 10.0.0.0/8 }
+	}
+
+	map marks {
+		type inet_service : mark
+		elements = { 7680 : 0x00000001, 9664 : 0x00000001,
+			     10000 : 0x00000002 }
+	}
+
+	map dst_addrs {
+		type inet_service : ipv4_addr
+		elements = { 7680 : 192.168.0.10, 9664 : 192.168.0.10,
+			     10000 : 192.168.1.10 }
+	}
+
+	map dst_ports {
+		type inet_service : inet_service
+	}
+
+	chain mangle_prerouting {
+		type filter hook prerouting priority -150; policy accept;
+		iifname "eth0" ip saddr @sources meta mark set tcp dport map @marks
+	}
+}
+"""
+
+
+@override_settings(FIREWALL_BACKEND='nftables')
+class NFTablesBatchTest(KernelStubMixin, TestCase):
+
+    def setUp(self):
+        super(NFTablesBatchTest, self).setUp()
+        self.tunnel = create_tunnel(['192.168.0.0/24'])
+        del self.commands[:], self.inputs[:]
+
+    def forwarding(self, loc_port, dst_addr='192.168.0.10', dst_port=22):
+        return Forwarding(tunnel=self.tunnel, dst_addr=dst_addr,
+                          dst_port=dst_port, loc_port=loc_port)
+
+    def test_list(self):
+        self.outputs[NFT_LIST] = NFT_TABLE
+        self.assertEqual(tunnels.list_nftables(), set([
+            ('marks', '7680', '0x1'), ('marks', '9664', '0x1'),
+            ('marks', '10000', '0x2'),
+            ('dst_addrs', '7680', '192.168.0.10'),
+            ('dst_addrs', '9664', '192.168.0.10'),
+            ('dst_addrs', '10000', '192.168.1.10'),
+        ]))
+
+    def test_list_missing_table(self):
+        def fail(cmd, *args, **kwargs):
+            raise subprocess.CalledProcessError(1, cmd)
+
+        self.patch(tunnels, 'run', fail)
+        self.assertEqual(tunnels.list_nftables(), set())
+
+    def test_dumps_add(self):
+        forwarding = self.forwarding(7680)
+        batch = tunnels.NFTablesBatch(elements=set([
+            ('marks', '7680', hex(self.tunnel.id)),
+            ('dst_addrs', '7680', '192.168.0.20'),
+        ]))
+        batch.add(forwarding)
+        lines = batch.dumps().splitlines()
+        # The table and its rules are (re)created along with any additions
+        ruleset = tunnels.get_nftables_ruleset()
+        self.assertEqual(lines[:len(ruleset)], ruleset)
+        self.assertEqual(lines[len(ruleset):], [
+            'delete element ip vpn-proxy dst_addrs { 7680 }',
+            'add element ip vpn-proxy dst_addrs { 7680 : 192.168.0.10 }',
+            'add element ip vpn-proxy dst_ports { 7680 : 22 }',
+        ])
+        self.assertEqual(batch.elements,
+                         set(tunnels.get_nftables_elements(forwarding)))
+        # Elements already in place are not added again
+        batch.changes = []
+        batch.add(forwarding)
+        self.assertEqual(batch.changes, [])
+
+    def test_dumps_remove(self):
+        forwarding = self.forwarding(7680)
+        other = ('marks', '9664', hex(self.tunnel.id))
+        batch = tunnels.NFTablesBatch(elements=set(
+            tunnels.get_nftables_elements(forwarding) + [other]))
+        batch.remove(forwarding)
+        self.assertEqual(batch.dumps().splitlines(), [
+            'delete element ip vpn-proxy marks { 7680 }',
+            'delete element ip vpn-proxy dst_addrs { 7680 }',
+            'delete element ip vpn-proxy dst_ports { 7680 }',
+        ])
+        self.assertEqual(batch.elements, set([other]))
+
+    def test_commit(self):
+        self.outputs[NFT_LIST] = NFT_TABLE
+        with kernel_state(), iptables_batch() as batch:
+            batch.add(self.forwarding(7680, dst_port=80))
+            batch.remove(self.forwarding(10000, dst_addr='192.168.1.10'))
+            dumps = batch.dumps()
+        commands = [' '.join(cmd) for cmd in self.commands]
+        self.assertEqual(commands, [NFT_LIST, 'nft -f -'])
+        self.assertEqual(self.inputs[-1], dumps)
+        self.assertIn('add element ip vpn-proxy dst_ports { 7680 : 80 }',
+                      dumps.splitlines())
+        self.assertIn('delete element ip vpn-proxy dst_addrs { 10000 }',
+                      dumps.splitlines())
+
+
+@override_settings(SHARED_SERVERS=1, SHARED_SERVER_CIDR='172.31.0.0/16')
+class TrafficShapingTest(KernelStubMixin, TestCase):
+
+    def setUp(self):
+        super(TrafficShapingTest, self).setUp()
+        self.dedicated = models.Tunnel(id=5, server='10.10.0.1',
+                                       client='10.10.0.2', rate=1000,
+                                       ceil=2000)
+        self.shared = models.Tunnel(id=0x10005, instance=0,
+                                    server='172.31.0.1', client='172.31.1.9',
+                                    rate=500)
+        exists = os.path.exists
+        self.patch(os.path, 'exists', lambda path: (
+            path.startswith('/sys/class/net/') or exists(path)))
+
+    def root(self, iface, output):
+        self.outputs['tc qdisc show dev %s root' % iface] = output
+
+    def tc_class(self, iface, classid, output):
+        self.outputs['tc class show dev %s classid %s' % (iface,
+                                                          classid)] = output
+
+    def ran(self):
+        return [' '.join(cmd) for cmd in self.commands
+                if cmd[2] != 'show']
+
+    def test_classid(self):
+        self.assertEqual(tunnels._tc_classid(self.dedicated), '1:1')
+        # The minor is the offset of the client address, not the tunnel id
+        self.assertEqual(tunnels._tc_classid(self.shared), '1:109')
+        self.shared.client = '172.31.255.254'
+        self.assertEqual(tunnels._tc_classid(self.shared), '1:fffe')
+        # Offsets in larger networks are reduced into range
+        with self.settings(SHARED_SERVER_CIDR='172.30.0.0/15'):
+            for client in ('172.31.0.0', '172.31.0.1', '172.31.255.254'):
+                self.shared.client = client
+                minor = int(tunnels._tc_classid(self.shared)[2:], 16)
+                self.assertTrue(2 <= minor <= 0xffff, client)
+
+    def test_get_tc_root(self):
+        for output, minor in (
+                ('qdisc htb 1: root refcnt 2 r2q 10 default 0x1 '
+                 'direct_packets_stat 0 direct_qlen 1000\n', 1),
+                ('qdisc htb 1: root refcnt 2 r2q 10 default 10 '
+                 'direct_packets_stat 0\n', 0x10),
+                ('qdisc htb 1: root refcnt 2 r2q 10 default 0 '
+                 'direct_packets_stat 0\n', 0),
+                ('qdisc noqueue 0: root refcnt 2\n', None),
+                ('', None)):
+            self.root('vpn-tun5', output)
+            self.assertEqual(tunnels.get_tc_root('vpn-tun5'), minor, output)
+
+    def test_get_tc_class(self):
+        for output, rates in (
+                ('class htb 1:1 root leaf 8001: prio 0 rate 1Mbit ceil '
+                 '2Mbit burst 1600b cburst 1600b\n', (1000, 2000)),
+                ('class htb 1:1 root leaf 8001: prio 0 rate 500Kbit ceil '
+                 '1500Kbit burst 1600b cburst 1600b\n', (500, 1500)),
+                ('class htb 1:1 root prio 0 rate 1.5Mbit ceil 1Gbit '
+                 'burst 1600b cburst 1375b\n', (1500, 1000000)),
+                ('class htb 1:1 root prio 0 rate 800bit ceil 8Kbit '
+                 'burst 1600b cburst 1600b\n', (1, 8)),
+                ('', None)):
+            self.tc_class('vpn-tun5', '1:1', output)
+            self.assertEqual(tunnels.get_tc_class('vpn-tun5', '1:1'), rates,
+                             output)
+
+    def test_add_dedicated(self):
+        self.root('vpn-tun5', 'qdisc noqueue 0: root refcnt 2\n')
+        self.assertTrue(tunnels.add_tc(self.dedicated))
+        self.assertEqual(self.ran(), [
+            'tc qdisc replace dev vpn-tun5 root handle 1: htb default 1',
+            'tc class replace dev vpn-tun5 parent 1: classid 1:1 htb '
+            'rate 1000kbit ceil 2000kbit',
+            'tc qdisc replace dev vpn-tun5 parent 1:1 fq_codel',
+        ])
+
+    def test_add_dedicated_shaped(self):
+        self.root('vpn-tun5', 'qdisc htb 1: root refcnt 2 r2q 10 default '
+                  '0x1 direct_packets_stat 0\n')
+        self.tc_class('vpn-tun5', '1:1', 'class htb 1:1 root leaf 8001: '
+                      'prio 0 rate 1Mbit ceil 2Mbit burst 1600b\n')
+        self.assertFalse(tunnels.add_tc(self.dedicated))
+        self.assertEqual(self.ran(), [])
+        # A root qdisc with another default class is recreated
+        self.root('vpn-tun5', 'qdisc htb 1: root refcnt 2 r2q 10 default '
+                  '0 direct_packets_stat 0\n')
+        self.assertTrue(tunnels.add_tc(self.dedicated))
+        self.assertEqual(self.ran()[:2], [
+            'tc qdisc del dev vpn-tun5 root',
+            'tc qdisc replace dev vpn-tun5 root handle 1: htb default 1',
+        ])
+
+    def test_add_shared(self):
+        self.root('vpn-srv0', 'qdisc htb 1: root refcnt 2 r2q 10 default '
+                  '0 direct_packets_stat 0\n')
+        self.assertTrue(tunnels.add_tc(self.shared))
+        self.assertEqual(self.ran(), [
+            'tc class replace dev vpn-srv0 parent 1: classid 1:109 htb '
+            'rate 500kbit ceil 500kbit',
+            'tc qdisc replace dev vpn-srv0 parent 1:109 fq_codel',
+            'tc filter replace dev vpn-srv0 parent 1: protocol ip prio 1 '
+            'handle 65541 fw classid 1:109',
+        ])
+
+    def test_del(self):
+        self.assertFalse(tunnels.del_tc(self.dedicated))
+        self.tc_class('vpn-tun5', '1:1', 'class htb 1:1 root leaf 8001: '
+                      'prio 0 rate 1Mbit ceil 2Mbit burst 1600b\n')
+        self.assertTrue(tunnels.del_tc(self.dedicated))
+        self.tc_class('vpn-srv0', '1:109', 'class htb 1:109 root leaf 8002: '
+                      'prio 0 rate 500Kbit ceil 500Kbit burst 1600b\n')
+        self.assertTrue(tunnels.del_tc(self.shared))
+        self.assertEqual(self.ran(), [
+            'tc qdisc del dev vpn-tun5 root',
+            'tc filter del dev vpn-srv0 parent 1: protocol ip prio 1 '
+            'handle 65541 fw',
+            'tc class del dev vpn-srv0 classid 1:109',
+        ])
+
+
+RT_TABLES = """#
+# reserved values
+#
+255\tlocal
+254\tmain
+253\tdefault
+0\tunspec
+#
+# local
+#
+1\tinr.ruhep
+10\told-table
+11\trt_vpn-tun11
+"""
+
+
+class RTablesTest(SimpleTestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        lock_settings = override_settings(
+            LOCK_DIR=os.path.join(self.tmp_dir, 'locks'))
+        lock_settings.enable()
+        self.addCleanup(lock_settings.disable)
+        self.path = os.path.join(self.tmp_dir, 'rt_tables')
+        with open(self.path, 'w') as fobj:
+            fobj.write(RT_TABLES)
+        os.chmod(self.path, 0o640)
+        self.rtables = tunnels.RTables(self.path)
+
+    def read_file(self):
+        with open(self.path) as fobj:
+            return fobj.read()
+
+    def test_read(self):
+        rtables = self.rtables.read()
+        self.assertEqual(rtables['main'], 254)
+        self.assertEqual(rtables['inr.ruhep'], 1)
+        self.assertEqual(rtables['rt_vpn-tun11'], 11)
+        self.assertNotIn('reserved', rtables)
+
+    def test_reload_on_change(self):
+        self.rtables.read()
+        # Unchanged files are not parsed again
+        self.rtables.indexes['cached'] = 99
+        self.assertEqual(self.rtables.read()['cached'], 99)
+        with open(self.path, 'a') as fobj:
+            fobj.write('12\trt_vpn-tun12\n')
+        rtables = self.rtables.read()
+        self.assertEqual(rtables['rt_vpn-tun12'], 12)
+        self.assertNotIn('cached', rtables)
+
+    def test_edit(self):
+        inode = os.stat(self.path).st_ino
+        self.assertTrue(self.rtables.edit(add=[(20, 'rt_vpn-tun20')],
+                                          remove=[(1, 'inr.ruhep')]))
+        # The file was replaced by renaming a temp file over it
+        stat = os.stat(self.path)
+        self.assertNotEqual(stat.st_ino, inode)
+        self.assertEqual(stat.st_mode & 0o777, 0o640)
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)),
+                         ['locks', 'rt_tables'])
+        self.assertEqual(self.read_file(),
+                         RT_TABLES.replace('1\tinr.ruhep\n', '') +
+                         '20\trt_vpn-tun20\n')
+        rtables = self.rtables.read()
+        self.assertEqual(rtables['rt_vpn-tun20'], 20)
+        self.assertNotIn('inr.ruhep', rtables)
+
+    def test_edit_noop(self):
+        stat = os.stat(self.path)
+        self.assertFalse(self.rtables.edit())
+        self.assertFalse(self.rtables.edit(add=[(1, 'inr.ruhep')],
+                                           remove=[(30, 'rt_vpn-tun30')]))
+        self.assertEqual(os.stat(self.path), stat)
+        self.assertEqual(self.read_file(), RT_TABLES)
+
+    def test_edit_conflicts(self):
+        self.assertTrue(self.rtables.edit(add=[(10, 'rt_vpn-tun10'),
+                                               (12, 'rt_vpn-tun11')]))
+        rtables = self.rtables.read()
+        # Lines with the same index or name as added entries are replaced
+        self.assertNotIn('old-table', rtables)
+        self.assertEqual(rtables['rt_vpn-tun10'], 10)
+        self.assertEqual(rtables['rt_vpn-tun11'], 12)
+        self.assertNotIn(11, rtables.values())
+
+    def test_edit_failure(self):
+        def fail(src, dst):
+            raise OSError(28, 'No space left on device')
+
+        self.addCleanup(setattr, os, 'rename', os.rename)
+        os.rename = fail
+        self.assertRaises(OSError, self.rtables.edit,
+                          add=[(20, 'rt_vpn-tun20')])
+        self.assertEqual(self.read_file(), RT_TABLES)
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)),
+                         ['locks', 'rt_tables'])
+
+
+class OpenVPNAffinityTest(KernelStubMixin, TestCase):
+
+    def setUp(self):
+        super(OpenVPNAffinityTest, self).setUp()
+        dropin_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dropin_dir)
+        self.patch(tunnels, 'OPENVPN_DROPIN',
+                   dropin_dir + '/openvpn@%s.service.d/vpn-proxy.conf')
+        self.scans, self.reloads = [], []
+        self.list_processes = tunnels.list_openvpn_processes
+        self.patch(tunnels, 'list_openvpn_processes',
+                   lambda: self.scans.append(1) or {})
+        self.patch(tunnels, 'choose_openvpn_cpu', lambda iface: 1)
+        self.patch(tunnels, 'get_unit_manager', lambda: self)
+
+    def reload(self):
+        self.reloads.append(1)
+
+    @override_settings(OPENVPN_NICE=None)
+    def test_pin_once(self):
+        self.assertTrue(tunnels.ensure_openvpn_pinned('vpn-tun1'))
+        self.assertEqual((len(self.scans), len(self.reloads)), (1, 1))
+        for i in range(3):
+            self.assertFalse(tunnels.ensure_openvpn_pinned('vpn-tun1'))
+        self.assertEqual((len(self.scans), len(self.reloads)), (1, 1))
+        with self.settings(OPENVPN_NICE=5):
+            self.assertTrue(tunnels.ensure_openvpn_pinned('vpn-tun1'))
+        self.assertEqual((len(self.scans), len(self.reloads)), (2, 2))
+        self.assertEqual(tunnels.read_openvpn_affinity(), {'vpn-tun1': 1})
+
+    def test_list_own_processes(self):
+        procs = []
+        for iface in ('vpn-tun7', 'vpn-srv0', 'client'):
+            procs.append(subprocess.Popen(
+                ['openvpn', '-c', 'import time; time.sleep(30)',
+                 '--config', '/etc/openvpn/%s.conf' % iface],
+                executable=sys.executable))
+            self.addCleanup(procs[-1].wait)
+            self.addCleanup(procs[-1].kill)
+        pids = self.list_processes()
+        self.assertEqual(pids.get('vpn-tun7'), procs[0].pid)
+        self.assertEqual(pids.get('vpn-srv0'), procs[1].pid)
+        self.assertNotIn('client', pids)
+
+
+class PoolTest(KernelStubMixin, TestCase):
+
+    def test_claim_ignores_empty_cidrs(self):
+        tunnel = create_tunnel(['192.168.0.0/24'], pooled=True)
+        claimed = pool.claim_tunnel([''], excluded_cidrs=[''])
+        self.assertEqual(claimed.id, tunnel.id)
+        self.assertFalse(claimed.pooled)
+        self.assertIsNone(pool.claim_tunnel(['']))
+
+
+class SystemctlManagerTest(KernelStubMixin, TestCase):
+
+    def test_list_units(self):
+        # Failed units are marked with a bullet by some systemd versions
+        self.outputs['systemctl list-units --all --plain --no-legend '
+                     'openvpn@vpn-*'] = (
+            'openvpn@vpn-tun1.service loaded active running OpenVPN '
+            'connection to vpn-tun1\n'
+            '\xe2\x97\x8f openvpn@vpn-tun2.service loaded failed failed '
+            'OpenVPN connection to vpn-tun2\n'
+            '* openvpn@vpn-tun3.service not-found inactive dead '
+            'openvpn@vpn-tun3.service\n')
+        units = tunnels.SystemctlManager().list_units('openvpn@vpn-*')
+        self.assertEqual(units, {
+            'openvpn@vpn-tun1.service': 'active',
+            'openvpn@vpn-tun2.service': 'failed',
+            'openvpn@vpn-tun3.service': 'inactive',
+        })
+
+
+class SystemdMarshalTest(TestCase):
+
+    def roundtrip(self, sig, value, offset=0):
+        buf = bytearray('\0' * offset)
+        systemd._marshal(buf, sig, value)
+        result, end = systemd._unmarshal(str(buf), offset, sig)
+        self.assertEqual(end, len(buf))
+        return result
+
+    def test_split(self):
+        self.assertEqual(systemd._split('sa(ssi)a{sv}yv'),
+                         ['s', 'a(ssi)', 'a{sv}', 'y', 'v'])
+
+    def test_fixed(self):
+        for sig, value in (('y', 255), ('b', 1), ('n', -2), ('q', 65535),
+                           ('i', -7), ('u', 7), ('x', -2 ** 40),
+                           ('t', 2 ** 63), ('d', 0.5)):
+            for offset in range(4):
+                self.assertEqual(self.roundtrip(sig, value, offset), value)
+
+    def test_strings(self):
+        buf = bytearray()
+        systemd._marshal(buf, 's', 'ab')
+        self.assertEqual(str(buf), '\x02\0\0\0ab\0')
+        self.assertEqual(self.roundtrip('s', u'caf\xe9'), 'caf\xc3\xa9')
+        self.assertEqual(self.roundtrip('o', '/a/b', 1), '/a/b')
+        self.assertEqual(self.roundtrip('g', 'a(yv)', 3), 'a(yv)')
+
+    def test_containers(self):
+        units = [('a.service', 'desc', 'loaded', 'active', 7)]
+        self.assertEqual(self.roundtrip('a(ssssu)', units, 1), units)
+        self.assertEqual(self.roundtrip('a(ssssu)', [], 1), [])
+        self.assertEqual(self.roundtrip('v', ('as', ['x', 'y'])),
+                         ['x', 'y'])
+        self.assertEqual(self.roundtrip('a{sv}', [('k', ('u', 3))], 2),
+                         [('k', 3)])
+
+    def test_empty_array_padding(self):
+        # The padding to the first element counts even without elements
+        buf = bytearray('\0')
+        systemd._marshal(buf, 'a(yv)', [])
+        self.assertEqual(len(buf), 8)
+
+    def test_message(self):
+        fields = [(systemd.PATH, ('o', systemd.SYSTEMD_PATH)),
+                  (systemd.MEMBER, ('s', 'StartUnit'))]
+        data = systemd._message(systemd.METHOD_CALL, 5, fields, 'ss',
+                                ['a.service', 'replace'])
+        # The body starts 8 byte aligned, right after the header
+        body = '\x09\0\0\0a.service\0\0\0\x07\0\0\0replace\0'
+        self.assertEqual(struct.unpack_from('<I', data, 4)[0], len(body))
+        self.assertEqual((len(data) - len(body)) % 8, 0)
+        self.assertTrue(data.endswith(body))
+        kind, fields, body = systemd._parse(data)
+        self.assertEqual(kind, systemd.METHOD_CALL)
+        self.assertEqual(fields, {systemd.PATH: systemd.SYSTEMD_PATH,
+                                  systemd.MEMBER: 'StartUnit',
+                                  systemd.SIGNATURE: 'ss'})
+        self.assertEqual(body, ['a.service', 'replace'])
+        self.assertEqual(struct.unpack_from('<I', data, 8)[0], 5)
+
+    def test_big_endian(self):
+        data = 'B' + systemd._message(systemd.METHOD_RETURN, 1, [])[1:]
+        with self.assertRaises(systemd.SystemdError):
+            systemd._parse(data)
+
+
+SYSTEMD_NO_UNIT = 'org.freedesktop.systemd1.NoSuchUnit'
+
+
+class FakeBus(threading.Thread):
+    """Serve systemd's manager methods on a unix socket, one connection at
+    a time, recording the method calls"""
+
+    def __init__(self, path, results):
+        super(FakeBus, self).__init__()
+        self.daemon = True
+        self.results = results
+        self.calls = []
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen(1)
+
+    def run(self):
+        while True:
+            try:
+                sock = self.server.accept()[0]
+            except socket.error:
+                return
+            try:
+                self.serve(sock)
+            finally:
+                sock.close()
+
+    def serve(self, sock):
+        data = ''
+        while 'BEGIN\r\n' not in data:
+            chunk = sock.recv(65536)
+            if not chunk:
+                return
+            data += chunk
+            if '\r\n' in data and not data.startswith('OK'):
+                sock.sendall('OK 0123456789abcdef\r\n')
+                data = 'OK' + data.split('\r\n', 1)[1]
+        data = data.split('BEGIN\r\n', 1)[1]
+        while True:
+            if len(data) >= systemd.HEADER.size + 4:
+                body_length = struct.unpack_from('<I', data, 4)[0]
+                length = systemd.HEADER.size + 4 + struct.unpack_from(
+                    '<I', data, systemd.HEADER.size)[0]
+                length += -length % 8 + body_length
+                if len(data) >= length:
+                    message, data = data[:length], data[length:]
+                    sock.sendall(self.handle(message))
+                    continue
+            chunk = sock.recv(65536)
+            if not chunk:
+                return
+            data += chunk
+
+    def handle(self, message):
+        kind, fields, body = systemd._parse(message)
+        serial = struct.unpack_from('<I', message, 8)[0]
+        member = fields[systemd.MEMBER]
+        self.calls.append((member, body))
+        reply = [(systemd.REPLY_SERIAL, ('u', serial))]
+        if member == 'Hello':
+            return systemd._message(systemd.METHOD_RETURN, 1, reply, 's',
+                                    [':1.1'])
+        if member == 'ListUnits':
+            units = [(unit, '', 'loaded', state, 'running', '', '/unit',
+                      0, '', '/') for unit, state in self.results.items()]
+            return systemd._message(systemd.METHOD_RETURN, 1, reply,
+                                    'a(ssssssouso)', [units])
+        if member not in systemd.JOB_METHODS.values():
+            return systemd._message(systemd.METHOD_RETURN, 1, reply)
+        unit = body[0]
+        if unit not in self.results:
+            return systemd._message(systemd.ERROR, 1, reply + [
+                (systemd.ERROR_NAME, ('s', SYSTEMD_NO_UNIT))
+            ], 's', ['Unit %s not found.' % unit])
+        path = '/org/freedesktop/systemd1/job/%d' % serial
+        return (systemd._message(systemd.METHOD_RETURN, 1, reply, 'o',
+                                 [path]) +
+                systemd._message(systemd.SIGNAL, 1, [
+                    (systemd.MEMBER, ('s', 'JobRemoved')),
+                ], 'uoss', [serial, path, unit, self.results[unit]]))
+
+
+class SystemdBusTest(TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'bus')
+        self.bus = FakeBus(path, {'a.service': 'done',
+                                  'b.service': 'failed'})
+        self.bus.start()
+        self.addCleanup(self.bus.server.close)
+        address = os.environ.get('DBUS_SYSTEM_BUS_ADDRESS')
+        os.environ['DBUS_SYSTEM_BUS_ADDRESS'] = 'unix:path=' + path
+        if address is None:
+            self.addCleanup(os.environ.pop, 'DBUS_SYSTEM_BUS_ADDRESS')
+        else:
+            self.addCleanup(os.environ.__setitem__,
+                            'DBUS_SYSTEM_BUS_ADDRESS', address)
+
+    def test_list_units(self):
+        self.assertEqual(systemd.list_units(), {'a.service': 'done',
+                                                'b.service': 'failed'})
+
+    def test_reload(self):
+        systemd.reload()
+        self.assertEqual(self.bus.calls, [('Hello', []), ('Reload', [])])
+
+    def test_run_jobs(self):
+        systemd.run_jobs('start', ['a.service'])
+        self.assertIn(('StartUnit', ['a.service', 'replace']),
+                      self.bus.calls)
+
+    def test_run_jobs_failed(self):
+        with self.assertRaises(systemd.SystemdError) as ctx:
+            systemd.run_jobs('restart', ['a.service', 'b.service',
+                                         'c.service'])
+        message = str(ctx.exception)
+        self.assertNotIn('a.service', message)
+        self.assertIn('b.service (failed)', message)
+        self.assertIn('c.service (%s' % SYSTEMD_NO_UNIT, message)
+
+
+class PortAllocatorTest(SimpleTestCase):
+
+    def allocator(self, start, stop, used=(), taken=()):
+        return PortAllocator(start, stop, lambda: used,
+                             lambda ports: set(ports) & set(taken))
+
+    def test_bitmap_padding(self):
+        # 11 ports take 2 bytes, the 5 bits past the range are never free
+        allocator = self.allocator(1000, 1011, used=[999, 1003, 1011])
+        allocator.reserve(1000)
+        self.assertEqual(allocator.free, 9)
+        ports = [allocator.allocate() for _ in range(9)]
+        self.assertEqual(sorted(ports),
+                         [port for port in range(1001, 1011)
+                          if port != 1003])
+        self.assertEqual(allocator.free, 0)
+        with self.assertRaises(Exception):
+            allocator.allocate()
+        allocator.release(1005)
+        allocator.release(1011)
+        self.assertEqual(allocator.allocate(), 1005)
+
+    def test_allocate_many(self):
+        allocator = self.allocator(1000, 1100)
+        ports = allocator.allocate_many(100)
+        self.assertEqual(sorted(ports), range(1000, 1100))
+
+    def test_allocate_many_rollback(self):
+        allocator = self.allocator(1000, 1010, used=[1000, 1001])
+        allocator.allocate_many(3)
+        self.assertEqual(allocator.free, 5)
+        with self.assertRaises(Exception):
+            allocator.allocate_many(6)
+        self.assertEqual(allocator.free, 5)
+        # Candidates found in use cut the ports available short midway
+        allocator = self.allocator(1000, 1010, taken=range(1000, 1006))
+        with self.assertRaises(Exception):
+            allocator.allocate_many(5)
+        self.assertEqual(allocator.free, 4)
+        self.assertEqual(sorted(allocator.allocate_many(4)),
+                         range(1006, 1010))
+
+    def test_in_use_double_check(self):
+        taken = range(1000, 1008)
+        allocator = self.allocator(1000, 1010, taken=taken)
+        self.assertIn(allocator.allocate(), (1008, 1009))
+        allocator = self.allocator(1000, 1010, taken=taken)
+        self.assertEqual(sorted(allocator.allocate_many(2)), [1008, 1009])
+        # Ports found in use stay reserved, until reloaded
+        with self.assertRaises(Exception):
+            allocator.allocate()
+        self.assertEqual(allocator.free, 0)
+        allocator.reset()
+        self.assertIn(allocator.allocate(), (1008, 1009))
+
+
+class FakeNetlinkSocket(object):
+    """Record the requests sent and reply to them with the messages queued
+    in `replies`, acknowledging each request once those run out"""
+
+    def __init__(self):
+        self.sent = []
+        self.replies = []
+
+    @contextlib.contextmanager
+    def open(self):
+        yield self
+
+    def sendall(self, data):
+        self.sent.append(data)
+
+    def recv(self, size):
+        if self.replies:
+            return self.replies.pop(0)
+        return nlmsg(netlink.NLMSG_ERROR, struct.pack('i', 0) + '\0' * 16)
+
+
+def nlmsg(kind, payload, flags=0):
+    data = netlink.NLMSGHDR.pack(netlink.NLMSGHDR.size + len(payload), kind,
+                                 flags, 0, 0) + payload
+    return data + '\0' * (-len(data) % 4)
+
+
+class FakeICMPSocket(object):
+    """An ICMP socket which records the packets sent and returns those
+    queued in `replies`, with a pipe to select on"""
+
+    def __init__(self, family, kind, proto, bind_error=None):
+        self.raw = kind == socket.SOCK_RAW
+        self.bind_error = bind_error
+        self.options, self.sent, self.replies = {}, [], []
+        self.closed = False
+        self._pipe = os.pipe()
+
+    def setsockopt(self, level, option, value):
+        if option == icmp.SO_BINDTODEVICE and self.bind_error:
+            raise socket.error(self.bind_error, os.strerror(self.bind_error))
+        self.options[option] = value
+
+    def setblocking(self, flag):
+        pass
+
+    def fileno(self):
+        return self._pipe[0]
+
+    def close(self):
+        if not self.closed:
+            map(os.close, self._pipe)
+        self.closed = True
+
+    def sendto(self, data, addr):
+        self.sent.append((data, addr))
+
+    def recvfrom(self, size):
+        if not self.replies:
+            raise socket.error(errno.EAGAIN, os.strerror(errno.EAGAIN))
+        return self.replies.pop(0)
+
+
+def echo(kind, ident, seq, ip_header=False):
+    """Return an ICMP echo packet, prefixed with an IP header as received
+    by raw sockets if `ip_header`"""
+    header = icmp.HEADER.pack(kind, 0, 0, ident, seq)
+    packet = icmp.HEADER.pack(kind, 0, icmp.checksum(header + icmp.PAYLOAD),
+                              ident, seq) + icmp.PAYLOAD
+    if ip_header:
+        packet = '\x45' + '\0' * 19 + packet
+    return packet
+
+
+class ICMPTest(KernelStubMixin, TestCase):
+
+    def setUp(self):
+        super(ICMPTest, self).setUp()
+        self.sockets = []
+        # Errors opening raw and binding datagram sockets, if any
+        self.raw_error = self.bind_error = None
+        self.patch(icmp.socket, 'socket', self.fake_socket)
+
+    def fake_socket(self, family, kind, proto):
+        if kind == socket.SOCK_RAW and self.raw_error:
+            raise socket.error(self.raw_error, os.strerror(self.raw_error))
+        sock = FakeICMPSocket(family, kind, proto,
+                              None if kind == socket.SOCK_RAW
+                              else self.bind_error)
+        self.addCleanup(sock.close)
+        self.sockets.append(sock)
+        return sock
+
+    def test_checksum(self):
+        self.assertEqual(icmp.checksum('\x08\x00\x00\x00\x00\x01\x00\x01'),
+                         0xf7fd)
+        self.assertEqual(icmp.checksum('\x01'), 0xfeff)
+        # A packet including its checksum sums up to 0
+        self.assertEqual(icmp.checksum(echo(icmp.ICMP_ECHO_REQUEST, 7, 3)), 0)
+
+    def test_receive_raw(self):
+        probe = icmp.Probe('10.10.0.2', 'vpn-tun1')
+        sock = self.sockets[0]
+        self.assertTrue(probe.raw)
+        self.assertEqual(sock.options[icmp.SO_BINDTODEVICE], 'vpn-tun1')
+        probe.send(0)
+        probe.send(1)
+        self.assertEqual(sock.sent[0], (echo(icmp.ICMP_ECHO_REQUEST,
+                                             probe.ident, 0),
+                                        ('10.10.0.2', 0)))
+        sock.replies = [
+            # Raw sockets also receive requests, and replies to others
+            (echo(icmp.ICMP_ECHO_REQUEST, probe.ident, 1, True),
+             ('10.10.0.2', 0)),
+            (echo(icmp.ICMP_ECHO_REPLY, probe.ident + 1, 1, True),
+             ('10.10.0.2', 0)),
+            (echo(icmp.ICMP_ECHO_REPLY, probe.ident, 0, True),
+             ('10.10.0.3', 0)),
+            (echo(icmp.ICMP_ECHO_REPLY, probe.ident, 1, True),
+             ('10.10.0.2', 0)),
+        ]
+        replies = probe.receive()
+        self.assertEqual([seq for seq, rtt in replies], [1])
+        self.assertTrue(replies[0][1] >= 0)
+        self.assertEqual(probe.pending.keys(), [0])
+        self.assertEqual(probe.expire(0), [0])
+        self.assertEqual(probe.pending, {})
+
+    def test_receive_dgram(self):
+        self.raw_error = errno.EPERM
+        probe = icmp.Probe('10.10.0.2')
+        sock = self.sockets[0]
+        self.assertFalse(probe.raw)
+        probe.send(0)
+        # The kernel rewrites the identifier of datagram sockets
+        sock.replies = [(echo(icmp.ICMP_ECHO_REPLY, 1234, 0),
+                         ('10.10.0.2', 0))]
+        self.assertEqual([seq for seq, rtt in probe.receive()], [0])
+
+    def test_bind_without_cap_net_raw(self):
+        self.raw_error = self.bind_error = errno.EPERM
+        self.assertRaises(socket.error, icmp.Probe, '10.10.0.2', 'vpn-tun1')
+        self.assertTrue(self.sockets[0].closed)
+
+    def test_deadline(self):
+        started_at = time.time()
+        results = list(icmp.iter_ping('10.10.0.2', count=5, deadline=0.2))
+        self.assertTrue(time.time() - started_at < 0.5)
+        self.assertEqual(sorted(results), [(seq, None) for seq in range(5)])
+        self.assertEqual(len(self.sockets[0].sent), 5)
+        self.assertTrue(self.sockets[0].closed)
+
+    def test_summarize(self):
+        summary = icmp.summarize('10.10.0.2', [(0, 10.0), (1, None),
+                                               (2, 20.0), (3, 30.0)])
+        self.assertEqual(summary, {
+            'host': '10.10.0.2', 'sent': '4', 'received': '3',
+            'packet_loss': '25', 'minping': '10.000', 'avgping': '20.000',
+            'maxping': '30.000', 'jitter': '8.165',
+        })
+        summary = icmp.summarize('10.10.0.2', [])
+        self.assertEqual((summary['sent'], summary['packet_loss'],
+                          summary['avgping']), ('0', '0', None))
+
+    def test_view_without_cap_net_raw(self):
+        self.raw_error = self.bind_error = errno.EPERM
+        tunnel = create_tunnel(['192.168.0.0/24'])
+        for query in ('', '?stream=1'):
+            response = self.client.get(
+                '/%s/ping/%s/%s' % (tunnel.id, tunnel.client, query),
+                REMOTE_ADDR=self.remote_addr)
+            self.assertEqual(response.status_code, 503)
+            self.assertIn('CAP_NET_RAW', response.content)
+
+
+class FakeProbe(object):
+    """A probe answering echo requests to hosts in `reachable` right away,
+    with a pipe to poll on"""
+
+    reachable, failing = set(), set()
+
+    def __init__(self, host, iface=None):
+        if host in self.failing:
+            raise socket.error(errno.EPERM, os.strerror(errno.EPERM))
+        self.host, self.pending = host, {}
+        self._pipe = os.pipe()
+
+    def fileno(self):
+        return self._pipe[0]
+
+    def close(self):
+        map(os.close, self._pipe)
+
+    def send(self, seq):
+        self.pending[seq] = time.time()
+        if self.host in self.reachable:
+            os.write(self._pipe[1], 'x')
+
+    def receive(self):
+        os.read(self._pipe[0], 4096)
+        replies = [(seq, 1.5) for seq in sorted(self.pending)]
+        self.pending = {}
+        return replies
+
+
+@override_settings(HEALTH_CHECK_PKTS=2, HEALTH_CHECK_TIMEOUT=0.1,
+                   HEALTH_CHECK_CONCURRENCY=2)
+class HealthTest(KernelStubMixin, TestCase):
+
+    def setUp(self):
+        super(HealthTest, self).setUp()
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.path = os.path.join(tmp_dir, 'health', 'health.json')
+        self.patch(health, 'RESULTS_PATH', self.path)
+        self.patch(views, 'health_results', health.HealthResults(self.path))
+        self.patch(icmp, 'Probe', FakeProbe)
+        self.tunnels = [create_tunnel(['192.168.0.0/24']) for i in range(3)]
+        # Neither disabled nor pooled tunnels are probed
+        create_tunnel(['192.168.0.0/24']).disable()
+        create_tunnel([], pooled=True)
+        self.patch(FakeProbe, 'reachable', set([self.tunnels[0].client]))
+        self.patch(FakeProbe, 'failing', set([self.tunnels[2].client]))
+
+    def test_sweep_tunnels(self):
+        results = health.sweep_tunnels()
+        self.assertEqual(sorted(results),
+                         sorted(tunnel.id for tunnel in self.tunnels))
+        for tunnel, rtt, loss in zip(self.tunnels, (1.5, None, None),
+                                     (0, 100, 100)):
+            result = results[tunnel.id]
+            self.assertEqual((result['client'], result['iface']),
+                             (tunnel.client, tunnel.iface))
+            self.assertEqual((result['rtt'], result['loss']), (rtt, loss))
+
+    def test_results(self):
+        results = health.HealthResults(self.path)
+        self.assertIsNone(results.get())
+        health.write_results({1: {'rtt': 1.5}}, time.time())
+        data = results.get()
+        self.assertEqual(data['tunnels'], {'1': {'rtt': 1.5}})
+        # The file is only read again once replaced by another sweep
+        self.assertIs(results.get(), data)
+        health.write_results({2: {'rtt': None}}, time.time())
+        self.assertEqual(results.get()['tunnels'], {'2': {'rtt': None}})
+        self.assertEqual(os.listdir(os.path.dirname(self.path)),
+                         ['health.json'])
+
+    def test_view(self):
+        response = self.client.get('/health/', REMOTE_ADDR=self.remote_addr)
+        self.assertEqual(response.status_code, 503)
+        health.run_sweep()
+        response = self.client.get('/health/', REMOTE_ADDR=self.remote_addr)
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content)
+        self.assertEqual(data['interval'], settings.HEALTH_CHECK_INTERVAL)
+        self.assertEqual(data['tunnels'][str(self.tunnels[0].id)]['rtt'],
+                         1.5)
+        self.assertEqual(data['tunnels'][str(self.tunnels[1].id)]['loss'],
+                         100)
+
+
+class NetlinkTest(KernelStubMixin, TestCase):
+
+    def setUp(self):
+        super(NetlinkTest, self).setUp()
+        self.sock = FakeNetlinkSocket()
+        self.patch(netlink, '_socket', self.sock.open)
+        self.patch(netlink, '_ifindex', lambda iface: 7)
+        self.patch(netlink, '_ifnames', lambda: {7: 'vpn-tun7'})
+
+    def sent(self):
+        """Return the type, flags and payload of the only request sent"""
+        self.assertEqual(len(self.sock.sent), 1)
+        messages = list(netlink._messages(self.sock.sent[0]))
+        self.assertEqual(len(messages), 1)
+        return messages[0]
+
+    def test_attrs(self):
+        data = (netlink._attr(1, 'abcde') + netlink._attr(2, '') +
+                netlink._attr(3, netlink._u32(5)))
+        self.assertEqual(len(data), 12 + 4 + 8)
+        self.assertEqual(netlink._parse_attrs(data),
+                         {1: 'abcde', 2: '', 3: netlink._u32(5)})
+        # Truncated and malformed attributes are ignored
+        self.assertEqual(netlink._parse_attrs(data[:2]), {})
+        self.assertEqual(netlink._parse_attrs('\x02\0\x01\0'), {})
+
+    def test_messages(self):
+        data = nlmsg(24, 'abc') + nlmsg(netlink.NLMSG_DONE, '', 2)
+        self.assertEqual(list(netlink._messages(data)),
+                         [(24, 0, 'abc'), (netlink.NLMSG_DONE, 2, '')])
+
+    def test_add_rule(self):
+        netlink.add_rule(300, src='10.0.0.1', fwmark=0x2a)
+        kind, flags, payload = self.sent()
+        self.assertEqual(kind, netlink.RTM_NEWRULE)
+        self.assertEqual(flags, netlink.NLM_F_REQUEST | netlink.NLM_F_ACK |
+                         netlink.NLM_F_CREATE | netlink.NLM_F_EXCL)
+        hdr = netlink.RTMSG.unpack_from(payload)
+        self.assertEqual(hdr, (socket.AF_INET, 0, 32, 0, 0, 0, 0,
+                               netlink.FR_ACT_TO_TBL, 0))
+        attrs = netlink._parse_attrs(payload[netlink.RTMSG.size:])
+        self.assertEqual(attrs, {
+            netlink.FRA_TABLE: netlink._u32(300),
+            netlink.FRA_SRC: socket.inet_aton('10.0.0.1'),
+            netlink.FRA_FWMARK: netlink._u32(0x2a),
+        })
+
+    def test_del_route(self):
+        netlink.del_route('vpn-tun7', 100, gateway='172.17.0.1')
+        kind, flags, payload = self.sent()
+        self.assertEqual(kind, netlink.RTM_DELROUTE)
+        self.assertEqual(flags, netlink.NLM_F_REQUEST | netlink.NLM_F_ACK)
+        hdr = netlink.RTMSG.unpack_from(payload)
+        self.assertEqual(hdr[4], 100)
+        self.assertEqual(hdr[6], netlink.RT_SCOPE_UNIVERSE)
+        attrs = netlink._parse_attrs(payload[netlink.RTMSG.size:])
+        self.assertEqual(attrs, {
+            netlink.RTA_TABLE: netlink._u32(100),
+            netlink.RTA_OIF: netlink._u32(7),
+            netlink.RTA_GATEWAY: socket.inet_aton('172.17.0.1'),
+        })
+
+    def test_error(self):
+        self.sock.replies.append(nlmsg(netlink.NLMSG_ERROR,
+                                       struct.pack('i', -17) + '\0' * 16))
+        with self.assertRaises(netlink.NetlinkError) as ctx:
+            netlink.add_rule(100, fwmark=1)
+        self.assertEqual(ctx.exception.errno, 17)
+
+    def test_list_rules(self):
+        rule = (netlink.RTMSG.pack(socket.AF_INET, 0, 24, 0, 0, 0, 0,
+                                   netlink.FR_ACT_TO_TBL, 0) +
+                netlink._attr(netlink.FRA_TABLE, netlink._u32(300)) +
+                netlink._attr(netlink.FRA_PRIORITY, netlink._u32(5)) +
+                netlink._attr(netlink.FRA_SRC, socket.inet_aton('10.0.0.0')))
+        # Dumps may span many reads, until NLMSG_DONE
+        self.sock.replies.extend([
+            nlmsg(netlink.RTM_NEWRULE, rule),
+            nlmsg(netlink.RTM_NEWRULE, rule[:netlink.RTMSG.size]) +
+            nlmsg(netlink.NLMSG_DONE, ''),
+        ])
+        rules = netlink.list_rules()
+        kind, flags, payload = self.sent()
+        self.assertEqual(kind, netlink.RTM_GETRULE)
+        self.assertTrue(flags & netlink.NLM_F_DUMP)
+        self.assertEqual(rules[0], {
+            'src': '10.0.0.0/24', 'fwmark': None, 'fwmask': None,
+            'priority': 5, 'action': netlink.FR_ACT_TO_TBL, 'table': 300})
+        self.assertEqual(rules[1]['table'], 0)
+        self.assertEqual(len(rules), 2)
+
+    def test_list_routes(self):
+        route = (netlink.RTMSG.pack(socket.AF_INET, 0, 0, 0, 100, 0, 0,
+                                    netlink.RTN_UNICAST, 0) +
+                 netlink._attr(netlink.RTA_OIF, netlink._u32(7)) +
+                 netlink._attr(netlink.RTA_GATEWAY,
+                               socket.inet_aton('172.17.0.1')))
+        self.sock.replies.append(nlmsg(netlink.RTM_NEWROUTE, route) +
+                                 nlmsg(netlink.NLMSG_DONE, ''))
+        self.assertEqual(netlink.list_routes(), [{
+            'dst': None, 'dst_len': 0, 'type': netlink.RTN_UNICAST,
+            'iface': 'vpn-tun7', 'gateway': '172.17.0.1', 'table': 100}])
+
+
+class IntervalSetTest(SimpleTestCase):
+
+    def assertIntervals(self, values, intervals):
+        self.assertEqual(zip(values.starts, values.ends), intervals)
+
+    def test_add_merges(self):
+        values = IntervalSet([1, 5])
+        self.assertIntervals(values, [(1, 1), (5, 5)])
+        values.add(2)
+        self.assertIntervals(values, [(1, 2), (5, 5)])
+        values.add(4)
+        self.assertIntervals(values, [(1, 2), (4, 5)])
+        values.add(3)
+        self.assertIntervals(values, [(1, 5)])
+        values.add(3)
+        self.assertIntervals(values, [(1, 5)])
+        values.add(0)
+        values.add(9)
+        self.assertIntervals(values, [(0, 5), (9, 9)])
+        self.assertEqual(len(values), 7)
+
+    def test_discard_splits(self):
+        values = IntervalSet(range(1, 8))
+        values.discard(4)
+        self.assertIntervals(values, [(1, 3), (5, 7)])
+        values.discard(1)
+        values.discard(7)
+        self.assertIntervals(values, [(2, 3), (5, 6)])
+        values.discard(9)
+        values.discard(4)
+        self.assertIntervals(values, [(2, 3), (5, 6)])
+        for value in (2, 3):
+            values.discard(value)
+        self.assertIntervals(values, [(5, 6)])
+        self.assertNotIn(4, values)
+        self.assertIn(5, values)
+        self.assertEqual(len(values), 2)
+
+    def test_first_free(self):
+        values = IntervalSet([1, 2, 3, 6])
+        self.assertEqual(values.next_free(1), 4)
+        self.assertEqual(values.next_free(5), 5)
+        self.assertEqual(values.first_free(1, 6), 4)
+        self.assertEqual(values.first_free(1, 6, 5), 5)
+        # Out of range starts fall back to the first integer
+        self.assertEqual(values.first_free(1, 6, 9), 4)
+
+    def test_first_free_wraps_around(self):
+        values = IntervalSet([1, 2, 5, 6])
+        self.assertEqual(values.first_free(1, 6, 5), 3)
+        values.add(3)
+        values.add(4)
+        self.assertIsNone(values.first_free(1, 6, 5))
+        self.assertIsNone(values.first_free(1, 6, 1))
+
+
+class AddressAllocatorTest(SimpleTestCase):
+
+    def allocator(self, cidrs, used=(), taken=()):
+        return AddressAllocator(cidrs, ['10.0.0.128/25'], lambda: used,
+                                lambda addr: addr in taken)
+
+    def allocate_all(self, allocator, *args):
+        addrs = []
+        while True:
+            addr = allocator.allocate(*args)
+            if addr is None:
+                return addrs
+            addrs.append(addr)
+
+    def test_network_and_broadcast_excluded(self):
+        allocator = self.allocator(['10.0.0.0/24'])
+        addrs = self.allocate_all(allocator, [])
+        self.assertEqual(sorted(addrs, key=IPAddress),
+                         ['10.0.0.%d' % i for i in range(1, 127)])
+
+    def test_excluded_cidrs(self):
+        allocator = self.allocator(['10.0.0.0/24'], used=['10.0.0.1'])
+        addrs = self.allocate_all(allocator, ['10.0.0.0/26', ''],
+                                  ['10.0.0.96/27'])
+        # Each sub-CIDR left skips its own network and broadcast address
+        self.assertEqual(sorted(addrs, key=IPAddress),
+                         ['10.0.0.%d' % i for i in range(65, 95)])
+
+    def test_adjacent_to_client(self):
+        allocator = self.allocator(['10.0.0.0/24'])
+        self.assertEqual(allocator.allocate([], [], '10.0.0.10'),
+                         '10.0.0.11')
+        self.assertEqual(allocator.allocate([], [], '10.0.0.10'),
+                         '10.0.0.12')
+        allocator.release('10.0.0.11')
+        self.assertEqual(allocator.allocate([], [], '10.0.0.10'),
+                         '10.0.0.11')
+
+    def test_in_use_fallback(self):
+        taken = set('10.0.0.%d' % i for i in range(2, 6))
+        allocator = self.allocator(['10.0.0.0/24'], taken=taken)
+        self.assertEqual(allocator.allocate([], [], '10.0.0.1'),
+                         '10.0.0.6')
+        # Addresses found in use stay reserved
+        for addr in taken:
+            self.assertIn(int(IPAddress(addr)), allocator.used)
+        allocator.reset()
+        self.assertEqual(len(allocator.used), 0)
+
+
+def in_netns():
+    """Whether tests run in a network namespace other than init's"""
+    try:
+        return (os.readlink('/proc/self/ns/net') !=
+                os.readlink('/proc/1/ns/net'))
+    except OSError:
+        return False
+
+
+def has_command(name):
+    return any(os.access(os.path.join(path, name), os.X_OK)
+               for path in os.environ.get('PATH', '').split(os.pathsep))
+
+
+class FakeOpenVPNManager(object):
+    """Bring tunnel ifaces up and down the way openvpn@ units would, from
+    the `dev` and `ifconfig` options of their config"""
+
+    def __init__(self, conf_dir):
+        self.conf_dir = conf_dir
+        self.units = {}
+
+    def list_units(self, pattern):
+        return dict((unit, state) for unit, state in self.units.items()
+                    if unit == pattern)
+
+    def run_jobs(self, job, units):
+        for unit in units:
+            iface = unit[len('openvpn@'):-len('.service')]
+            if job in ('stop', 'restart'):
+                run(['ip', 'link', 'del', iface])
+            if job in ('start', 'restart'):
+                with open(os.path.join(self.conf_dir,
+                                       iface + '.conf')) as fobj:
+                    local, peer = re.search(r'^ifconfig (\S+) (\S+)$',
+                                            fobj.read(), re.M).groups()
+                run(['ip', 'tuntap', 'add', 'dev', iface, 'mode', 'tun'])
+                run(['ip', 'address', 'add', local, 'peer', peer,
+                     'dev', iface])
+                run(['ip', 'link', 'set', iface, 'up'])
+            self.units[unit] = 'inactive' if job == 'stop' else 'active'
+
+    def reload(self):
+        pass
+
+
+@override_settings(ROUTING_BACKEND='netlink', OPENVPN_CPU_AFFINITY=False,
+                   SHARED_SERVERS=0)
+class NetnsDriverTest(KernelStubMixin, TestCase):
+    """Start and stop tunnels for real, in a network namespace of their own
+
+    Run as root with e.g. `unshare -nm`, remounting /sys in the new mount
+    namespace so that it lists the namespace's interfaces."""
+
+    def setUp(self):
+        if os.geteuid() != 0 or not in_netns():
+            self.skipTest("Not running as root in a network namespace.")
+        super(NetnsDriverTest, self).setUp()
+        self.patch(tunnels, 'run', run)
+        conf_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, conf_dir)
+        for name in ('conf_path', 'key_path'):
+            self.patch(models.Tunnel, name, property(
+                lambda tun, ext='.' + name[:-5]: os.path.join(
+                    conf_dir, tun.name + ext)))
+        rt_tables = os.path.join(conf_dir, 'rt_tables')
+        with open(rt_tables, 'w') as fobj:
+            fobj.write('255\tlocal\n254\tmain\n253\tdefault\n')
+        self.patch(tunnels, 'rt_tables', tunnels.RTables(rt_tables))
+        self.patch(tunnels, 'OPENVPN_DROPIN',
+                   conf_dir + '/openvpn@%s.service.d/vpn-proxy.conf')
+        manager = FakeOpenVPNManager(conf_dir)
+        self.patch(tunnels, 'get_unit_manager', lambda: manager)
+
+    def assertRunning(self, tunnel):
+        iface = tunnel.iface
+        self.assertTrue(os.path.exists('/sys/class/net/%s' % iface))
+        self.assertIn('peer %s/32' % tunnel.client,
+                      run(['ip', 'address', 'show', 'dev', iface]))
+        self.assertIn('default dev %s' % iface,
+                      run(['ip', 'route', 'show', 'table', str(tunnel.id)]))
+        rules = run(['ip', 'rule', 'show'])
+        self.assertIn('from %s lookup %s' % (tunnel.server, tunnel.id),
+                      rules)
+        self.assertIn('fwmark %s lookup %s' % (hex(tunnel.id), tunnel.id),
+                      rules)
+
+    def assertStopped(self, tunnel):
+        self.assertFalse(os.path.exists('/sys/class/net/%s' % tunnel.iface))
+        self.assertNotIn('lookup %s' % tunnel.id, run(['ip', 'rule', 'show']))
+        self.assertNotIn(tunnel.rtable, tunnels.read_rtables())
+
+    def check_driver(self, driver):
+        tunnel = create_tunnel(['192.168.0.0/24'], driver=driver)
+        tunnels.start_tunnel(tunnel)
+        self.assertRunning(tunnel)
+        # Starting again leaves everything in place
+        tunnels.start_tunnel(tunnel)
+        self.assertRunning(tunnel)
+        tunnels.stop_tunnel(tunnel)
+        self.assertStopped(tunnel)
+        tunnels.stop_tunnel(tunnel)
+        self.assertStopped(tunnel)
+
+    def test_openvpn(self):
+        self.check_driver('openvpn')
+
+    def test_wireguard(self):
+        if not has_command('wg'):
+            self.skipTest("WireGuard tools not installed.")
+        self.check_driver('wireguard')
+
+
+class RecordingExecutor(object):
+    """Record the IP rule and route changes made through it"""
+
+    def __init__(self):
+        self.calls = []
+
+    def add_rule(self, rule):
+        self.calls.append(('add_rule', rule))
+
+    def del_rule(self, rule):
+        self.calls.append(('del_rule', rule))
+
+    def add_route(self, route):
+        self.calls.append(('add_route', route))
+
+    def del_route(self, route):
+        self.calls.append(('del_route', route))
+
+
+class StubKernelState(tunnels.KernelState):
+    """A snapshot of a host with the given rules and routes in place"""
+
+    def __init__(self, ip_rules=(), ip_routes=(), iptables=(), ipsets=None):
+        self.executor = RecordingExecutor()
+        self.lock = threading.RLock()
+        self._ip_rules = set(ip_rules)
+        self._ip_routes = set(ip_routes)
+        self._iptables = set(iptables)
+        self._ipsets = ipsets or {}
+        self._nftables = set()
+
+
+@override_settings(FIREWALL_BACKEND='iptables')
+class ReconcileTest(KernelStubMixin, TestCase):
+
+    def setUp(self):
+        super(ReconcileTest, self).setUp()
+        self.conf_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.conf_dir)
+        for name in ('conf_path', 'key_path'):
+            self.patch(models.Tunnel, name, property(
+                lambda tun, ext='.' + name[:-5]: os.path.join(
+                    self.conf_dir, tun.name + ext)))
+        self.patch(reconcile, 'glob', self)
+        rt_tables = os.path.join(self.conf_dir, 'rt_tables')
+        with open(rt_tables, 'w') as fobj:
+            fobj.write('255\tlocal\n254\tmain\n253\tdefault\n')
+        self.patch(tunnels, 'rt_tables', tunnels.RTables(rt_tables))
+        self.units, self.jobs = set(['client']), []
+        self.patch(reconcile, 'list_openvpn_units', lambda: self.units)
+        self.patch(reconcile, 'systemctl_openvpn',
+                   lambda job, ifaces: ifaces and self.jobs.append(
+                       (job, sorted(ifaces))))
+        self.patch(reconcile, 'wait_for_ifaces', lambda ifaces: set())
+        self.patch(reconcile, 'list_wireguard_links', lambda: set())
+        self.patch(reconcile, 'check_rp_filter', lambda path, iface: None)
+        self.patch(reconcile, 'check_tc', lambda tunnel: None)
+        self.tunnel = create_tunnel(['192.168.0.0/24'])
+        self.forwarding = Forwarding(tunnel=self.tunnel,
+                                     dst_addr='192.168.0.10', dst_port=22,
+                                     loc_port=pick_port())
+        self.forwarding.save()
+        del self.commands[:], self.inputs[:]
+
+    def glob(self, pattern):
+        """Look for config files in the temporary directory instead"""
+        for prefix in ('/etc/openvpn/', '/etc/wireguard/',
+                       os.path.join(settings.PKI_DIR, 'ccd') + '/'):
+            if pattern.startswith(prefix):
+                return glob.glob(os.path.join(self.conf_dir,
+                                              pattern[len(prefix):]))
+        return []
+
+    def reconcile(self, state, dry_run=False):
+        with kernel_state(state):
+            return reconcile.reconcile(dry_run=dry_run)
+
+    def reconciled_state(self):
+        """Return a stub snapshot with everything the DB requires in place,
+        along with unmanaged rules and routes"""
+        tunnel, name = self.tunnel, self.tunnel.name
+        for path, data in ((tunnel.conf_path, tunnel.conf),
+                           (tunnel.key_path, tunnel.key)):
+            with open(path, 'w') as fobj:
+                fobj.write(data)
+        tunnels.add_rtable(tunnel.id, tunnel.rtable)
+        self.units.add(name)
+        iptables = set([
+            ('nat', 'POSTROUTING', ('-o', 'eth0', '-j', 'MASQUERADE')),
+            ('filter', 'INPUT', ('-s', tunnels.SOURCE_CIDRS[0],
+                                 '-j', 'ACCEPT')),
+        ])
+        for rules in tunnels.get_iptables_rules(self.forwarding).values():
+            iptables.update(rules)
+        for rules in tunnels.get_tunnel_iptables_rules(tunnel).values():
+            iptables.update(rules)
+        ipsets = {tunnels.IPSET_SOURCES: set(tunnels.SOURCE_CIDRS),
+                  name: set([str(self.forwarding.loc_port)])}
+        return StubKernelState(
+            ip_rules=[('all', None, 'main'),
+                      (tunnel.server, None, tunnel.rtable),
+                      ('all', hex(tunnel.id), tunnel.rtable)],
+            ip_routes=[('eth0', 'main', '192.168.1.1'),
+                       (name, tunnel.rtable, None)],
+            iptables=iptables, ipsets=ipsets)
+
+    def drift(self, report):
+        return dict((kind, (counts['missing'], counts['extra']))
+                    for kind, counts in report['drift'].items()
+                    if counts['missing'] or counts['extra'])
+
+    def test_from_scratch(self):
+        state = StubKernelState()
+        report = self.reconcile(state)
+        self.assertEqual(report['errors'], 0)
+        self.assertEqual(self.drift(report), {
+            'files': (2, 0), 'units': (1, 0), 'rtables': (1, 0),
+            'ip_rules': (2, 0), 'ip_routes': (1, 0), 'iptables': (5, 0),
+            'ipsets': (4, 0)})
+        self.assertEqual(self.jobs, [('start', [self.tunnel.name])])
+        self.assertEqual(sorted(self.reconcile(
+            self.reconciled_state(), dry_run=True)['drift'].values()),
+            [{'missing': 0, 'extra': 0}] * len(reconcile.RESOURCES))
+
+    def test_reconciled(self):
+        state = self.reconciled_state()
+        report = self.reconcile(state)
+        self.assertEqual((self.drift(report), report['errors']), ({}, 0))
+        self.assertEqual(self.jobs, [])
+        self.assertEqual(state.executor.calls, [])
+        self.assertEqual(self.commands, [])
+
+    def test_restart_on_changed_files_only(self):
+        state = self.reconciled_state()
+        with open(self.tunnel.conf_path, 'a') as fobj:
+            fobj.write('verb 9\n')
+        report = self.reconcile(state)
+        self.assertEqual(self.drift(report), {'files': (1, 0),
+                                              'ip_routes': (1, 0)})
+        self.assertEqual(self.jobs, [('restart', [self.tunnel.name])])
+        with open(self.tunnel.conf_path) as fobj:
+            self.assertEqual(fobj.read(), self.tunnel.conf)
+        # Restarting flushes the tunnel's routes, which are added again
+        self.assertEqual(state.executor.calls, [
+            ('add_route', (self.tunnel.name, self.tunnel.rtable, None))])
+
+    def test_readd_missing_rules_and_routes(self):
+        state = self.reconciled_state()
+        tunnel = self.tunnel
+        state.ip_rules.discard(('all', hex(tunnel.id), tunnel.rtable))
+        state.ip_routes.clear()
+        report = self.reconcile(state)
+        self.assertEqual(self.drift(report), {'ip_rules': (1, 0),
+                                              'ip_routes': (1, 0)})
+        self.assertEqual(sorted(state.executor.calls), [
+            ('add_route', (tunnel.name, tunnel.rtable, None)),
+            ('add_rule', ('all', hex(tunnel.id), tunnel.rtable)),
+        ])
+        self.assertEqual(self.jobs, [])
+
+    def test_remove_legacy_and_stale(self):
+        state = self.reconciled_state()
+        legacy = set((table, chain, ('-s', tunnels.SOURCE_CIDRS[0]) + spec)
+                     for table, chain, spec
+                     in tunnels.get_legacy_iptables_rules(self.forwarding))
+        state.iptables.update(legacy)
+        state.ip_rules.add(('10.0.0.99', None, 'rt_vpn-tun99'))
+        self.units.add('vpn-tun99')
+        report = self.reconcile(state)
+        self.assertEqual(self.drift(report), {
+            'iptables': (0, 3), 'ip_rules': (0, 1), 'units': (0, 1)})
+        self.assertEqual(self.jobs, [('stop', ['vpn-tun99'])])
+        self.assertEqual(state.executor.calls, [
+            ('del_rule', ('10.0.0.99', None, 'rt_vpn-tun99'))])
+        restore = self.inputs[self.commands.index(
+            ['iptables-restore', '--noflush'])]
+        deleted = set(line for line in restore.splitlines()
+                      if line.startswith('-D '))
+        self.assertEqual(deleted, set(' '.join(('-D', chain) + spec)
+                                      for table, chain, spec in legacy))
+        # Unmanaged rules, routes and units are left alone
+        self.assertNotIn('-j ACCEPT', restore)
+        self.assertNotIn('-o eth0', restore)
+
+    def test_dry_run(self):
+        state = StubKernelState()
+        report = self.reconcile(state, dry_run=True)
+        self.assertEqual(self.drift(report)['units'], (1, 0))
+        self.assertEqual(report['errors'], 0)
+        self.assertEqual(self.commands, [])
+        self.assertEqual(self.jobs, [])
+        self.assertEqual(state.executor.calls, [])
+        self.assertEqual(os.listdir(self.conf_dir), ['rt_tables'])
+        self.assertNotIn(self.tunnel.rtable, tunnels.read_rtables())
+
+
+@override_settings(FIREWALL_BACKEND='iptables', ROUTING_BACKEND='iproute2')
+class ResetTunnelsTest(KernelStubMixin, TransactionTestCase):
+
+    def setUp(self):
+        super(ResetTunnelsTest, self).setUp()
+        self.tunnels = []
+        for i in range(8):
+            tunnel = create_tunnel(['192.168.0.0/24'])
+            for port in (22, 80):
+                Forwarding(tunnel=tunnel, dst_addr='192.168.0.10',
+                           dst_port=port, loc_port=pick_port()).save()
+            self.tunnels.append(tunnel)
+        self.patch(models, 'start_tunnel', self.start_tunnel)
+        self.patch(reset_tunnels, 'ThreadPool', self.thread_pool)
+        del self.commands[:], self.inputs[:]
+
+    def thread_pool(self, jobs):
+        """Let the workers use the in-memory test database"""
+        connection = connections['default']
+        self.patch(connection, 'allow_thread_sharing', True)
+
+        def share_connection():
+            connections['default'] = connection
+
+        return ThreadPool(jobs, share_connection)
+
+    def start_tunnel(self, tunnel):
+        """Change the shared snapshot the way starting a tunnel does"""
+        tunnels.add_ip_rule(tunnel.server, tunnel.rtable)
+        tunnels.add_fwmark(tunnel)
+        tunnels.get_kernel_state().forget_iface(tunnel.iface)
+        tunnels.add_ip_route(tunnel.iface, tunnel.rtable)
+
+    def test_parallel_reset(self):
+        stdout = StringIO()
+        call_command('reset_tunnels', jobs=4, stdout=stdout)
+        self.assertIn('Reset 8 tunnels with 4 jobs', stdout.getvalue())
+        commands = [' '.join(cmd) for cmd in self.commands]
+        # The snapshot is listed and the batch committed once
+        for cmd in LISTINGS:
+            self.assertEqual(commands.count(cmd), 1, cmd)
+        self.assertEqual(commands.count('iptables-restore --noflush'), 1)
+        for tunnel in self.tunnels:
+            for cmd in ('ip rule add from %s table %s' % (tunnel.server,
+                                                          tunnel.rtable),
+                        'ip rule add from all fwmark %s table %s' % (
+                            hex(tunnel.id), tunnel.rtable),
+                        'ip route add default dev %s table %s' % (
+                            tunnel.iface, tunnel.rtable)):
+                self.assertEqual(commands.count(cmd), 1, cmd)
+        restore = self.inputs[commands.index('iptables-restore --noflush')]
+        self.assertEqual(len([line for line in restore.splitlines()
+                              if '-j DNAT' in line]), 16)
+        self.assertEqual(len([line for line in restore.splitlines()
+                              if line.startswith(':')]), 8)
@@ -2,27 +2,57 @@ from django.conf import settings
 
 import os
 import re
+import glob
+import time
+import fcntl
+import shutil
+import base64
 import logging
+import binascii
 import tempfile
+import threading
+import fnmatch
+import contextlib
 import subprocess
+import multiprocessing
 
+from netaddr import IPAddress, IPNetwork
 
-SOURCE_CIDRS = ','.join(settings.SOURCE_CIDRS)
+from . import netlink
+from . import systemd
+
+
+SOURCE_CIDRS = [str(IPNetwork(cidr).cidr) for cidr in settings.SOURCE_CIDRS]
 
 
 log = logging.getLogger(__name__)
 
+_local = threading.local()
+
 
-def run(cmd, shell=False, verbosity=1):
-    """Run given command and return output"""
+def run(cmd, shell=False, verbosity=1, data=None):
+    """Run given command and return output
+
+    If `data` is given, it is written to the command's standard input
+    """
     _cmd = ' '.join(cmd) if not isinstance(cmd, basestring) else cmd
     if verbosity > 1:
         log.info("Running command '%s'.", _cmd)
     elif verbosity > 0:
         log.debug("Running command '%s'.", _cmd)
     try:
-        output = subprocess.check_output(cmd, shell=shell,
-                                         stderr=subprocess.STDOUT)
+        if data is None:
+            output = subprocess.check_output(cmd, shell=shell,
+                                             stderr=subprocess.STDOUT)
+        else:
+            proc = subprocess.Popen(cmd, shell=shell,
+                                    stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT)
+            output = proc.communicate(data)[0]
+            if proc.returncode:
+                raise subprocess.CalledProcessError(proc.returncode, cmd,
+                                                    output=output)
     except subprocess.CalledProcessError as exc:
         log.error(u"Command '%s' exited with %d. Output was:\n%s",
                   _cmd, exc.returncode, exc.output)
@@ -68,14 +98,153 @@ def remove_file(path, name='file'):
     return False
 
 
+@contextlib.contextmanager
+def file_lock(name):
+    """Hold an exclusive lock named `name` for the duration of the block
+
+    Locks are flock'ed files in settings.LOCK_DIR, so they serialize both
+    threads and processes, e.g. API workers and management commands."""
+    if not os.path.isdir(settings.LOCK_DIR):
+        try:
+            os.makedirs(settings.LOCK_DIR)
+        except OSError:
+            if not os.path.isdir(settings.LOCK_DIR):
+                raise
+    with open(os.path.join(settings.LOCK_DIR, '%s.lock' % name), 'a') as fobj:
+        fcntl.flock(fobj, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fobj, fcntl.LOCK_UN)
+
+
+def tunnel_lock(tunnel):
+    """Serialize configuring `tunnel`"""
+    return file_lock(tunnel.name)
+
+
 def gen_key():
-    """Generate and return an OpenVPN static key"""
-    path = tempfile.mkstemp()[1]
-    run(['/usr/sbin/openvpn', '--genkey', '--secret', path])
-    with open(path) as fobj:
-        key = fobj.read()
-    os.unlink(path)
-    return key
+    """Generate and return an OpenVPN static key
+
+    The key consists of 2048 random bits, formatted the way `openvpn
+    --genkey` does, without forking openvpn or writing a temp file"""
+    data = binascii.hexlify(os.urandom(256))
+    lines = [data[i:i + 32] for i in xrange(0, len(data), 32)]
+    return '\n'.join(['#', '# 2048 bit OpenVPN static key', '#',
+                      '-----BEGIN OpenVPN Static key V1-----'] + lines +
+                     ['-----END OpenVPN Static key V1-----', ''])
+
+
+_P = 2 ** 255 - 19
+
+
+def _x25519(scalar, point):
+    """Return the X25519 function of 32 byte strings `scalar` and `point`,
+    as specified in RFC 7748"""
+    k = bytearray(scalar)
+    k[0] &= 248
+    k[31] &= 127
+    k[31] |= 64
+    k = int(binascii.hexlify(bytes(k[::-1])), 16)
+    x1 = int(binascii.hexlify(bytes(bytearray(point)[::-1])), 16)
+    x1 &= (1 << 255) - 1
+    x2, z2, x3, z3, swap = 1, 0, x1, 1, 0
+    for t in reversed(xrange(255)):
+        bit = (k >> t) & 1
+        if swap ^ bit:
+            x2, x3, z2, z3 = x3, x2, z3, z2
+        swap = bit
+        a, b = x2 + z2, x2 - z2
+        aa, bb = a * a % _P, b * b % _P
+        e = aa - bb
+        c, d = x3 + z3, x3 - z3
+        da, cb = d * a % _P, c * b % _P
+        x3 = (da + cb) ** 2 % _P
+        z3 = x1 * (da - cb) ** 2 % _P
+        x2 = aa * bb % _P
+        z2 = e * (aa + 121665 * e) % _P
+    if swap:
+        x2, z2 = x3, z3
+    x2 = x2 * pow(z2, _P - 2, _P) % _P
+    return binascii.unhexlify('%064x' % x2)[::-1]
+
+
+def wireguard_pubkey(private_key):
+    """Return the base64 public key of a base64 WireGuard private key"""
+    return base64.b64encode(_x25519(base64.b64decode(private_key),
+                                    b'\x09' + b'\x00' * 31))
+
+
+def gen_wireguard_key():
+    """Generate and return the server's and the client's private key of a
+    WireGuard tunnel, one per line, the way `wg genkey` does"""
+    keys = []
+    for _ in range(2):
+        key = bytearray(os.urandom(32))
+        key[0] &= 248
+        key[31] &= 127
+        key[31] |= 64
+        keys.append(base64.b64encode(bytes(key)))
+    return '\n'.join(keys)
+
+
+class SystemctlManager(object):
+    """Control systemd units by running `systemctl`"""
+
+    def list_units(self, pattern):
+        """Return a dict of the active state of loaded units matching
+        `pattern` by name"""
+        units = {}
+        output = run(['systemctl', 'list-units', '--all', '--plain',
+                      '--no-legend', pattern], verbosity=0)
+        for line in output.splitlines():
+            parts = line.split()
+            # Some versions prefix failed units with a bullet, even with
+            # --plain, so skip to the column of the unit's name
+            while parts and not fnmatch.fnmatch(parts[0], pattern):
+                parts.pop(0)
+            if len(parts) > 2:
+                units[parts[0]] = parts[2]
+        return units
+
+    def run_jobs(self, job, units):
+        run(['systemctl', job] + sorted(units))
+
+    def reload(self):
+        run(['systemctl', 'daemon-reload'])
+
+
+class DBusManager(object):
+    """Control systemd units over D-Bus, without forking `systemctl`
+
+    Units are listed with a single ListUnits call and jobs for many units
+    are queued at once and waited for together."""
+
+    def list_units(self, pattern):
+        return dict((unit, state)
+                    for unit, state in systemd.list_units().items()
+                    if fnmatch.fnmatch(unit, pattern))
+
+    def run_jobs(self, job, units):
+        systemd.run_jobs(job, sorted(units))
+
+    def reload(self):
+        systemd.reload()
+
+
+UNIT_MANAGERS = {
+    'systemctl': SystemctlManager,
+    'dbus': DBusManager,
+}
+
+
+def get_unit_manager():
+    """Return the manager selected by settings.SYSTEMD_BACKEND"""
+    return UNIT_MANAGERS[settings.SYSTEMD_BACKEND]()
+
+
+def _openvpn_unit(iface):
+    return 'openvpn@%s.service' % iface
 
 
 def start_openvpn(iface, force=True):
@@ -83,126 +252,732 @@ def start_openvpn(iface, force=True):
 
     Use `force` to restart anyways
     """
-    try:
-        run(['systemctl', 'status', 'openvpn@%s' % iface], verbosity=0)
+    manager, unit = get_unit_manager(), _openvpn_unit(iface)
+    if manager.list_units(unit).get(unit) == 'active':
         if force:
             log.info("Restarting OpenVPN server for %s.", iface)
-            run(['systemctl', 'restart', 'openvpn@%s' % iface])
+            manager.run_jobs('restart', [unit])
         else:
             log.debug("OpenVPN server for %s already running.", iface)
             return False
-    except subprocess.CalledProcessError:
+    else:
         log.info("OpenVPN server for %s not running, starting.", iface)
-        run(['systemctl', 'start', 'openvpn@%s' % iface])
+        manager.run_jobs('start', [unit])
+    get_kernel_state().forget_iface(iface)
     return True
 
 
 def stop_openvpn(iface):
     """Stop OpenVPN for given iface if running, return True if changed"""
-    try:
-        run(['systemctl', 'status', 'openvpn@%s' % iface], verbosity=0)
-        log.info("OpenVPN server for %s is running, stopping.", iface)
-        run(['systemctl', 'stop', 'openvpn@%s' % iface])
-    except subprocess.CalledProcessError:
+    manager, unit = get_unit_manager(), _openvpn_unit(iface)
+    if manager.list_units(unit).get(unit) != 'active':
         log.debug("OpenVPN server for %s already stopped.", iface)
         return False
+    log.info("OpenVPN server for %s is running, stopping.", iface)
+    manager.run_jobs('stop', [unit])
+    get_kernel_state().forget_iface(iface)
     return True
 
 
-def add_rtable(index, rtable):
-    """Add custom rtable with given index, return True if changed"""
-    regex = re.compile(r'^(\d+)\s*([^\s]+)\s*$')
-    with open('/etc/iproute2/rt_tables', 'r') as fobj:
-        lines, conflicts = [], []
-        for line in fobj.readlines():
-            match = regex.match(line)
-            if match:
-                _index, _rtable = match.groups()
-                if _index == str(index) or _rtable == rtable:
-                    conflicts.append((_index, _rtable))
-                    continue
-            lines.append(line)
-    if len(conflicts) == 1 and conflicts[0] == (str(index), rtable):
-        log.debug("Routing table %s already created.", rtable)
+def list_openvpn_units():
+    """Return the set of ifaces whose OpenVPN unit is active"""
+    return set(unit[len('openvpn@'):-len('.service')]
+               for unit, state in
+               get_unit_manager().list_units('openvpn@*').items()
+               if state == 'active')
+
+
+def list_wireguard_links():
+    """Return the set of WireGuard ifaces"""
+    ifaces = set()
+    output = run(['ip', '-o', 'link', 'show', 'type', 'wireguard'],
+                 verbosity=0)
+    for line in output.splitlines():
+        parts = line.split()
+        if len(parts) > 1:
+            ifaces.add(parts[1].rstrip(':').split('@')[0])
+    return ifaces
+
+
+def del_link(iface):
+    """Remove network interface if it exists, return True if changed"""
+    if not os.path.exists('/sys/class/net/%s' % iface):
+        log.debug("Interface %s already removed.", iface)
         return False
-    if conflicts:
-        log.warning("Creating rtable %s, removing conflicting lines: %s",
-                    rtable, conflicts)
-    else:
-        log.info("Creating rtable %s.", rtable)
-    lines.append('%s\t%s\n' % (index, rtable))
-    with open('/etc/iproute2/rt_tables', 'w') as fobj:
-        fobj.writelines(lines)
+    log.info("Removing interface %s.", iface)
+    run(['ip', 'link', 'del', iface])
+    get_kernel_state().forget_iface(iface)
     return True
 
 
-def del_rtable(index, rtable):
-    """Delete custom rtable with given index, return True if changed"""
-    with open('/etc/iproute2/rt_tables', 'r') as fobj:
-        _lines = fobj.readlines()
-    regex = re.compile(r'^(%s)\s*(%s)\s*$' % (index, rtable))
-    lines = [line for line in _lines if not regex.match(line)]
-    if len(lines) == len(_lines):
-        log.debug("Routing table %s already removed.", rtable)
+def systemctl_openvpn(job, ifaces):
+    """Run systemctl `job` for the OpenVPN units of all `ifaces` at once"""
+    if not ifaces:
+        return False
+    log.info("Running %s for OpenVPN servers %s.", job,
+             ', '.join(sorted(ifaces)))
+    get_unit_manager().run_jobs(job, [_openvpn_unit(iface)
+                                      for iface in ifaces])
+    state = get_kernel_state()
+    for iface in ifaces:
+        state.forget_iface(iface)
+    return True
+
+
+def wait_for_ifaces(ifaces, timeout=10):
+    """Wait until all `ifaces` exist, return the ones still missing"""
+    deadline = time.time() + timeout
+    missing = set(ifaces)
+    while missing:
+        missing = set(iface for iface in missing
+                      if not os.path.exists('/sys/class/net/%s' % iface))
+        if not missing or time.time() > deadline:
+            break
+        time.sleep(0.1)
+    if missing:
+        log.warning("Timed out waiting for interfaces %s.",
+                    ', '.join(sorted(missing)))
+    return missing
+
+
+# systemd drop-in, per OpenVPN unit, pinning the server to a CPU
+OPENVPN_DROPIN = '/etc/systemd/system/openvpn@%s.service.d/vpn-proxy.conf'
+
+
+def list_openvpn_processes():
+    """Return a dict of the pids of running OpenVPN servers by iface
+
+    Servers are found in /proc by the config file they were started with,
+    the way openvpn@ units start them. Only vpn-proxy's own servers, named
+    after its tunnel and shared server ifaces, are returned."""
+    regex = re.compile(r'^(?:%s|%s)\d+$' % (
+        re.escape(settings.IFACE_PREFIX),
+        re.escape(settings.SHARED_IFACE_PREFIX)))
+    pids = {}
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open('/proc/%s/cmdline' % pid) as fobj:
+                args = fobj.read().split('\0')
+        except IOError:
+            # The process has exited
+            continue
+        if os.path.basename(args[0]) != 'openvpn':
+            continue
+        for opt, value in zip(args, args[1:]):
+            if opt == '--config':
+                iface = os.path.splitext(os.path.basename(value))[0]
+                if regex.match(iface):
+                    pids[iface] = int(pid)
+    return pids
+
+
+def get_cpu_times(pids):
+    """Return a dict of (CPU seconds used, seconds running) tuples by pid"""
+    ticks = float(os.sysconf('SC_CLK_TCK'))
+    with open('/proc/uptime') as fobj:
+        uptime = float(fobj.read().split()[0])
+    times = {}
+    for pid in pids:
+        try:
+            with open('/proc/%s/stat' % pid) as fobj:
+                # The command name may contain spaces and parentheses
+                fields = fobj.read().rsplit(')', 1)[1].split()
+        except IOError:
+            continue
+        # utime, stime and starttime, the 14th, 15th and 22nd fields
+        times[pid] = ((int(fields[11]) + int(fields[12])) / ticks,
+                      uptime - int(fields[19]) / ticks)
+    return times
+
+
+def get_openvpn_load(interval=None):
+    """Return the share of a CPU each running OpenVPN server uses by iface
+
+    The load is sampled over `interval` seconds, if given, otherwise it's
+    averaged over the lifetime of each server."""
+    pids = list_openvpn_processes()
+    before = get_cpu_times(pids.values())
+    after = {}
+    if interval:
+        time.sleep(interval)
+        after = get_cpu_times(pids.values())
+    load = {}
+    for iface, pid in pids.items():
+        if pid not in before:
+            continue
+        if interval:
+            if pid in after:
+                load[iface] = (after[pid][0] - before[pid][0]) / interval
+        else:
+            cpu, elapsed = before[pid]
+            load[iface] = cpu / elapsed if elapsed > 0 else 0.0
+    return load
+
+
+def get_openvpn_cpus():
+    """Return the CPUs OpenVPN servers may be pinned to"""
+    if settings.OPENVPN_CPUS:
+        return list(settings.OPENVPN_CPUS)
+    return range(multiprocessing.cpu_count())
+
+
+def read_openvpn_affinity():
+    """Return a dict of the CPU each OpenVPN server is pinned to by iface"""
+    prefix, suffix = OPENVPN_DROPIN.split('%s')
+    affinity = {}
+    for path in glob.glob(OPENVPN_DROPIN % '*'):
+        with open(path) as fobj:
+            match = re.search(r'^CPUAffinity=(\d+)$', fobj.read(), re.M)
+        if match:
+            affinity[path[len(prefix):-len(suffix)]] = int(match.group(1))
+    return affinity
+
+
+def place_openvpn(loads, cpus, current={}):
+    """Spread OpenVPN servers over `cpus` by their `loads`
+
+    Servers are placed busiest first, each on the CPU with the least load
+    and servers so far, preferring its `current` CPU on ties. Return a dict
+    of the CPU of each iface."""
+    totals = dict((cpu, [0.0, 0]) for cpu in cpus)
+    placement = {}
+    for iface in sorted(loads, key=lambda iface: (-loads[iface], iface)):
+        cpu = min(cpus, key=lambda cpu: (totals[cpu],
+                                         cpu != current.get(iface)))
+        totals[cpu][0] += loads[iface]
+        totals[cpu][1] += 1
+        placement[iface] = cpu
+    return placement
+
+
+def choose_openvpn_cpu(iface):
+    """Return the CPU least loaded by the other pinned OpenVPN servers"""
+    cpus = get_openvpn_cpus()
+    loads = get_openvpn_load()
+    totals = dict((cpu, [0.0, 0]) for cpu in cpus)
+    for other, cpu in read_openvpn_affinity().items():
+        if other != iface and cpu in totals:
+            totals[cpu][0] += loads.get(other, 0.0)
+            totals[cpu][1] += 1
+    return min(cpus, key=lambda cpu: totals[cpu])
+
+
+def get_openvpn_dropin(cpu):
+    lines = ['[Service]', 'CPUAffinity=%s' % cpu]
+    if settings.OPENVPN_NICE is not None:
+        lines.append('Nice=%s' % settings.OPENVPN_NICE)
+    return '\n'.join(lines + [''])
+
+
+def pin_openvpn(iface, cpu, pid=None):
+    """Pin the OpenVPN server of `iface` to `cpu`, return True if changed
+
+    The systemd drop-in takes effect once systemd is reloaded and the unit
+    (re)started, so the server's running process `pid`, if any, is pinned
+    and reniced in place as well."""
+    path = OPENVPN_DROPIN % iface
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    if not write_file(path, get_openvpn_dropin(cpu), 'systemd drop-in'):
         return False
-    log.info("Removing routing table %s.", rtable)
-    with open('/etc/iproute2/rt_tables', 'w') as fobj:
-        fobj.writelines(lines)
+    if pid:
+        log.info("Pinning OpenVPN server for %s to CPU %s.", iface, cpu)
+        run(['taskset', '-a', '-c', '-p', str(cpu), str(pid)])
+        if settings.OPENVPN_NICE is not None:
+            run(['renice', '-n', str(settings.OPENVPN_NICE), '-p', str(pid)])
     return True
 
 
+def unpin_openvpn(iface):
+    """Remove the systemd drop-in of `iface`, return True if changed"""
+    path = OPENVPN_DROPIN % iface
+    changed = remove_file(path, 'systemd drop-in')
+    if os.path.isdir(os.path.dirname(path)):
+        try:
+            os.rmdir(os.path.dirname(path))
+        except OSError:
+            # Other drop-ins are left alone
+            pass
+    return changed
+
+
+def ensure_openvpn_pinned(iface):
+    """Pin the OpenVPN server of `iface` to its CPU, choosing one if it
+    isn't pinned yet, and reload systemd if changed
+
+    Servers with an up to date drop-in are left alone, without looking for
+    their process or reloading systemd, since they were pinned when it was
+    written."""
+    with file_lock('cpu_affinity'):
+        try:
+            with open(OPENVPN_DROPIN % iface) as fobj:
+                dropin = fobj.read()
+        except IOError:
+            dropin = ''
+        match = re.search(r'^CPUAffinity=(\d+)$', dropin, re.M)
+        if match:
+            cpu = int(match.group(1))
+            if dropin == get_openvpn_dropin(cpu):
+                log.debug("OpenVPN server for %s already pinned to CPU %s.",
+                          iface, cpu)
+                return False
+        else:
+            cpu = choose_openvpn_cpu(iface)
+        if pin_openvpn(iface, cpu, list_openvpn_processes().get(iface)):
+            get_unit_manager().reload()
+            return True
+    return False
+
+
+def rebalance_openvpn(interval=1.0, dry_run=False):
+    """Re-pin running OpenVPN servers to spread their load evenly
+
+    The load of each server is sampled over `interval` seconds. Return a
+    list of (iface, old CPU, new CPU, load) tuples of the servers moved."""
+    with file_lock('cpu_affinity'):
+        loads = get_openvpn_load(interval)
+        current = read_openvpn_affinity()
+        placement = place_openvpn(loads, get_openvpn_cpus(), current)
+        pids = list_openvpn_processes()
+        moves = []
+        for iface, cpu in sorted(placement.items()):
+            if current.get(iface) == cpu:
+                continue
+            moves.append((iface, current.get(iface), cpu, loads[iface]))
+            if not dry_run:
+                pin_openvpn(iface, cpu, pids.get(iface))
+        if moves and not dry_run:
+            get_unit_manager().reload()
+    return moves
+
+
+class RTables(object):
+    """Index of the routing tables defined in /etc/iproute2/rt_tables
+
+    The file is parsed once and the index is reused for as long as the file
+    remains unchanged. Edits are applied in batches under the `rt_tables`
+    lock and written to a temp file which is fsync'ed and renamed over the
+    original, so that readers never see a partially written file. Nothing
+    is written if the edits don't change anything.
+
+    """
+
+    REGEX = re.compile(r'^(\d+)\s*([^\s]+)\s*$')
+    BUILTIN = {'local': 255, 'main': 254, 'default': 253, 'unspec': 0}
+
+    def __init__(self, path='/etc/iproute2/rt_tables'):
+        self.path = path
+        self.lock = threading.Lock()
+        self.lines = []
+        self.indexes = {}
+        self._stat = None
+
+    def _fingerprint(self):
+        stat = os.stat(self.path)
+        return stat.st_ino, stat.st_mtime, stat.st_size
+
+    def load(self):
+        """Parse the file, unless unchanged since it was last parsed"""
+        with self.lock:
+            fingerprint = self._fingerprint()
+            if fingerprint == self._stat:
+                return
+            with open(self.path, 'r') as fobj:
+                lines = fobj.readlines()
+            indexes = {}
+            for line in lines:
+                match = self.REGEX.match(line)
+                if match:
+                    indexes[match.group(2)] = int(match.group(1))
+            self.lines, self.indexes, self._stat = lines, indexes, fingerprint
+
+    def read(self):
+        """Return a dict mapping routing table names to their indexes"""
+        self.load()
+        rtables = dict(self.BUILTIN)
+        rtables.update(self.indexes)
+        return rtables
+
+    def _write(self, lines):
+        fd, path = tempfile.mkstemp(dir=os.path.dirname(self.path),
+                                    prefix='.rt_tables.')
+        try:
+            with os.fdopen(fd, 'w') as fobj:
+                fobj.writelines(lines)
+                fobj.flush()
+                os.fsync(fobj.fileno())
+            os.chmod(path, os.stat(self.path).st_mode & 0o777)
+            os.rename(path, self.path)
+        except:
+            if os.path.exists(path):
+                os.unlink(path)
+            raise
+
+    def edit(self, add=(), remove=()):
+        """Add and remove (index, rtable) entries, return True if changed
+
+        Lines conflicting with added entries, by index or name, are
+        removed."""
+        add = set((int(index), rtable) for index, rtable in add)
+        remove = set((int(index), rtable) for index, rtable in remove)
+        if not add and not remove:
+            return False
+        with file_lock('rt_tables'):
+            self.load()
+            indexes = set(index for index, rtable in add)
+            rtables = set(rtable for index, rtable in add)
+            lines, present = [], set()
+            for line in self.lines:
+                match = self.REGEX.match(line)
+                if match:
+                    entry = (int(match.group(1)), match.group(2))
+                    if entry in remove:
+                        continue
+                    if entry in add:
+                        present.add(entry)
+                    elif entry[0] in indexes or entry[1] in rtables:
+                        log.warning("Removing conflicting rtable line: %s",
+                                    line.strip())
+                        continue
+                lines.append(line)
+            for index, rtable in sorted(add - present):
+                lines.append('%s\t%s\n' % (index, rtable))
+            if lines == self.lines:
+                log.debug("Routing tables already up to date.")
+                return False
+            log.info("Adding %d and removing %d routing tables.",
+                     len(add - present),
+                     len(self.lines) - len(lines) + len(add - present))
+            self._write(lines)
+            with self.lock:
+                self._stat = None
+            self.load()
+            return True
+
+
+rt_tables = RTables()
+
+
+def edit_rtables(add=(), remove=()):
+    """Add and remove (index, rtable) entries in a single write of
+    /etc/iproute2/rt_tables, return True if changed"""
+    return rt_tables.edit(add=add, remove=remove)
+
+
+def add_rtable(index, rtable):
+    """Add custom rtable with given index, return True if changed"""
+    return rt_tables.edit(add=[(index, rtable)])
+
+
+def del_rtable(index, rtable):
+    """Delete custom rtable with given index, return True if changed"""
+    return rt_tables.edit(remove=[(index, rtable)])
+
+
+def read_rtables():
+    """Return a dict mapping routing table names to their indexes"""
+    return rt_tables.read()
+
+
+def _parse_opts(parts, keys):
+    """Return a dict of the values following any of `keys` in `parts`"""
+    opts = {}
+    for key, value in zip(parts, parts[1:]):
+        if key in keys and key not in opts:
+            opts[key] = value
+    return opts
+
+
+class IPRouteExecutor(object):
+    """Manage IP rules and routes by running `ip`
+
+    Rules are represented as (src, fwmark, table) and routes as (iface,
+    table, gateway) tuples, the way `ip` prints them. `gateway` is None for
+    routes straight out of `iface`.
+
+    """
+
+    def list_rules(self):
+        """Return a set of (src, fwmark, table) tuples for all IP rules"""
+        rules = set()
+        for line in run(['ip', 'rule', 'list'], verbosity=0).splitlines():
+            opts = _parse_opts(line.split()[1:],
+                               ('from', 'fwmark', 'lookup'))
+            if 'lookup' in opts:
+                rules.add((opts.get('from'), opts.get('fwmark'),
+                           opts['lookup']))
+        return rules
+
+    def list_routes(self):
+        """Return a set of (iface, table, gateway) tuples for all default
+        routes"""
+        routes = set()
+        for line in run(['ip', '-4', 'route', 'list', 'table', 'all'],
+                        verbosity=0).splitlines():
+            parts = line.split()
+            if parts and parts[0] == 'default':
+                opts = _parse_opts(parts, ('via', 'dev', 'table'))
+                routes.add((opts.get('dev'), opts.get('table', 'main'),
+                            opts.get('via')))
+        return routes
+
+    def _rule_cmd(self, job, rule):
+        src, fwmark, table = rule
+        cmd = ['ip', 'rule', job]
+        if src is not None:
+            cmd += ['from', src]
+        if fwmark is not None:
+            cmd += ['fwmark', fwmark]
+        return cmd + ['table', table]
+
+    def add_rule(self, rule):
+        run(self._rule_cmd('add', rule), verbosity=2)
+
+    def del_rule(self, rule):
+        run(self._rule_cmd('del', rule), verbosity=2)
+
+    def _route_cmd(self, job, route):
+        iface, table, gateway = route
+        cmd = ['ip', 'route', job, 'default']
+        if gateway is not None:
+            cmd += ['via', gateway]
+        return cmd + ['dev', iface, 'table', table]
+
+    def add_route(self, route):
+        run(self._route_cmd('add', route), verbosity=2)
+
+    def del_route(self, route):
+        run(self._route_cmd('del', route), verbosity=2)
+
+
+class NetlinkExecutor(object):
+    """Manage IP rules and routes over rtnetlink, without forking `ip`
+
+    Accepts and returns the same tuples as `IPRouteExecutor`, translating
+    routing table names with /etc/iproute2/rt_tables.
+
+    """
+
+    def __init__(self):
+        self.load_rtables()
+
+    def load_rtables(self):
+        self.rtables = read_rtables()
+        self.rtable_names = dict((index, name)
+                                 for name, index in self.rtables.items())
+
+    def _index(self, table):
+        if table.isdigit():
+            return int(table)
+        if table not in self.rtables:
+            # The table may have just been added by `add_rtable`
+            self.load_rtables()
+        return self.rtables[table]
+
+    def _name(self, index):
+        return self.rtable_names.get(index, str(index))
+
+    def list_rules(self):
+        rules = set()
+        for rule in netlink.list_rules():
+            if rule['action'] != netlink.FR_ACT_TO_TBL:
+                continue
+            fwmark = rule['fwmark']
+            if fwmark is not None:
+                fwmark = hex(fwmark)
+                if rule['fwmask'] not in (None, 0xffffffff):
+                    fwmark += '/%s' % hex(rule['fwmask'])
+            rules.add((rule['src'] or 'all', fwmark,
+                       self._name(rule['table'])))
+        return rules
+
+    def list_routes(self):
+        return set((route['iface'], self._name(route['table']),
+                    route['gateway'])
+                   for route in netlink.list_routes()
+                   if route['dst_len'] == 0 and
+                   route['type'] == netlink.RTN_UNICAST)
+
+    def _rule_args(self, rule):
+        src, fwmark, table = rule
+        return {'table': self._index(table),
+                'src': src if src != 'all' else None,
+                'fwmark': int(fwmark, 16) if fwmark is not None else None}
+
+    def add_rule(self, rule):
+        log.debug("Adding IP rule %s over netlink.", rule)
+        netlink.add_rule(**self._rule_args(rule))
+
+    def del_rule(self, rule):
+        log.debug("Removing IP rule %s over netlink.", rule)
+        netlink.del_rule(**self._rule_args(rule))
+
+    def add_route(self, route):
+        log.debug("Adding IP route %s over netlink.", route)
+        netlink.add_route(route[0], self._index(route[1]), route[2])
+
+    def del_route(self, route):
+        log.debug("Removing IP route %s over netlink.", route)
+        netlink.del_route(route[0], self._index(route[1]), route[2])
+
+
+ROUTING_EXECUTORS = {
+    'iproute2': IPRouteExecutor,
+    'netlink': NetlinkExecutor,
+}
+
+
+def get_routing_executor():
+    """Return the executor selected by settings.ROUTING_BACKEND"""
+    return ROUTING_EXECUTORS[settings.ROUTING_BACKEND]()
+
+
+class KernelState(object):
+    """Snapshot of the IP rules, routes and firewall rules in place
+
+    The output of `ip rule`, `ip route`, `iptables-save`, `ipset save` and
+    `nft list` is each parsed once, when first needed, into a set or dict.
+    All checks are then answered from memory and the snapshot is updated as
+    changes are applied.
+
+    A snapshot may be shared by threads working on different tunnels, which
+    hold its `lock` while changing it.
+
+    """
+
+    def __init__(self):
+        self.executor = get_routing_executor()
+        # Held while changing the snapshot, which threads may share
+        self.lock = threading.RLock()
+        self._ip_rules = None
+        self._ip_routes = None
+        self._iptables = None
+        self._ipsets = None
+        self._nftables = None
+
+    @property
+    def ip_rules(self):
+        with self.lock:
+            if self._ip_rules is None:
+                self._ip_rules = self.executor.list_rules()
+        return self._ip_rules
+
+    @property
+    def ip_routes(self):
+        with self.lock:
+            if self._ip_routes is None:
+                self._ip_routes = self.executor.list_routes()
+        return self._ip_routes
+
+    @property
+    def iptables(self):
+        with self.lock:
+            if self._iptables is None:
+                self._iptables = list_iptables()
+        return self._iptables
+
+    @property
+    def ipsets(self):
+        with self.lock:
+            if self._ipsets is None:
+                self._ipsets = list_ipsets()
+        return self._ipsets
+
+    @property
+    def nftables(self):
+        with self.lock:
+            if self._nftables is None:
+                self._nftables = list_nftables()
+        return self._nftables
+
+    def forget_iface(self, iface):
+        """Drop routes via `iface`, since the kernel flushes them whenever
+        the device goes down"""
+        with self.lock:
+            if self._ip_routes is not None:
+                self._ip_routes.difference_update(
+                    [route for route in self._ip_routes
+                     if route[0] == iface])
+
+
+@contextlib.contextmanager
+def kernel_state(state=None):
+    """Answer all checks made within the block from a single snapshot
+
+    Nested blocks share the same snapshot. Pass `state` to share a snapshot
+    taken in another thread."""
+    _state = getattr(_local, 'kernel_state', None)
+    if _state is not None:
+        yield _state
+        return
+    state = _local.kernel_state = state or KernelState()
+    try:
+        yield state
+    finally:
+        _local.kernel_state = None
+
+
+def get_kernel_state():
+    """Return the active snapshot, or a fresh one if there is none"""
+    return getattr(_local, 'kernel_state', None) or KernelState()
+
+
 def check_ip_rule(server, rtable):
     """Check if IP rule for src address `server` to `rtable` exists"""
-    line = 'from %s lookup %s' % (server, rtable)
-    return line in run(['ip', 'rule', 'list'], verbosity=0)
+    return (server, None, rtable) in get_kernel_state().ip_rules
 
 
 def add_ip_rule(server, rtable):
-    if check_ip_rule(server, rtable):
+    state = get_kernel_state()
+    if (server, None, rtable) in state.ip_rules:
         log.debug("IP rule for %s already configured.", rtable)
         return False
     log.info("Adding IP rule for %s.", rtable)
-    run(['ip', 'rule', 'add', 'from', server, 'table', rtable], verbosity=2)
+    state.executor.add_rule((server, None, rtable))
+    with state.lock:
+        state.ip_rules.add((server, None, rtable))
     return True
 
 
 def del_ip_rule(server, rtable):
-    if not check_ip_rule(server, rtable):
+    state = get_kernel_state()
+    if (server, None, rtable) not in state.ip_rules:
         log.debug("IP rule for %s already removed.", rtable)
         return False
     log.info("Removing IP rule for %s.", rtable)
-    run(['ip', 'rule', 'del', 'from', server, 'table', rtable], verbosity=2)
+    state.executor.del_rule((server, None, rtable))
+    with state.lock:
+        state.ip_rules.discard((server, None, rtable))
     return True
 
 
-def check_ip_route(iface, rtable):
-    line = 'default dev %s' % iface
-    try:
-        return line in run(['ip', 'route', 'list', 'table', rtable],
-                           verbosity=0)
-    except subprocess.CalledProcessError:
-        return False
+def check_ip_route(iface, rtable, gateway=None):
+    return (iface, rtable, gateway) in get_kernel_state().ip_routes
 
 
-def add_ip_route(iface, rtable):
-    if check_ip_route(iface, rtable):
+def add_ip_route(iface, rtable, gateway=None):
+    state = get_kernel_state()
+    if (iface, rtable, gateway) in state.ip_routes:
         log.debug("IP route for %s already configured.", rtable)
         return False
     log.info("Adding IP route for %s.", rtable)
-    run(['ip', 'route', 'add', 'default',
-         'dev', iface, 'table', rtable],
-        verbosity=2)
+    state.executor.add_route((iface, rtable, gateway))
+    with state.lock:
+        state.ip_routes.add((iface, rtable, gateway))
     return True
 
 
-def del_ip_route(iface, rtable):
-    if not check_ip_route(iface, rtable):
+def del_ip_route(iface, rtable, gateway=None):
+    state = get_kernel_state()
+    if (iface, rtable, gateway) not in state.ip_routes:
         log.debug("IP route for %s already removed.", rtable)
         return False
     log.info("Removing IP route for %s.", rtable)
-    run(['ip', 'route', 'del', 'default',
-         'dev', iface, 'table', rtable],
-        verbosity=2)
+    state.executor.del_route((iface, rtable, gateway))
+    with state.lock:
+        state.ip_routes.discard((iface, rtable, gateway))
     return True
 
 
@@ -222,28 +997,211 @@ def check_rp_filter(path, iface):
             return False
 
 
-def get_conf(tunnel):
-    return '\n'.join(['dev %s' % tunnel.name,
-                      'dev-type tun',
-                      'port %s' % tunnel.port,
-                      'ifconfig %s %s' % (tunnel.server, tunnel.client),
-                      'secret %s' % tunnel.key_path,
-                      'proto %s' % tunnel.server_protocol])
+_TC_UNITS = {'': 0.001, 'K': 1, 'M': 1000, 'G': 1000000}
+
+
+# The minor of the HTB class of dedicated tunnels, which is the default
+# class of their interface, so that all traffic sent over it is shaped
+_TC_DEDICATED_MINOR = 1
+
+
+def _tc_classid(tunnel):
+    """The HTB class of `tunnel`
+
+    On the interfaces of shared servers, the minor is the offset of the
+    tunnel's client address in the server's network, which is unique among
+    the server's tunnels and, unlike the tunnel id, fits in the 16 bits of
+    the minor for networks up to a /16. Offsets 0 and 1, of the network and
+    the server, are never used, and larger ones are reduced into range."""
+    if tunnel.shared_server is None:
+        return '1:%x' % _TC_DEDICATED_MINOR
+    offset = (int(IPAddress(tunnel.client)) -
+              tunnel.shared_server.network.first)
+    return '1:%x' % (2 + (offset - 2) % 0xfffe)
+
+
+def get_tc_root(iface):
+    """Return the default class minor of the HTB root qdisc of `iface`, or
+    None if it has no such qdisc"""
+    output = run(['tc', 'qdisc', 'show', 'dev', iface, 'root'], verbosity=0)
+    # Older versions of tc print the default minor in hex without the 0x
+    match = re.search(r'qdisc htb 1: root .*?default (?:0x)?([0-9a-f]+)',
+                      output)
+    return int(match.group(1), 16) if match else None
+
+
+def get_tc_class(iface, classid):
+    """Return the (rate, ceil) in kbit/s of HTB class `classid` of `iface`,
+    or None if missing"""
+    output = run(['tc', 'class', 'show', 'dev', iface, 'classid', classid],
+                 verbosity=0)
+    match = re.search(r'rate (\d+(?:\.\d+)?)([KMG]?)bit '
+                      r'ceil (\d+(?:\.\d+)?)([KMG]?)bit', output)
+    if not match:
+        return None
+    rate, rate_unit, ceil, ceil_unit = match.groups()
+    return (int(round(float(rate) * _TC_UNITS[rate_unit])),
+            int(round(float(ceil) * _TC_UNITS[ceil_unit])))
+
+
+def add_tc(tunnel):
+    """Shape the traffic sent over `tunnel` to its rate and ceil, return
+    True if changed
+
+    Each tunnel gets an HTB class with an fq_codel qdisc, so its flows are
+    queued fairly. Dedicated interfaces have a single class, their default
+    one. On the interfaces of shared servers, which are shared with other
+    tunnels, traffic is classified by the tunnel's fwmark and the root
+    qdisc is only created if missing, since HTB can't be changed in
+    place."""
+    iface, classid = tunnel.iface, _tc_classid(tunnel)
+    rate, ceil = tunnel.rate or tunnel.ceil, tunnel.ceil or tunnel.rate
+    default = _TC_DEDICATED_MINOR if tunnel.shared_server is None else 0
+    root = get_tc_root(iface)
+    # Nothing else uses dedicated interfaces, their root may be recreated
+    stale = (tunnel.shared_server is None and root is not None and
+             root != default)
+    if (root is not None and not stale and
+            get_tc_class(iface, classid) == (rate, ceil)):
+        log.debug("Traffic of %s already shaped.", tunnel.name)
+        return False
+    log.info("Shaping traffic of %s to rate %s ceil %s kbit/s.",
+             tunnel.name, rate, ceil)
+    if stale:
+        run(['tc', 'qdisc', 'del', 'dev', iface, 'root'])
+        root = None
+    if root is None:
+        run(['tc', 'qdisc', 'replace', 'dev', iface, 'root', 'handle', '1:',
+             'htb', 'default', '%x' % default])
+    run(['tc', 'class', 'replace', 'dev', iface, 'parent', '1:', 'classid',
+         classid, 'htb', 'rate', '%skbit' % rate, 'ceil', '%skbit' % ceil])
+    run(['tc', 'qdisc', 'replace', 'dev', iface, 'parent', classid,
+         'fq_codel'])
+    if tunnel.shared_server is not None:
+        run(['tc', 'filter', 'replace', 'dev', iface, 'parent', '1:',
+             'protocol', 'ip', 'prio', '1', 'handle', str(tunnel.id), 'fw',
+             'classid', classid])
+    return True
 
 
-def get_client_conf(tunnel):
-    return '\n'.join(['remote %s' % settings.VPN_SERVER_REMOTE_ADDRESS,
-                      'dev %s' % tunnel.name,
-                      'dev-type tun',
-                      'port %s' % tunnel.port,
-                      'ifconfig %s %s' % (tunnel.client, tunnel.server),
-                      'secret %s' % tunnel.key_path,
-                      'proto %s' % tunnel.client_protocol,
-                      'keepalive 10 120'])
+def del_tc(tunnel):
+    """Stop shaping the traffic sent over `tunnel`, return True if changed"""
+    iface, classid = tunnel.iface, _tc_classid(tunnel)
+    if (not os.path.exists('/sys/class/net/%s' % iface) or
+            get_tc_class(iface, classid) is None):
+        log.debug("Traffic of %s already not shaped.", tunnel.name)
+        return False
+    log.info("Removing traffic shaping of %s.", tunnel.name)
+    if tunnel.shared_server is None:
+        run(['tc', 'qdisc', 'del', 'dev', iface, 'root'])
+    else:
+        run(['tc', 'filter', 'del', 'dev', iface, 'parent', '1:',
+             'protocol', 'ip', 'prio', '1', 'handle', str(tunnel.id), 'fw'])
+        run(['tc', 'class', 'del', 'dev', iface, 'classid', classid])
+    return True
 
 
-def get_client_script(tunnel):
-    return """#!/bin/bash
+def check_tc(tunnel):
+    """Shape `tunnel` if it has a rate or ceil, return True if changed"""
+    if tunnel.rate or tunnel.ceil:
+        return add_tc(tunnel)
+    return del_tc(tunnel)
+
+
+def _pki_path(name):
+    return os.path.join(settings.PKI_DIR, name)
+
+
+def _gen_cert(cn):
+    """Return a new private key and a certificate for it signed by the CA
+    of shared servers, both PEM encoded"""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        key, csr, crt = [os.path.join(tmpdir, name)
+                         for name in ('cert.key', 'cert.csr', 'cert.crt')]
+        run(['openssl', 'req', '-new', '-newkey', 'rsa:2048', '-nodes',
+             '-subj', '/CN=%s' % cn, '-keyout', key, '-out', csr],
+            verbosity=0)
+        run(['openssl', 'x509', '-req', '-days', '3650', '-in', csr,
+             '-CA', _pki_path('ca.crt'), '-CAkey', _pki_path('ca.key'),
+             '-set_serial', str(int(binascii.hexlify(os.urandom(8)), 16)),
+             '-out', crt], verbosity=0)
+        with open(key) as fobj:
+            key = fobj.read()
+        with open(crt) as fobj:
+            crt = fobj.read()
+        return key, crt
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def ensure_pki():
+    """Create the CA and server certificate of shared servers, if missing"""
+    with file_lock('pki'):
+        if not os.path.isdir(_pki_path('ccd')):
+            os.makedirs(_pki_path('ccd'))
+        if not os.path.exists(_pki_path('ca.crt')):
+            log.info("Creating CA of shared servers in %s.",
+                     settings.PKI_DIR)
+            run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+                 '-days', '3650', '-subj', '/CN=vpn-proxy-ca',
+                 '-keyout', _pki_path('ca.key'),
+                 '-out', _pki_path('ca.crt')], verbosity=0)
+            os.chmod(_pki_path('ca.key'), 0o600)
+        if not os.path.exists(_pki_path('server.crt')):
+            log.info("Creating certificate of shared servers.")
+            key, crt = _gen_cert('vpn-proxy-server')
+            write_file(_pki_path('server.key'), key, 'key file')
+            os.chmod(_pki_path('server.key'), 0o600)
+            write_file(_pki_path('server.crt'), crt, 'certificate')
+
+
+def gen_client_cert(name):
+    """Generate and return the private key and certificate, concatenated,
+    a tunnel named `name` authenticates to shared servers with"""
+    ensure_pki()
+    return ''.join(_gen_cert(name))
+
+
+# The OpenVPN options of performance profiles, in the order rendered
+PERFORMANCE_OPTIONS = ('sndbuf', 'rcvbuf', 'fast_io', 'tun_mtu', 'mssfix',
+                       'txqueuelen')
+
+
+def get_performance_conf(options, protocol='udp'):
+    """Return the OpenVPN config lines of performance profile `options`"""
+    lines = []
+    for option in PERFORMANCE_OPTIONS:
+        value = options.get(option)
+        if value is None or value is False:
+            continue
+        if protocol != 'udp' and option in ('fast_io', 'mssfix'):
+            # Both are only supported over UDP
+            continue
+        name = option.replace('_', '-')
+        lines.append(name if value is True else '%s %s' % (name, value))
+    return lines
+
+
+def get_shared_conf(server):
+    return '\n'.join(['dev %s' % server.name,
+                      'dev-type tap',
+                      'mode server',
+                      'tls-server',
+                      'port %s' % server.port,
+                      'proto udp',
+                      'ifconfig %s %s' % (server.server, server.netmask),
+                      'ca %s' % _pki_path('ca.crt'),
+                      'cert %s' % _pki_path('server.crt'),
+                      'key %s' % _pki_path('server.key'),
+                      'dh none',
+                      'client-config-dir %s' % _pki_path('ccd'),
+                      'ccd-exclusive',
+                      'keepalive 10 120'] +
+                     get_performance_conf(server.performance))
+
+
+CLIENT_SCRIPT = """#!/bin/bash
 
 set -ex
 
@@ -261,11 +1219,77 @@ install_pkg() {
     fi
 }
 
-if ! which openvpn > /dev/null; then
-    install_pkg openvpn
+if ! which %(binary)s > /dev/null; then
+    install_pkg %(package)s
 fi
 
-cat > %(key_path)s << EOF
+%(setup)s
+
+echo 1 > /proc/sys/net/ipv4/ip_forward
+
+ifaces=`ip link show | grep '^[0-9]*:' | awk '{print $2}' | sed 's/:$//' | \\
+    grep -v ^lo$`
+for iface in $ifaces; do
+    iptables -t nat -A POSTROUTING -o $iface -j MASQUERADE
+done
+"""
+
+
+class OpenVPNDriver(object):
+    """Serve tunnels with userspace OpenVPN
+
+    Each tunnel is served either by an OpenVPN server of its own, using a
+    static key, or by a shared multi-client server, using TLS.
+
+    """
+
+    def gen_key(self):
+        return gen_key()
+
+    def get_conf(self, tunnel):
+        if tunnel.shared_server is not None:
+            # The tunnel's entry in the client-config-dir of its server
+            return 'ifconfig-push %s %s' % (tunnel.client,
+                                            tunnel.shared_server.netmask)
+        return '\n'.join(['dev %s' % tunnel.name,
+                          'dev-type tun',
+                          'port %s' % tunnel.port,
+                          'ifconfig %s %s' % (tunnel.server, tunnel.client),
+                          'secret %s' % tunnel.key_path,
+                          'proto %s' % tunnel.server_protocol] +
+                         get_performance_conf(tunnel.performance,
+                                              tunnel.protocol))
+
+    def get_client_conf(self, tunnel):
+        if tunnel.shared_server is not None:
+            with open(_pki_path('ca.crt')) as fobj:
+                ca = fobj.read().strip()
+            return '\n'.join([
+                'client',
+                'remote %s' % settings.VPN_SERVER_REMOTE_ADDRESS,
+                'dev %s' % tunnel.name,
+                'dev-type tap',
+                'port %s' % tunnel.port,
+                'proto udp',
+                'cert %s' % tunnel.key_path,
+                'key %s' % tunnel.key_path,
+                'verify-x509-name vpn-proxy-server name',
+                '<ca>', ca, '</ca>',
+                'keepalive 10 120'] +
+                get_performance_conf(tunnel.performance))
+        return '\n'.join(['remote %s' % settings.VPN_SERVER_REMOTE_ADDRESS,
+                          'dev %s' % tunnel.name,
+                          'dev-type tun',
+                          'port %s' % tunnel.port,
+                          'ifconfig %s %s' % (tunnel.client, tunnel.server),
+                          'secret %s' % tunnel.key_path,
+                          'proto %s' % tunnel.client_protocol,
+                          'keepalive 10 120'] +
+                         get_performance_conf(tunnel.performance,
+                                              tunnel.protocol))
+
+    def get_client_script(self, tunnel):
+        setup = """cat > %(key_path)s << EOF
 %(key)s
 EOF
 
@@ -277,136 +1301,800 @@ if which systemctl > /dev/null; then
     systemctl restart openvpn@%(name)s
 else
     service openvpn restart %(name)s
-fi
+fi""" % {'key_path': tunnel.key_path, 'conf_path': tunnel.conf_path,
+         'key': tunnel.key, 'conf': self.get_client_conf(tunnel),
+         'name': tunnel.name}
+        return CLIENT_SCRIPT % {'binary': 'openvpn', 'package': 'openvpn',
+                                'setup': setup}
+
+    def start(self, tunnel):
+        if tunnel.shared_server is not None:
+            start_shared_server(tunnel.shared_server)
+            write_file(tunnel.conf_path, self.get_conf(tunnel),
+                       'client config')
+        else:
+            # Only restart the server if its rendered config changed
+            changed = write_file(tunnel.key_path, tunnel.key, 'key file')
+            changed |= write_file(tunnel.conf_path, self.get_conf(tunnel),
+                                  'conf file')
+            if settings.OPENVPN_CPU_AFFINITY:
+                ensure_openvpn_pinned(tunnel.name)
+            start_openvpn(tunnel.name, force=changed)
+
+    def stop(self, tunnel):
+        if tunnel.shared_server is not None:
+            # Shared servers are left running, reconcile stops unused ones
+            remove_file(tunnel.conf_path, 'client config')
+        else:
+            stop_openvpn(tunnel.name)
+            unpin_openvpn(tunnel.name)
+            remove_file(tunnel.conf_path, 'conf file')
+            remove_file(tunnel.key_path, 'key file')
 
-echo 1 > /proc/sys/net/ipv4/ip_forward
 
-ifaces=`ip link show | grep '^[0-9]*:' | awk '{print $2}' | sed 's/:$//' | \
-    grep -v ^lo$`
-for iface in $ifaces; do
-    iptables -t nat -A POSTROUTING -o $iface -j MASQUERADE
-done
-""" % {'key_path': tunnel.key_path, 'conf_path': tunnel.conf_path,
-       'key': tunnel.key, 'conf': get_client_conf(tunnel), 'name': tunnel.name}
+class WireGuardDriver(object):
+    """Serve tunnels with in-kernel WireGuard
+
+    Each tunnel gets a WireGuard interface with the client as its only
+    peer. Encryption runs in the kernel, spread over all cores, and
+    (re)configuring a tunnel is a single `wg setconf` instead of a service
+    restart. `Tunnel.key` holds the server's and the client's private key,
+    one per line.
+
+    """
+
+    def gen_key(self):
+        return gen_wireguard_key()
+
+    def get_conf(self, tunnel):
+        server_key, client_key = tunnel.key.split()
+        return '\n'.join(['[Interface]',
+                          'PrivateKey = %s' % server_key,
+                          'ListenPort = %s' % tunnel.port,
+                          '',
+                          '[Peer]',
+                          'PublicKey = %s' % wireguard_pubkey(client_key),
+                          'AllowedIPs = 0.0.0.0/0',
+                          ''])
+
+    def get_client_conf(self, tunnel):
+        server_key, client_key = tunnel.key.split()
+        return '\n'.join(['[Interface]',
+                          'PrivateKey = %s' % client_key,
+                          'Address = %s/32' % tunnel.client,
+                          '',
+                          '[Peer]',
+                          'PublicKey = %s' % wireguard_pubkey(server_key),
+                          'Endpoint = %s:%s' % (
+                              settings.VPN_SERVER_REMOTE_ADDRESS,
+                              tunnel.port),
+                          'AllowedIPs = %s/32' % tunnel.server,
+                          'PersistentKeepalive = 25',
+                          ''])
+
+    def get_client_script(self, tunnel):
+        setup = """mkdir -p /etc/wireguard
+
+cat > %(conf_path)s << EOF
+%(conf)s
+EOF
+chmod 600 %(conf_path)s
+
+if which systemctl > /dev/null; then
+    systemctl enable wg-quick@%(name)s
+    systemctl restart wg-quick@%(name)s
+else
+    wg-quick down %(name)s || true
+    wg-quick up %(name)s
+fi""" % {'conf_path': tunnel.conf_path, 'name': tunnel.name,
+         'conf': self.get_client_conf(tunnel)}
+        return CLIENT_SCRIPT % {'binary': 'wg', 'package': 'wireguard-tools',
+                                'setup': setup}
+
+    def start(self, tunnel):
+        """Create the tunnel's interface, if missing, and (re)configure it"""
+        iface = tunnel.name
+        if not os.path.isdir(os.path.dirname(tunnel.conf_path)):
+            os.makedirs(os.path.dirname(tunnel.conf_path), 0o700)
+        write_file(tunnel.conf_path, self.get_conf(tunnel), 'conf file')
+        os.chmod(tunnel.conf_path, 0o600)
+        if not os.path.exists('/sys/class/net/%s' % iface):
+            log.info("Creating WireGuard interface %s.", iface)
+            run(['ip', 'link', 'add', iface, 'type', 'wireguard'])
+        run(['wg', 'setconf', iface, tunnel.conf_path])
+        run(['ip', 'address', 'replace', tunnel.server, 'peer',
+             tunnel.client, 'dev', iface])
+        run(['ip', 'link', 'set', iface, 'up'])
+
+    def stop(self, tunnel):
+        del_link(tunnel.name)
+        remove_file(tunnel.conf_path, 'conf file')
+
+
+TUNNEL_DRIVERS = {
+    'openvpn': OpenVPNDriver,
+    'wireguard': WireGuardDriver,
+}
+
+
+def get_driver(tunnel):
+    """Return the driver selected by `tunnel.driver`"""
+    return TUNNEL_DRIVERS[tunnel.driver]()
 
 
-def check_iptables(forwarding, job='-C', rule=''):
-    """mangle incoming packets based on local port, mangle table is traversed
-    before nat in every chain
+def get_conf(tunnel):
+    return get_driver(tunnel).get_conf(tunnel)
+
+
+def get_client_conf(tunnel):
+    return get_driver(tunnel).get_client_conf(tunnel)
+
+
+def get_client_script(tunnel):
+    return get_driver(tunnel).get_client_script(tunnel)
+
+
+# Source CIDRs are matched against a single set, updated in place when
+# settings.SOURCE_CIDRS change, and local ports against a set per tunnel
+IPSET_SOURCES = 'vpn-proxy-src'
+IPSET_NETS = 'hash:net'
+IPSET_PORTS = 'bitmap:port range 0-65535'
+
+
+def get_tunnel_iptables_rules(tunnel):
+    """Return the iptables rules shared by all forwardings of `tunnel`
+
+    Packets from any of the source CIDRs for any of the local ports in the
+    tunnel's ipset are marked once and jump to the tunnel's own nat chain,
+    which holds a DNAT rule per forwarding. MASQUERADE marked packets routed
+    via the virtual interface, which may be shared with other tunnels.
+
+    Rules are returned as a dict of lists of (table, chain, spec) tuples.
+    Each `spec` is in the normalized form printed by `iptables-save`, so
+    that it can be compared against its output and fed to
+    `iptables-restore` as is. The tunnel's chain itself is listed as a rule
+    with an empty `spec`"""
+    match = ('-i', str(settings.IN_IFACE),
+             '-p', 'tcp',
+             '-m', 'set', '--match-set', IPSET_SOURCES, 'src',
+             '-m', 'set', '--match-set', str(tunnel.name), 'dst')
+    return {
+        'chain': [('nat', str(tunnel.name), ())],
+        'mangle': [('mangle', 'PREROUTING', match + (
+            '-j', 'MARK', '--set-xmark', '%s/0xffffffff' % hex(tunnel.id),
+        ))],
+        'nat': [('nat', 'PREROUTING', match + (
+            '-j', str(tunnel.name),
+        ))],
+        'mask': [('nat', 'POSTROUTING', (
+            '-o', str(tunnel.iface),
+            '-m', 'set', '--match-set', IPSET_SOURCES, 'src',
+            '-m', 'mark', '--mark', hex(tunnel.id),
+            '-j', 'MASQUERADE',
+        ))],
+    }
+
+
+def get_iptables_rules(forwarding):
+    """Return the iptables rules required by `forwarding`
+
     DNAT incoming packets in order to force forwarding --> private host (IP,
-    PORT)
-    MASQUERADE packets routed via the virtual interface"""
-    mangle_rule = ['iptables', '-w', '-t', 'mangle', job, 'PREROUTING',
-                   '-p', 'tcp',
-                   '-i', str(settings.IN_IFACE),
-                   '-s', str(SOURCE_CIDRS),
-                   '--destination-port', str(forwarding.loc_port),
-                   '-j', 'MARK', '--set-mark', str(forwarding.tunnel.id)]
-
-    nat_rule = ['iptables', '-w', '-t', 'nat', job, 'PREROUTING',
-                '-p', 'tcp',
-                '-i', str(settings.IN_IFACE),
-                '-s', str(SOURCE_CIDRS),
-                '--destination-port', str(forwarding.loc_port),
-                '-j', 'DNAT', '--to-destination', str(forwarding.destination)]
-
-    mask_rule = ['iptables', '-w', '-t', 'nat', job, 'POSTROUTING',
-                 '-p', 'tcp',
-                 '-o', str(forwarding.tunnel.name),
-                 '-s', str(SOURCE_CIDRS),
-                 '-d', str(forwarding.dst_addr),
-                 '--destination-port', str(forwarding.dst_port),
-                 '-j', 'MASQUERADE']
-
-    rules = {'mangle': mangle_rule, 'nat': nat_rule, 'mask': mask_rule}
-    if job == '-C' and rule == '':
-        exitcodes = {}
-        for name, cmd in rules.iteritems():
+    PORT), in the chain of the forwarding's tunnel"""
+    return {'dnat': [('nat', str(forwarding.tunnel.name), (
+        '-p', 'tcp', '-m', 'tcp',
+        '--dport', str(forwarding.loc_port),
+        '-j', 'DNAT', '--to-destination', str(forwarding.destination),
+    ))]}
+
+
+def get_legacy_iptables_rules(forwarding):
+    """Return the rules `forwarding` was given before tunnels got their own
+    chains, as (table, chain, spec) tuples with the source CIDR matched
+    left out of `spec`
+
+    Forwardings created by earlier versions may still have them in place,
+    for whatever source CIDRs were configured back then"""
+    return [
+        ('mangle', 'PREROUTING', (
+            '-i', str(settings.IN_IFACE),
+            '-p', 'tcp', '-m', 'tcp',
+            '--dport', str(forwarding.loc_port),
+            '-j', 'MARK', '--set-xmark', '%s/0xffffffff' % hex(
+                forwarding.tunnel.id),
+        )),
+        ('nat', 'PREROUTING', (
+            '-i', str(settings.IN_IFACE),
+            '-p', 'tcp', '-m', 'tcp',
+            '--dport', str(forwarding.loc_port),
+            '-j', 'DNAT', '--to-destination', str(forwarding.destination),
+        )),
+        ('nat', 'POSTROUTING', (
+            '-d', '%s/32' % forwarding.dst_addr,
+            '-o', str(forwarding.tunnel.name),
+            '-p', 'tcp', '-m', 'tcp',
+            '--dport', str(forwarding.dst_port),
+            '-j', 'MASQUERADE',
+        )),
+    ]
+
+
+def list_iptables():
+    """Return a set of all (table, chain, spec) rules currently installed
+
+    User defined chains are included as rules with an empty `spec`"""
+    rules = set()
+    table = None
+    for line in run(['iptables-save'], verbosity=0).splitlines():
+        if line.startswith('*'):
+            table = line[1:].strip()
+        elif line.startswith(':') and table:
+            parts = line[1:].split()
+            if parts[1] == '-':
+                rules.add((table, parts[0], ()))
+        elif line.startswith('-A ') and table:
+            parts = line.split()
+            rules.add((table, parts[1], tuple(parts[2:])))
+    return rules
+
+
+def iptables_cmd(job, rule):
+    table, chain, spec = rule
+    if not spec and job == '-C':
+        # There's no check for chains, list them instead
+        return ['iptables', '-w', '-t', table, '-n', '-L', chain]
+    return ['iptables', '-w', '-t', table, job, chain] + list(spec)
+
+
+def list_ipsets():
+    """Return a dict of the members of all ipsets currently in place"""
+    ipsets = {}
+    for line in run(['ipset', 'save'], verbosity=0).splitlines():
+        parts = line.split()
+        if len(parts) > 1 and parts[0] == 'create':
+            ipsets[parts[1]] = set()
+        elif len(parts) > 2 and parts[0] == 'add':
+            ipsets.setdefault(parts[1], set()).add(parts[2])
+    return ipsets
+
+
+class IPTablesBatch(object):
+    """Collect iptables changes and commit them in a single transaction
+
+    The installed rules and ipsets are taken from the active kernel state
+    snapshot, or listed once with `iptables-save` and `ipset save` if there
+    is none, and all required changes are committed with a single
+    `iptables-restore --noflush` call, preceded and followed by `ipset
+    restore` calls creating and removing ipsets and their members. In case
+    `iptables-restore` fails, changes are checked and applied one by one
+    with `iptables`.
+
+    """
+
+    def __init__(self, rules=None, ipsets=None):
+        self.rules = rules
+        self.ipsets = ipsets
+        self.changes = []
+        self.ipset_changes = []
+        self.hooks = []
+        # Held while queueing changes, since threads may share a batch
+        self.lock = threading.RLock()
+
+    def on_commit(self, func):
+        """Have `func` called once the batch has been committed"""
+        self.hooks.append(func)
+
+    def load(self):
+        if self.rules is None:
+            self.rules = get_kernel_state().iptables
+        return self.rules
+
+    def load_ipsets(self):
+        if self.ipsets is None:
+            self.ipsets = get_kernel_state().ipsets
+        return self.ipsets
+
+    def append(self, rule):
+        """Queue appending a single (table, chain, spec) rule, or creating
+        a chain if `spec` is empty"""
+        self.changes.append(('-A' if rule[2] else '-N', rule))
+        self.load().add(rule)
+
+    def delete(self, rule):
+        """Queue deleting a single (table, chain, spec) rule, or a chain if
+        `spec` is empty"""
+        self.changes.append(('-D' if rule[2] else '-X', rule))
+        self.load().discard(rule)
+
+    def create_ipset(self, name, spec):
+        self.ipset_changes.append(('create', name, spec))
+        self.load_ipsets()[name] = set()
+
+    def destroy_ipset(self, name):
+        self.ipset_changes.append(('destroy', name, None))
+        self.load_ipsets().pop(name, None)
+
+    def add_ipset(self, name, member):
+        self.ipset_changes.append(('add', name, member))
+        self.load_ipsets()[name].add(member)
+
+    def del_ipset(self, name, member):
+        self.ipset_changes.append(('del', name, member))
+        self.load_ipsets()[name].discard(member)
+
+    def sync_sources(self):
+        """Queue bringing the source CIDRs ipset in line with SOURCE_CIDRS"""
+        ipsets = self.load_ipsets()
+        if IPSET_SOURCES not in ipsets:
+            log.info('Creating ipset %s', IPSET_SOURCES)
+            self.create_ipset(IPSET_SOURCES, IPSET_NETS)
+        # `ipset save` omits the prefix length of /32 networks
+        members = dict((str(IPNetwork(member).cidr), member)
+                       for member in ipsets[IPSET_SOURCES])
+        for cidr in SOURCE_CIDRS:
+            if cidr not in members:
+                log.info('Adding source CIDR %s to ipset %s',
+                         cidr, IPSET_SOURCES)
+                self.add_ipset(IPSET_SOURCES, cidr)
+        for cidr, member in members.items():
+            if cidr not in SOURCE_CIDRS:
+                log.info('Removing source CIDR %s from ipset %s',
+                         cidr, IPSET_SOURCES)
+                self.del_ipset(IPSET_SOURCES, member)
+
+    def add(self, forwarding):
+        """Queue appending any missing rules of `forwarding`, along with
+        those of its tunnel and its local port in the tunnel's ipset"""
+        rules, ipsets = self.load(), self.load_ipsets()
+        self.sync_sources()
+        name, port = str(forwarding.tunnel.name), str(forwarding.loc_port)
+        if name not in ipsets:
+            log.info('Creating ipset %s', name)
+            self.create_ipset(name, IPSET_PORTS)
+        if port not in ipsets[name]:
+            log.info('Adding local port %s to ipset %s', port, name)
+            self.add_ipset(name, port)
+        tunnel_rules = get_tunnel_iptables_rules(forwarding.tunnel)
+        for key in ('chain', 'mangle', 'nat', 'mask'):
+            missing = [rule for rule in tunnel_rules[key]
+                       if rule not in rules]
+            if missing:
+                log.info('Appending %s rule for %s', key, name)
+                for rule in missing:
+                    self.append(rule)
+        for key, _rules in sorted(get_iptables_rules(forwarding).items()):
+            missing = [rule for rule in _rules if rule not in rules]
+            if not missing:
+                log.debug('IPtables %s rule already in place for local port '
+                          '%s.', key, forwarding.loc_port)
+                continue
+            log.info('Appending %s rule for local port %s',
+                     key, forwarding.loc_port)
+            for rule in missing:
+                self.append(rule)
+
+    def remove(self, forwarding):
+        """Queue deleting any existing rules of `forwarding`, including
+        those of earlier versions, along with those of its tunnel if it was
+        the tunnel's last one"""
+        rules, ipsets = self.load(), self.load_ipsets()
+        name, port = str(forwarding.tunnel.name), str(forwarding.loc_port)
+        for key, _rules in sorted(get_iptables_rules(forwarding).items()):
+            existing = [rule for rule in _rules if rule in rules]
+            if not existing:
+                log.debug('IPtables %s for local port %s already deleted.',
+                          key, forwarding.loc_port)
+                continue
+            log.info('Removing IPtables %s rule for local port %s',
+                     key, forwarding.loc_port)
+            for rule in existing:
+                self.delete(rule)
+        legacy = get_legacy_iptables_rules(forwarding)
+        existing = [rule for rule in rules
+                    if rule[2][:1] == ('-s',) and
+                    (rule[0], rule[1], rule[2][2:]) in legacy]
+        if existing:
+            log.info('Removing legacy IPtables rules for local port %s',
+                     forwarding.loc_port)
+            for rule in existing:
+                self.delete(rule)
+        if port in ipsets.get(name, ()):
+            log.info('Removing local port %s from ipset %s', port, name)
+            self.del_ipset(name, port)
+        if ipsets.get(name):
+            return
+        existing = [rule for rule in rules if rule[:2] == ('nat', name) and
+                    rule[2]]
+        tunnel_rules = get_tunnel_iptables_rules(forwarding.tunnel)
+        for key in ('mask', 'nat', 'mangle', 'chain'):
+            existing.extend(rule for rule in tunnel_rules[key]
+                            if rule in rules)
+        if existing:
+            log.info('Removing IPtables rules for %s', name)
+            for rule in existing:
+                self.delete(rule)
+        if name in ipsets:
+            log.info('Destroying ipset %s', name)
+            self.destroy_ipset(name)
+
+    def dumps(self):
+        """Return queued changes in `iptables-restore` format"""
+        lines = []
+        for table in ('mangle', 'nat'):
+            changes = [(job, rule) for job, rule in self.changes
+                       if rule[0] == table]
+            if not changes:
+                continue
+            lines.append('*%s' % table)
+            # Declaring a chain creates it, or flushes it even with
+            # --noflush, so chains created or deleted are declared and
+            # refilled with all their rules, instead of changed rule by rule.
+            # Chains must be declared before any rules jumping to them and
+            # may only be deleted once they're no longer referenced.
+            chains = []
+            for job, (_, chain, spec) in changes:
+                if job in ('-N', '-X') and chain not in chains:
+                    chains.append(chain)
+                    lines.append(':%s - [0:0]' % chain)
+            for job, (_, chain, spec) in changes:
+                if job in ('-A', '-D') and chain not in chains:
+                    lines.append(' '.join((job, chain) + spec))
+            for chain in chains:
+                if (table, chain, ()) in self.rules:
+                    lines.extend(' '.join(('-A', chain) + rule[2])
+                                 for rule in sorted(self.rules)
+                                 if rule[:2] == (table, chain) and rule[2])
+                else:
+                    lines.append('-X %s' % chain)
+            lines.append('COMMIT')
+        return '\n'.join(lines) + '\n'
+
+    def dumps_ipsets(self, jobs):
+        """Return queued ipset changes of `jobs` in `ipset restore` format"""
+        lines = []
+        for job, name, arg in self.ipset_changes:
+            if job in jobs:
+                lines.append(' '.join([job, name] + ([arg] if arg else [])))
+        return '\n'.join(lines) + '\n' if lines else ''
+
+    def commit(self):
+        """Apply queued changes, return True if changed"""
+        if not self.changes and not self.ipset_changes:
+            return False
+        # Sets need to exist before rules match against them and can only be
+        # destroyed once no rules do
+        pre = self.dumps_ipsets(('create', 'add'))
+        post = self.dumps_ipsets(('del', 'destroy'))
+        data, changes = self.dumps(), self.changes
+        self.changes, self.ipset_changes = [], []
+        if pre:
+            run(['ipset', 'restore', '-exist'], data=pre)
+        if changes:
             try:
-                run(cmd, verbosity=0)
-                exitcodes[name] = 0
-            except subprocess.CalledProcessError as err:
-                exitcodes[name] = err.returncode
-        return exitcodes
-    else:
-        if rule == 'mangle':
-            run(mangle_rule)
-        elif rule == 'nat':
-            run(nat_rule)
-        elif rule == 'mask':
-            run(mask_rule)
+                run(['iptables-restore', '--noflush'], data=data)
+            except (subprocess.CalledProcessError, OSError):
+                log.warning("Batch commit of %d iptables changes failed, "
+                            "falling back to applying them one by one.",
+                            len(changes))
+                for job, rule in sorted(changes, key=lambda change: (
+                        change[0] == '-X', change[0] != '-N')):
+                    try:
+                        run(iptables_cmd('-C', rule), verbosity=0)
+                        exists = True
+                    except subprocess.CalledProcessError:
+                        exists = False
+                    if exists != (job in ('-A', '-N')):
+                        run(iptables_cmd(job, rule))
+        if post:
+            run(['ipset', 'restore', '-exist'], data=post)
+        return True
+
+
+NFT_TABLE = 'ip vpn-proxy'
+
+
+def get_nftables_elements(forwarding):
+    """Return the nftables map elements required by `forwarding`
+
+    Elements are (map, loc_port, value) tuples, mapping the local port to the
+    mark of the tunnel and to the address and port to DNAT to"""
+    loc_port = str(forwarding.loc_port)
+    return [('marks', loc_port, hex(forwarding.tunnel.id)),
+            ('dst_addrs', loc_port, str(forwarding.dst_addr)),
+            ('dst_ports', loc_port, str(forwarding.dst_port))]
+
+
+def get_nftables_ruleset():
+    """Return the commands creating the `vpn-proxy` table and its rules
+
+    The commands are idempotent: the table, sets, maps and chains are only
+    added if missing, while the chains are flushed and their few rules
+    added again, in the same transaction as any map changes.
+
+    mangle incoming packets with the mark the local port maps to
+    DNAT them to the address and port the local port maps to
+    MASQUERADE packets routed via any virtual interface"""
+    lines = [
+        'add table %s' % NFT_TABLE,
+        'add set %s sources { type ipv4_addr; flags interval; }' % NFT_TABLE,
+        'add map %s marks { type inet_service : mark; }' % NFT_TABLE,
+        'add map %s dst_addrs { type inet_service : ipv4_addr; }' % NFT_TABLE,
+        'add map %s dst_ports { type inet_service : inet_service; }' %
+        NFT_TABLE,
+        'add chain %s mangle_prerouting '
+        '{ type filter hook prerouting priority -150; }' % NFT_TABLE,
+        'add chain %s nat_prerouting '
+        '{ type nat hook prerouting priority -100; }' % NFT_TABLE,
+        'add chain %s nat_postrouting '
+        '{ type nat hook postrouting priority 100; }' % NFT_TABLE,
+        'flush set %s sources' % NFT_TABLE,
+        'add element %s sources { %s }' % (NFT_TABLE,
+                                           ', '.join(SOURCE_CIDRS)),
+    ]
+    for chain in ('mangle_prerouting', 'nat_prerouting', 'nat_postrouting'):
+        lines.append('flush chain %s %s' % (NFT_TABLE, chain))
+    match = 'iifname "%s" ip saddr @sources' % settings.IN_IFACE
+    lines.extend([
+        'add rule %s mangle_prerouting %s '
+        'meta mark set tcp dport map @marks' % (NFT_TABLE, match),
+        'add rule %s nat_prerouting %s '
+        'dnat to tcp dport map @dst_addrs : tcp dport map @dst_ports' % (
+            NFT_TABLE, match),
+    ])
+    for prefix in (settings.IFACE_PREFIX, settings.SHARED_IFACE_PREFIX):
+        lines.append('add rule %s nat_postrouting ip saddr @sources '
+                     'oifname "%s*" masquerade' % (NFT_TABLE, prefix))
+    return lines
+
+
+def list_nftables():
+    """Return a set of all (map, key, value) elements currently installed"""
+    elements = set()
+    try:
+        output = run(['nft', '-nn', 'list', 'table'] + NFT_TABLE.split(),
+                     verbosity=0)
+    except (subprocess.CalledProcessError, OSError):
+        log.debug("No nftables table %s found.", NFT_TABLE)
+        return elements
+    regex = re.compile(r'map (\w+) \{[^}]*?elements = \{([^}]*)\}')
+    for name, data in regex.findall(output):
+        for element in data.split(','):
+            key, value = [part.strip() for part in element.split(':')]
+            if name == 'marks':
+                value = hex(int(value, 16))
+            elements.add((name, key, value))
+    return elements
+
+
+class NFTablesBatch(object):
+    """Collect nftables map changes and commit them in a single transaction
+
+    Instead of a set of rules per forwarding, which every packet is matched
+    against in turn, packets are marked and DNATed by looking up their
+    destination port in the maps of a single table, whose few rules never
+    change. Adding or removing a forwarding only adds or deletes its map
+    elements, and all queued changes are committed atomically with a single
+    `nft -f -` call.
+
+    The interface is the same as that of `IPTablesBatch`.
+
+    """
+
+    def __init__(self, elements=None):
+        self.elements = elements
+        self.changes = []
+        self.hooks = []
+        self.lock = threading.RLock()
+
+    def on_commit(self, func):
+        """Have `func` called once the batch has been committed"""
+        self.hooks.append(func)
+
+    def load(self):
+        if self.elements is None:
+            self.elements = get_kernel_state().nftables
+        return self.elements
+
+    def append(self, element):
+        """Queue adding a single (map, key, value) element"""
+        elements = self.load()
+        # A map key can't be added again with a different value
+        for _element in list(elements):
+            if _element[:2] == element[:2] and _element != element:
+                self.delete(_element)
+        self.changes.append(('add', element))
+        elements.add(element)
+
+    def delete(self, element):
+        """Queue deleting a single (map, key, value) element"""
+        self.changes.append(('delete', element))
+        self.load().discard(element)
+
+    def add(self, forwarding):
+        """Queue adding any missing map elements of `forwarding`"""
+        elements = self.load()
+        missing = [element for element in get_nftables_elements(forwarding)
+                   if element not in elements]
+        if not missing:
+            log.debug('nftables elements already in place for local port '
+                      '%s.', forwarding.loc_port)
+            return
+        log.info('Adding nftables elements for local port %s',
+                 forwarding.loc_port)
+        for element in missing:
+            self.append(element)
+
+    def remove(self, forwarding):
+        """Queue deleting any existing map elements of `forwarding`"""
+        elements = self.load()
+        existing = [element for element in get_nftables_elements(forwarding)
+                    if element in elements]
+        if not existing:
+            log.debug('nftables elements for local port %s already deleted.',
+                      forwarding.loc_port)
+            return
+        log.info('Removing nftables elements for local port %s',
+                 forwarding.loc_port)
+        for element in existing:
+            self.delete(element)
+
+    def dumps(self, changes=None):
+        """Return queued changes in `nft -f` format"""
+        if changes is None:
+            changes = self.changes
+        lines = []
+        if any(job == 'add' for job, element in changes):
+            lines.extend(get_nftables_ruleset())
+        for job, (name, key, value) in changes:
+            if job == 'add':
+                lines.append('add element %s %s { %s : %s }' % (
+                    NFT_TABLE, name, key, value))
+            else:
+                lines.append('delete element %s %s { %s }' % (
+                    NFT_TABLE, name, key))
+        return '\n'.join(lines) + '\n'
+
+    def commit(self):
+        """Apply queued changes, return True if changed"""
+        if not self.changes:
+            return False
+        changes, self.changes = self.changes, []
+        try:
+            run(['nft', '-f', '-'], data=self.dumps(changes))
+        except subprocess.CalledProcessError:
+            # Elements may have been changed by another process since they
+            # were listed, retry with the changes still needed
+            log.warning("Commit of %d nftables changes failed, retrying "
+                        "against the current ruleset.", len(changes))
+            elements = list_nftables()
+            changes = [(job, element) for job, element in changes
+                       if (element in elements) != (job == 'add')]
+            if changes:
+                run(['nft', '-f', '-'], data=self.dumps(changes))
+        return True
+
+
+FIREWALL_BATCHES = {
+    'iptables': IPTablesBatch,
+    'nftables': NFTablesBatch,
+}
+
+
+def get_firewall_batch():
+    """Return an empty batch for settings.FIREWALL_BACKEND"""
+    return FIREWALL_BATCHES[settings.FIREWALL_BACKEND]()
+
+
+@contextlib.contextmanager
+def iptables_batch(batch=None):
+    """Group all firewall changes made within the block in one transaction
+
+    Calls to `add_iptables` and `del_iptables` are queued and committed
+    together when the outermost block exits, by either an `IPTablesBatch` or
+    an `NFTablesBatch` depending on settings.FIREWALL_BACKEND. Nested blocks
+    share the same batch. Pass `batch` to queue changes to a batch created
+    in another thread, which is then left to that thread to commit. Hooks
+    registered with the batch's `on_commit` are called after committing,
+    even if that fails, since the kernel's state is then unknown."""
+    _batch = getattr(_local, 'iptables_batch', None)
+    if _batch is not None:
+        yield _batch
+        return
+    if batch is not None:
+        _local.iptables_batch = batch
+        try:
+            yield batch
+        finally:
+            _local.iptables_batch = None
+        return
+    batch = _local.iptables_batch = get_firewall_batch()
+    try:
+        yield batch
+    finally:
+        _local.iptables_batch = None
+        try:
+            batch.commit()
+        finally:
+            for func in batch.hooks:
+                func()
 
 
 def add_iptables(forwarding):
-    exitcodes = check_iptables(forwarding)
-    for rule, exitcode in exitcodes.iteritems():
-        if exitcode == 0:
-            log.debug('IPtables %s rule already in place for local port '
-                      '%s.' % (rule, forwarding.loc_port))
-        else:
-            check_iptables(forwarding, '-A', rule)
-            log.info('Appending %s rule for local port %s' %
-                     (rule, forwarding.loc_port))
+    with iptables_batch() as batch, batch.lock:
+        batch.add(forwarding)
 
 
 def del_iptables(forwarding):
-    exitcodes = check_iptables(forwarding)
-    for rule, exitcode in exitcodes.iteritems():
-        if exitcode == 0:
-            check_iptables(forwarding, '-D', rule)
-            log.info('Removing IPtables %s rule for local port %s' %
-                     (rule, forwarding.loc_port))
-        else:
-            log.debug('IPtables %s for local port %s already deleted.' %
-                      (rule, forwarding.loc_port))
+    with iptables_batch() as batch, batch.lock:
+        batch.remove(forwarding)
 
 
 def check_fwmark(mark, table):
-    line = 'from all fwmark %s lookup %s' % (hex(mark), table)
-    if line in run(['ip', 'rule', 'show'], verbosity=0):
-        return True
-    return False
+    return ('all', hex(mark), table) in get_kernel_state().ip_rules
 
 
-def add_fwmark(forwarding):
-    """point marked packets to the corresponding routing table
-    as created during `openvpn start`"""
-    ip_rule = ['ip', 'rule', 'add', 'fwmark', str(hex(forwarding.tunnel.id)),
-               'table', str(forwarding.tunnel.rtable)]
-    if check_fwmark(forwarding.tunnel.id, forwarding.tunnel.rtable):
-        log.debug('IP rule for mark %s already exists.', forwarding.tunnel.id)
-    else:
-        run(ip_rule)
-        log.info('Inserting IP rule for fwmark %s pointing to routing table'
-                 ' %s' % (forwarding.tunnel.id, forwarding.tunnel.rtable))
-
-
-def del_fwmark(forwarding):
-    ip_rule = ['ip', 'rule', 'delete',
-               'fwmark', str(hex(forwarding.tunnel.id)),
-               'table', str(forwarding.tunnel.rtable)]
-    if check_fwmark(forwarding.tunnel.id, forwarding.tunnel.rtable):
-        run(ip_rule)
-        log.info('Removing IP rule for fwmark %s pointing to routing table'
-                 ' %s' % (forwarding.tunnel.id, forwarding.tunnel.rtable))
-    else:
-        log.debug('IP rule for mark % already removed.', forwarding.tunnel.id)
+def add_fwmark(tunnel):
+    """point packets marked with the tunnel id to the corresponding routing
+    table as created during `openvpn start`
+
+    The table's index is the tunnel id too, but since the kernel can't look
+    up a table by mark, a single rule per tunnel is shared by all of its
+    forwardings"""
+    rule = ('all', hex(tunnel.id), tunnel.rtable)
+    state = get_kernel_state()
+    if rule in state.ip_rules:
+        log.debug('IP rule for mark %s already exists.', tunnel.id)
+        return False
+    log.info('Inserting IP rule for fwmark %s pointing to routing table %s',
+             tunnel.id, tunnel.rtable)
+    state.executor.add_rule(rule)
+    with state.lock:
+        state.ip_rules.add(rule)
+    return True
+
+
+def del_fwmark(tunnel):
+    rule = ('all', hex(tunnel.id), tunnel.rtable)
+    state = get_kernel_state()
+    if rule not in state.ip_rules:
+        log.debug('IP rule for mark %s already removed.', tunnel.id)
+        return False
+    log.info('Removing IP rule for fwmark %s pointing to routing table %s',
+             tunnel.id, tunnel.rtable)
+    state.executor.del_rule(rule)
+    with state.lock:
+        state.ip_rules.discard(rule)
+    return True
+
+
+def start_shared_server(server):
+    """Configure and start shared `server`, unless already running"""
+    with file_lock(server.name):
+        ensure_pki()
+        changed = write_file(server.conf_path, get_shared_conf(server),
+                             'conf file')
+        if settings.OPENVPN_CPU_AFFINITY:
+            ensure_openvpn_pinned(server.name)
+        start_openvpn(server.name, force=changed)
+        check_rp_filter(server.rp_filter, server.name)
 
 
 def start_tunnel(tunnel):
-    write_file(tunnel.key_path, tunnel.key, 'key file')
-    write_file(tunnel.conf_path, get_conf(tunnel), 'conf file')
-    start_openvpn(tunnel.name)
+    get_driver(tunnel).start(tunnel)
     add_rtable(tunnel.id, tunnel.rtable)
-    add_ip_rule(tunnel.server, tunnel.rtable)
-    add_ip_route(tunnel.name, tunnel.rtable)
-    check_rp_filter(tunnel.rp_filter, tunnel.name)
+    if tunnel.shared_server is None:
+        # The server address of shared servers is shared by many tunnels
+        add_ip_rule(tunnel.server, tunnel.rtable)
+    add_fwmark(tunnel)
+    add_ip_route(tunnel.iface, tunnel.rtable, tunnel.gateway)
+    check_rp_filter(tunnel.rp_filter, tunnel.iface)
+    check_tc(tunnel)
 
 
 def stop_tunnel(tunnel):
-    del_ip_route(tunnel.name, tunnel.rtable)
-    del_ip_rule(tunnel.server, tunnel.rtable)
+    del_tc(tunnel)
+    del_ip_route(tunnel.iface, tunnel.rtable, tunnel.gateway)
+    del_fwmark(tunnel)
+    if tunnel.shared_server is None:
+        del_ip_rule(tunnel.server, tunnel.rtable)
     del_rtable(tunnel.id, tunnel.rtable)
-    stop_openvpn(tunnel.name)
-    remove_file(tunnel.conf_path, 'conf file')
-    remove_file(tunnel.key_path, 'key file')
+    get_driver(tunnel).stop(tunnel)
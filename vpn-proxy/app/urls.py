@@ -5,10 +5,15 @@ from . import views
 
 urlpatterns = [
     url(r'^$', views.tunnels, name='tunnels'),
+    url(r'^jobs/(?P<job_id>[0-9]+)/$', views.job, name='job'),
+    url(r'^health/$', views.health, name='health'),
     # /interface_id/target_IP/target_port/
     url(r'(?P<tunnel_id>[0-9]+)/forwardings/'
         r'(?P<target>([0-9]{1,3}.){3}[0-9]{1,3})/'
         r'(?P<port>[0-9]+)/$', views.connection, name='connection'),
+    # POST many targets as `targets=IP:port` at once
+    url(r'(?P<tunnel_id>[0-9]+)/forwardings/$', views.forwardings,
+        name='forwardings'),
     # ping command
     # in case no target is provided, the VPN endpoint will be probed
     url(r'(?P<tunnel_id>[0-9]+)/ping/(?P<target>(([0-9]{1,3}.){3}[0-9]{1,3})?)'
@@ -1,16 +1,23 @@
+import json
+import socket
 import logging
 
 
-from django.http import HttpResponse
+from django.conf import settings
+from django.http import HttpResponse, StreamingHttpResponse
 from django.http import JsonResponse as _JsonResponse
 from django.shortcuts import get_object_or_404
+from django.core.exceptions import ValidationError
+from django.core.urlresolvers import reverse
 from django.views.decorators.http import require_http_methods
 
-from .models import Tunnel, Forwarding
-from .models import choose_ip, pick_port
-
-import subprocess
-import pingparser
+from .models import Tunnel, Forwarding, Job
+from .models import pick_port, create_forwardings
+from .pool import create_tunnel
+from .cache import forwarding_cache
+from .health import health_results
+from . import jobs
+from . import icmp
 
 
 log = logging.getLogger(__name__)
@@ -23,28 +30,75 @@ class JsonResponse(_JsonResponse):
         super(JsonResponse, self).__init__(data, **kwargs)
 
 
+def is_async(request):
+    """Check if request opted in or out of running in the background"""
+    value = request.POST.get('async')
+    if value is None:
+        return settings.ASYNC_PROVISIONING
+    return value.lower() not in ('', '0', 'false', 'no')
+
+
 @require_http_methods(['GET', 'POST'])
 def tunnels(request):
     if request.method == 'POST':
-        params = {}
         cidrs = request.POST.getlist('cidrs')
         excluded_cidrs = request.POST.getlist('excluded', [])
-        client = choose_ip(cidrs, excluded_cidrs)
-        params['client'] = client
-        params['server'] = choose_ip(cidrs, excluded_cidrs, client_addr=client)
-        if 'proto' in request.POST:
-            params['protocol'] = request.POST['proto']
-        tun = Tunnel(**params)
-        tun.save()
+        protocol = request.POST.get('proto')
+        driver = request.POST.get('driver')
+        profile = request.POST.get('profile')
+        tuning = request.POST.get('tuning')
+        rate = request.POST.get('rate')
+        ceil = request.POST.get('ceil')
+        if is_async(request):
+            job = jobs.submit('create_tunnel', cidrs=cidrs,
+                              excluded_cidrs=excluded_cidrs,
+                              protocol=protocol, driver=driver,
+                              profile=profile, tuning=tuning, rate=rate,
+                              ceil=ceil)
+            response = JsonResponse(job.to_dict(), status=202)
+            response['Location'] = reverse('job', args=[job.id])
+            return response
+        try:
+            tun = create_tunnel(cidrs, excluded_cidrs, protocol=protocol,
+                                driver=driver, profile=profile,
+                                tuning=tuning, rate=rate, ceil=ceil)
+        except ValidationError as exc:
+            return HttpResponse('; '.join(exc.messages), status=400)
         return JsonResponse(tun.to_dict())
-    return JsonResponse(map(Tunnel.to_dict, Tunnel.objects.all()))
+    return JsonResponse(map(Tunnel.to_dict,
+                            Tunnel.objects.filter(pooled=False)))
+
+
+@require_http_methods(['GET'])
+def health(request):
+    results = health_results.get()
+    if results is None:
+        return HttpResponse("No health sweep has completed yet.", status=503)
+    return JsonResponse(results)
+
+
+@require_http_methods(['GET'])
+def job(request, job_id):
+    return JsonResponse(get_object_or_404(Job, pk=job_id).to_dict())
 
 
 @require_http_methods(['GET', 'POST', 'DELETE'])
 def tunnel(request, tunel_id):
     tun = get_object_or_404(Tunnel, pk=tunel_id)
     if request.method == 'POST':
-        tun.enable()
+        # Changing the performance profile only restarts the tunnel if its
+        # rendered config changes, shaping is changed in place
+        for field in ('profile', 'tuning'):
+            if field in request.POST:
+                setattr(tun, field, request.POST[field])
+        for field in ('rate', 'ceil'):
+            if field in request.POST:
+                setattr(tun, field, request.POST[field] or None)
+        tun.active = True
+        try:
+            tun.save()
+        except ValidationError as exc:
+            return HttpResponse('; '.join(exc.messages), status=400)
     elif request.method == 'DELETE':
         tun.delete()
         return HttpResponse('OK', status=200)
@@ -59,6 +113,9 @@ def script(request, tunel_id):
 
 @require_http_methods(['GET'])
 def connection(request, tunnel_id, target, port):
+    loc_port = forwarding_cache.get(int(tunnel_id), target, int(port))
+    if loc_port is not None:
+        return HttpResponse(loc_port)
     entry = {
         'dst_addr': target,
         'dst_port': int(port),
@@ -68,6 +125,7 @@ def connection(request, tunnel_id, target, port):
         # look up db for existing entry in order to avoid duplicates
         forwarding = Forwarding.objects.get(**entry)
         forwarding.enable()
+        forwarding_cache.set(forwarding)
         return HttpResponse(forwarding.port)
     except Forwarding.DoesNotExist:
         try:
@@ -78,9 +136,31 @@ def connection(request, tunnel_id, target, port):
         forwarding = Forwarding(loc_port=loc_port, active=False, **entry)
         forwarding.save()
         forwarding.enable()
+        forwarding_cache.set(forwarding)
     return HttpResponse(forwarding.port)
 
 
+@require_http_methods(['POST'])
+def forwardings(request, tunnel_id):
+    tunnel = get_object_or_404(Tunnel, pk=tunnel_id)
+    targets = []
+    for target in request.POST.getlist('targets'):
+        addr, _, port = target.rpartition(':')
+        if not addr or not port.isdigit():
+            return HttpResponse("Invalid target %s, expected IP:port." %
+                                target, status=400)
+        targets.append((addr, int(port)))
+    try:
+        fwds = create_forwardings(tunnel, targets)
+    except ValidationError as exc:
+        return HttpResponse('; '.join(exc.messages), status=400)
+    except Exception as exc:
+        log.exception(exc)
+        return HttpResponse(str(exc), status=409)
+    return JsonResponse([{'dst_addr': fwd.dst_addr, 'dst_port': fwd.dst_port,
+                          'loc_port': fwd.loc_port} for fwd in fwds])
+
+
 @require_http_methods(['GET'])
 def ping(request, tunnel_id, target):
     tunnel = get_object_or_404(Tunnel, pk=tunnel_id)
@@ -95,9 +175,37 @@ def ping(request, tunnel_id, target):
         except (ValueError, TypeError) as exc:
             log.warning("Couldn't cast pkts param (%s) to int: %r",
                         request.GET['pkts'], exc)
-
-    cmd = ['ping', '-c', str(pkts), '-i', '0.4', '-W', '1', '-q', '-I',
-           str(tunnel.name), str(hostname)]
-    ping_output = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-    ping_parsed = pingparser.parse(ping_output.stdout.read())
-    return JsonResponse(ping_parsed)
+    deadline = None
+    if request.GET.get('deadline'):
+        try:
+            deadline = float(request.GET['deadline'])
+        except (ValueError, TypeError) as exc:
+            log.warning("Couldn't cast deadline param (%s) to float: %r",
+                        request.GET['deadline'], exc)
+    hostname = str(hostname)
+    try:
+        results = icmp.iter_ping(hostname, tunnel.iface, count=max(pkts, 1),
+                                 deadline=deadline)
+    except socket.error as exc:
+        # Binding to the interface requires CAP_NET_RAW, even for the
+        # datagram sockets used when raw ones aren't permitted
+        log.error("Failed to open ICMP socket over %s: %r", tunnel.iface,
+                  exc)
+        return HttpResponse("Can't ping over %s, the server lacks the "
+                            "CAP_NET_RAW capability required to bind ICMP "
+                            "sockets to it: %s" % (tunnel.iface, exc),
+                            status=503)
+    if request.GET.get('stream'):
+        return StreamingHttpResponse(_stream_ping(hostname, results),
+                                     content_type='application/x-ndjson')
+    return JsonResponse(icmp.summarize(hostname, list(results)))
+
+
+def _stream_ping(hostname, results):
+    """Yield a JSON line per echo request as it's answered or lost,
+    followed by the summary"""
+    done = []
+    for seq, rtt in results:
+        done.append((seq, rtt))
+        yield json.dumps({'seq': seq, 'rtt': rtt}) + '\n'
+    yield json.dumps(icmp.summarize(hostname, done)) + '\n'
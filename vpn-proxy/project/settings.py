@@ -42,9 +42,110 @@ PORT_ALLOC_RANGE = (5000, 10000)
 # VPN interface name prefix
 IFACE_PREFIX = 'vpn-tun'
 
+# Serve new UDP tunnels from a few shared, multi-client OpenVPN servers,
+# which authenticate clients with TLS certificates and configure them
+# through a client-config-dir, instead of starting an OpenVPN server with its
+# own port and static key per tunnel. Set to the number of shared servers,
+# 0 disables
+SHARED_SERVERS = 0
+
+# The network shared servers and their clients are addressed from, split
+# evenly among shared servers. It's excluded from the addresses of dedicated
+# tunnels and must not overlap with any network routed over a tunnel. Each
+# shared server's part should be a /16 or smaller, so that its tunnels get
+# traffic shaping classes of their own
+SHARED_SERVER_CIDR = '172.31.0.0/16'
+
+# The port of the first shared server, incremented by one for every other
+SHARED_SERVER_PORT_START = 1100
+
+# The prefix of the network interfaces of shared servers
+SHARED_IFACE_PREFIX = 'vpn-srv'
+
+# Where the CA and server certificate of shared servers, as well as their
+# client-config-dir, are kept
+PKI_DIR = '/etc/openvpn/vpn-proxy'
+
+# OpenVPN performance profiles, rendered into both the server and the client
+# config of tunnels. Each tunnel picks a profile by name and may override
+# any of its options: sndbuf, rcvbuf, tun_mtu, mssfix and txqueuelen, in
+# bytes or packets, and fast_io, a boolean. Options left out are left to
+# OpenVPN's defaults. fast_io and mssfix only apply to UDP tunnels. Tunnels
+# of shared servers always use the default profile, as does the server
+PERFORMANCE_PROFILES = {
+    'default': {},
+    'high-latency': {'sndbuf': 4194304, 'rcvbuf': 4194304, 'fast_io': True,
+                     'txqueuelen': 1000},
+    'low-mtu': {'tun_mtu': 1400, 'mssfix': 1360},
+}
+DEFAULT_PERFORMANCE_PROFILE = 'default'
+
+# Pin each OpenVPN server, being single-threaded, to a CPU of its own choice
+# with a systemd drop-in for its openvpn@ unit, so that busy servers don't
+# share a core while others sit idle. New servers go to the CPU least loaded
+# by the servers already pinned, `manage.py rebalance_openvpn` re-spreads
+# them all by their current load
+OPENVPN_CPU_AFFINITY = False
+
+# The CPUs OpenVPN servers may be pinned to, None for all
+OPENVPN_CPUS = None
+
+# The niceness of OpenVPN servers set in their drop-ins, None to leave as is
+OPENVPN_NICE = None
+
 # The interface that may accept proxying requests
 IN_IFACE = 'eth0'
 
+# How IP rules and routes are managed, either 'iproute2' to run the `ip`
+# command or 'netlink' to talk to the kernel over rtnetlink directly
+ROUTING_BACKEND = 'iproute2'
+
+# How OpenVPN units are controlled, either 'systemctl' to fork `systemctl`
+# or 'dbus' to talk to the systemd manager over D-Bus directly, listing
+# units in a single call and waiting for the jobs of many units together
+SYSTEMD_BACKEND = 'systemctl'
+
+# How forwardings are marked and DNATed, either 'iptables' to add a set of
+# rules per forwarding or 'nftables' to look them up by local port in the
+# maps of a single `vpn-proxy` nftables table
+FIREWALL_BACKEND = 'iptables'
+
+# Directory holding the lock files used to serialize changes to shared
+# resources, such as /etc/iproute2/rt_tables, across processes
+LOCK_DIR = '/var/lock/vpn-proxy'
+
+# Provision new tunnels in the background, responding with 202 and a job to
+# poll under /jobs/<id>/, instead of within the request. Clients may also
+# opt in or out per request by POSTing `async`
+ASYNC_PROVISIONING = False
+
+# Number of threads per web server process running background jobs
+JOB_WORKERS = 4
+
+# Keep this many tunnels with default options provisioned ahead of time, to
+# be claimed by requests to create one in milliseconds instead of seconds.
+# The pool is topped up in the background after every claim and may be
+# filled up front with `manage.py fill_tunnel_pool`. Set to 0 to disable
+TUNNEL_POOL_SIZE = 0
+
+# Ping the client end of every active tunnel every this many seconds, from
+# `manage.py sweep_health`, and serve the latest round-trip times and packet
+# loss under /health/. Set to 0 to disable
+HEALTH_CHECK_INTERVAL = 60
+
+# Echo requests sent to each tunnel per sweep, and seconds to wait for the
+# replies to the last of them
+HEALTH_CHECK_PKTS = 3
+HEALTH_CHECK_TIMEOUT = 1
+
+# The maximum number of tunnels probed at once, each probe holding a socket
+HEALTH_CHECK_CONCURRENCY = 512
+
+# Seconds to remember, per web server process, forwardings that have been
+# enabled, so that repeated requests for them skip the DB and the kernel.
+# Set to 0 to disable
+FORWARDING_CACHE_TTL = 300
+
 # Application definition
 
 INSTALLED_APPS = [